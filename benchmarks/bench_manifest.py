@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Compare the cost of loading dataset JSON and dataset manifests.
+
+A synthetic campaign with the given number of datasets and files per dataset
+is generated in a temporary directory, and the following are timed for each
+format:
+
+- loading every dataset (as `make_mapfiles' does)
+- looking up only the dataset IDs (as `get_catalogs' does)
+- loading a single dataset by ID
+
+The memory used to hold one dataset's files as a list of dictionaries and as a
+FileList is also shown.
+
+Usage: python benchmarks/bench_manifest.py [-d DATASETS] [-f FILES]
+"""
+import sys
+import os
+import argparse
+import json
+import tempfile
+import time
+import tracemalloc
+
+from esacci_esgf.input.manifest import json_to_manifest, load_datasets
+from esacci_esgf.input.file_list import FileList
+
+
+def make_campaign(num_datasets, files_per_dataset):
+    """
+    Return a dictionary in dataset JSON format
+    """
+    campaign = {}
+    for i in range(num_datasets):
+        dsid = "esacci.BENCH.day.L3S.VAR.sensor.platform.prod{}.1-0.r1.v2018"
+        dsid = dsid.format(i)
+        files = []
+        for j in range(files_per_dataset):
+            files.append({
+                "path": "/neodc/esacci/bench/data/{}/file_{:07d}.nc".format(i, j),
+                "size": 1000000 + j,
+                "mtime": 1500000000.0 + j,
+                "sha256": "{:064x}".format(i * files_per_dataset + j)
+            })
+        campaign[dsid] = {
+            "generate_aggregation": True,
+            "include_in_wms": bool(i % 2),
+            "tech_note_url": "http://tech.notes/{}".format(i),
+            "tech_note_title": "Tech note {}".format(i),
+            "files": files
+        }
+    return campaign
+
+
+def timed(label, func, *args):
+    start = time.time()
+    result = func(*args)
+    print("{:<40} {:>10.3f} s".format(label, time.time() - start))
+    return result
+
+
+def load_all(filename):
+    datasets = load_datasets(filename)
+    count = sum(len(ds["files"]) for _, ds in datasets.items())
+    if hasattr(datasets, "close"):
+        datasets.close()
+    return count
+
+
+def load_keys(filename):
+    datasets = load_datasets(filename)
+    keys = list(datasets.keys())
+    if hasattr(datasets, "close"):
+        datasets.close()
+    return keys
+
+
+def load_one(filename, dsid):
+    datasets = load_datasets(filename)
+    ds = datasets[dsid]
+    if hasattr(datasets, "close"):
+        datasets.close()
+    return ds
+
+
+def memory_used(func, *args):
+    """
+    Return the amount of memory (in bytes) allocated by func(*args) and still
+    in use when it returns
+    """
+    tracemalloc.start()
+    result = func(*args)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "-d", "--datasets",
+        type=int,
+        default=100,
+        help="Number of datasets to generate [default: %(default)s]"
+    )
+    parser.add_argument(
+        "-f", "--files",
+        type=int,
+        default=10000,
+        help="Number of files per dataset [default: %(default)s]"
+    )
+    args = parser.parse_args(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        json_file = os.path.join(tmpdir, "campaign.json")
+        manifest_file = os.path.join(tmpdir, "campaign.manifest")
+
+        campaign = make_campaign(args.datasets, args.files)
+        dsid = sorted(campaign.keys())[len(campaign) // 2]
+        with open(json_file, "w") as f:
+            json.dump(campaign, f)
+        file_dicts_json = json.dumps(campaign[dsid]["files"])
+        del campaign
+
+        print("{} datasets, {} files per dataset".format(args.datasets,
+                                                         args.files))
+        timed("convert JSON to manifest", json_to_manifest, json_file,
+              manifest_file)
+        for label, filename in (("JSON", json_file),
+                                ("manifest", manifest_file)):
+            print("")
+            print("{}: {:.1f} MB".format(label,
+                                         os.path.getsize(filename) / 1e6))
+            timed("{}: load all datasets".format(label), load_all, filename)
+            timed("{}: list dataset IDs".format(label), load_keys, filename)
+            timed("{}: load one dataset by ID".format(label), load_one,
+                  filename, dsid)
+
+        print("")
+        dicts_mem = memory_used(json.loads, file_dicts_json)
+        file_list_mem = memory_used(
+            lambda: FileList(json.loads(file_dicts_json))
+        )
+        print("{:<40} {:>10.1f} MB".format("one dataset: list of dicts",
+                                           dicts_mem / 1e6))
+        print("{:<40} {:>10.1f} MB".format("one dataset: FileList",
+                                           file_list_mem / 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Time a full pass of modify_solr_links over a local fake Solr server (see
+fake_solr.py), so that changes to querying and batching can be measured
+without touching a real index.
+
+The 'datasets' and 'files' cores are seeded with the given number of ESGF-shaped
+esacci documents in total, all of which have links that need fixing. For each
+of the two query modes (checking every document locally, and asking Solr for
+only the documents that need updating), the following are timed:
+
+- a first pass, which fixes every document
+- a second pass, in which there is nothing left to fix
+
+After each first pass, every document is checked to make sure that it no longer
+needs updating, and the script exits with an error if not.
+
+Usage: python benchmarks/bench_solr_links.py [-n DOCS] [-f FILES] [-b BATCH]
+           [-j CONCURRENCY]
+"""
+import sys
+import os
+import argparse
+import contextlib
+import copy
+import time
+
+import pysolr
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_solr import FakeSolrServer  # noqa: E402
+from esacci_esgf.http_session import make_session  # noqa: E402
+from esacci_esgf.modify_solr_links import (CORES, fix_core, run_jobs,  # noqa
+                                           update_urls)
+
+DATA_NODE = "cci-odp-data.ceda.ac.uk"
+THREDDS = "http://{}/thredds".format(DATA_NODE)
+
+
+def make_docs(num_docs, files_per_dataset):
+    """
+    Return a dictionary mapping core name to a list of documents, with
+    `num_docs' documents in total
+    """
+    docs = {"datasets": [], "files": []}
+    num_datasets = max(1, num_docs // (files_per_dataset + 1))
+    for i in range(num_datasets):
+        ds_name = ("esacci.BENCH.day.L3S.VAR.sensor.platform.prod{}.1-0.r1"
+                   .format(i))
+        instance_id = "{}.v20180101".format(ds_name)
+        urls = [
+            "{}/catalog/esacci/{}.xml#{}|application/xml+thredds|THREDDS"
+            .format(THREDDS, instance_id, instance_id),
+            "{}/dodsC/{}.html|application/opendap-html|OPENDAP"
+            .format(THREDDS, instance_id)
+        ]
+        if i % 2:
+            urls += [
+                "{}/wms/{}|application/xml+wms|WMS".format(THREDDS,
+                                                          instance_id),
+                "{}/wcs/{}|application/xml+wcs|WCS".format(THREDDS,
+                                                          instance_id)
+            ]
+        docs["datasets"].append({
+            "id": "{}|{}".format(instance_id, DATA_NODE),
+            "instance_id": instance_id,
+            "master_id": ds_name,
+            "data_node": DATA_NODE,
+            "project": ["esacci"],
+            "url": urls
+        })
+
+    num_files = num_docs - num_datasets
+    for j in range(num_files):
+        i = j % num_datasets
+        instance_id = docs["datasets"][i]["instance_id"]
+        filename = "file_{:07d}.nc".format(j)
+        path = "esg_esacci/bench/{}/{}".format(i, filename)
+        docs["files"].append({
+            "id": "{}.{}|{}".format(instance_id, filename, DATA_NODE),
+            "instance_id": "{}.{}".format(instance_id, filename),
+            "dataset_id": "{}|{}".format(instance_id, DATA_NODE),
+            "data_node": DATA_NODE,
+            "project": ["esacci"],
+            "url": [
+                "{}/fileServer/{}|application/netcdf|HTTPServer"
+                .format(THREDDS, path),
+                "{}/dodsC/{}.html|application/opendap-html|OPENDAP"
+                .format(THREDDS, path)
+            ]
+        })
+    return docs
+
+
+def seed(server, docs):
+    for core, core_docs in docs.items():
+        index = server.cores[core]
+        index.docs = {}
+        index.ids = []
+        index.commits = 0
+        index.update_requests = 0
+        # Documents are sorted first so that adding is quick
+        for doc in sorted(core_docs, key=lambda d: d["id"]):
+            index.docs[doc["id"]] = copy.deepcopy(doc)
+            index.ids.append(doc["id"])
+
+
+def count_unfixed(server):
+    """
+    Return the number of documents in the server that still need updating
+    """
+    return sum(update_urls(copy.deepcopy(doc))
+               for index in server.cores.values()
+               for doc in index.docs.values())
+
+
+def timed_pass(label, solrs, prefilter, **kwargs):
+    jobs = [(fix_core, (core, solrs[core], prefilter)) for core in CORES]
+    start = time.time()
+    # Hide the progress messages printed while querying
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            totals = run_jobs(jobs, solrs, **kwargs)
+    secs = time.time() - start
+    checked = sum(t.updated + t.unchanged for t in totals.values())
+    updated = sum(t.updated for t in totals.values())
+    print("{:<40} {:>10.3f} s {:>10.0f} docs/s {:>8} updated"
+          .format(label, secs, checked / secs if secs else 0, updated))
+    return updated
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "-n", "--docs",
+        type=int,
+        default=100000,
+        help="Total number of documents to generate [default: %(default)s]"
+    )
+    parser.add_argument(
+        "-f", "--files",
+        type=int,
+        default=99,
+        help="Number of file documents per dataset [default: %(default)s]"
+    )
+    parser.add_argument(
+        "-b", "--batch-size",
+        type=int,
+        default=500,
+        help="Number of updated documents to send at once "
+             "[default: %(default)s]"
+    )
+    parser.add_argument(
+        "-j", "--concurrency",
+        type=int,
+        default=2,
+        help="Maximum number of requests to make at once "
+             "[default: %(default)s]"
+    )
+    args = parser.parse_args(sys.argv[1:])
+
+    docs = make_docs(args.docs, args.files)
+    print("{} dataset documents, {} file documents".format(
+        len(docs["datasets"]), len(docs["files"])
+    ))
+
+    server = FakeSolrServer(cores=CORES)
+    server.start()
+    try:
+        session = make_session(pool_size=args.concurrency)
+        solrs = {}
+        for core in CORES:
+            solrs[core] = pysolr.Solr("{}/solr/{}".format(server.url, core))
+            solrs[core].session = session
+
+        failed = False
+        for prefilter in (False, True):
+            mode = "prefilter" if prefilter else "no prefilter"
+            seed(server, docs)
+            print("")
+            timed_pass("{}: first pass".format(mode), solrs, prefilter,
+                       concurrency=args.concurrency,
+                       batch_size=args.batch_size)
+            requests = sum(i.update_requests for i in server.cores.values())
+            print("{:<40} {:>10}".format("{}: update requests".format(mode),
+                                         requests))
+            unfixed = count_unfixed(server)
+            if unfixed:
+                print("ERROR: {} documents were not fixed".format(unfixed),
+                      file=sys.stderr)
+                failed = True
+            updated = timed_pass("{}: second pass".format(mode), solrs,
+                                 prefilter, concurrency=args.concurrency,
+                                 batch_size=args.batch_size)
+            if updated:
+                print("ERROR: {} documents were updated twice"
+                      .format(updated), file=sys.stderr)
+                failed = True
+    finally:
+        server.stop()
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
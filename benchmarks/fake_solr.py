@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+Minimal in-memory stand-in for a Solr server, for benchmarking and testing
+modify_solr_links without touching a real index.
+
+Only the parts of the Solr HTTP API used by modify_solr_links are
+implemented:
+
+- /solr/<core>/select with q ('*:*' or a term that must appear in the
+  document ID), fq (see FakeSolrIndex.matches), fl, rows, sort='id asc' and
+  cursorMark. Responses are always JSON.
+
+- /solr/<core>/update with JSON or XML bodies containing documents (with
+  atomic 'set' updates) or commit commands.
+
+Usage: python benchmarks/fake_solr.py [-p PORT]
+"""
+import sys
+import argparse
+import bisect
+import json
+import re
+import socketserver
+import threading
+import xml.etree.cElementTree as ET
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeSolrIndex(object):
+    """
+    In-memory set of documents for a single core, kept sorted by ID
+    """
+    def __init__(self):
+        self.docs = {}
+        self.ids = []
+        self.lock = threading.Lock()
+        self.commits = 0
+        self.update_requests = 0
+
+    def add(self, doc):
+        """
+        Add a document, or apply atomic updates if the document exists and
+        values are given as {"set": value}
+        """
+        with self.lock:
+            doc_id = doc["id"]
+            existing = self.docs.get(doc_id)
+            atomic = any(isinstance(v, dict) for v in doc.values())
+            if existing is not None and atomic:
+                for field, value in doc.items():
+                    if isinstance(value, dict):
+                        existing[field] = value["set"]
+                return
+            if existing is None:
+                bisect.insort(self.ids, doc_id)
+            self.docs[doc_id] = {k: v["set"] if isinstance(v, dict) else v
+                                 for k, v in doc.items()}
+
+    def matches(self, doc, q, fqs):
+        """
+        Return True if a document matches a query and list of filter
+        queries. Filter queries must be of the form
+        'field:("value" OR "value" ...)' or 'field:(/regex/ OR /regex/ ...)'
+        """
+        if q not in ("*:*", "*") and q not in doc["id"]:
+            return False
+
+        for fq in fqs:
+            field, values = re.match(r'(\w+):\((.*)\)$', fq, re.S).groups()
+            doc_values = doc.get(field)
+            if not isinstance(doc_values, list):
+                doc_values = [doc_values]
+            doc_values = [v for v in doc_values if v is not None]
+
+            if values.startswith("/"):
+                regexes = [r.replace("\\/", "/") for r in
+                           re.findall(r'/((?:[^/\\]|\\.)*)/', values)]
+                if not any(re.fullmatch(r, v)
+                           for r in regexes for v in doc_values):
+                    return False
+            else:
+                wanted = set(
+                    re.sub(r'\\(.)', r'\1', v)
+                    for v in re.findall(r'"((?:[^"\\]|\\.)*)"', values)
+                )
+                if not any(v in wanted for v in doc_values):
+                    return False
+        return True
+
+    def select(self, params):
+        q = params.get("q", ["*:*"])[0]
+        fqs = params.get("fq", [])
+        rows = int(params.get("rows", ["10"])[0])
+        cursor = params.get("cursorMark", [None])[0]
+        fields = params.get("fl", ["*"])[0].split(",")
+
+        with self.lock:
+            start = 0
+            if cursor not in (None, "*"):
+                start = bisect.bisect_right(self.ids, cursor)
+            page = []
+            for doc_id in self.ids[start:]:
+                if len(page) == rows:
+                    break
+                doc = self.docs[doc_id]
+                if self.matches(doc, q, fqs):
+                    if "*" in fields:
+                        page.append(json.loads(json.dumps(doc)))
+                    else:
+                        page.append({f: json.loads(json.dumps(doc[f]))
+                                     for f in fields if f in doc})
+
+        response = {
+            "responseHeader": {"status": 0, "QTime": 0},
+            "response": {"numFound": len(page), "start": 0, "docs": page}
+        }
+        if cursor is not None:
+            response["nextCursorMark"] = page[-1]["id"] if page else cursor
+        return response
+
+    def update(self, body, content_type, params):
+        self.update_requests += 1
+        if "json" in content_type:
+            message = json.loads(body.decode("utf-8"))
+            if isinstance(message, dict):
+                if "commit" in message:
+                    self.commits += 1
+                docs = [message["add"]["doc"]] if "add" in message else []
+            else:
+                docs = message
+        else:
+            root = ET.fromstring(body)
+            docs = []
+            if root.tag == "commit":
+                self.commits += 1
+            for doc_el in root.iter("doc"):
+                doc = {}
+                for field in doc_el.iter("field"):
+                    name = field.get("name")
+                    value = field.text or ""
+                    if field.get("update"):
+                        doc.setdefault(name, {"set": []})["set"].append(value)
+                    elif name in doc:
+                        if not isinstance(doc[name], list):
+                            doc[name] = [doc[name]]
+                        doc[name].append(value)
+                    else:
+                        doc[name] = value
+                docs.append(doc)
+
+        for doc in docs:
+            self.add(doc)
+        if params.get("commit", ["false"])[0] == "true":
+            self.commits += 1
+        return {"responseHeader": {"status": 0, "QTime": 0}}
+
+
+class FakeSolrHandler(BaseHTTPRequestHandler):
+    # Use keep-alive connections, as Solr does
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def get_core_and_handler(self, path):
+        parts = [p for p in path.split("/") if p]
+        if len(parts) < 3 or parts[0] != "solr" or \
+                parts[1] not in self.server.cores:
+            return None, None
+        return self.server.cores[parts[1]], parts[2]
+
+    def send_json(self, obj, status=200):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_request(self, body=b""):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        core, handler = self.get_core_and_handler(url.path)
+        if core is None:
+            self.send_json({"error": "not found"}, status=404)
+            return
+
+        content_type = self.headers.get("Content-Type", "")
+        if handler == "select":
+            if "x-www-form-urlencoded" in content_type:
+                params.update(parse_qs(body.decode("utf-8")))
+            self.send_json(core.select(params))
+        elif handler == "update":
+            self.send_json(core.update(body, content_type, params))
+        else:
+            self.send_json({"error": "unknown handler"}, status=404)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.handle_request(self.rfile.read(length))
+
+
+class FakeSolrServer(socketserver.ThreadingMixIn, HTTPServer):
+    """
+    HTTP server with an in-memory index for each of the given cores. Use
+    start() to serve requests in a background thread
+    """
+    daemon_threads = True
+
+    def __init__(self, cores=("datasets", "files"), port=0):
+        super().__init__(("127.0.0.1", port), FakeSolrHandler)
+        self.cores = {core: FakeSolrIndex() for core in cores}
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "-p", "--port",
+        type=int,
+        default=8984,
+        help="Port to listen on [default: %(default)s]"
+    )
+    args = parser.parse_args(sys.argv[1:])
+
+    server = FakeSolrServer(port=args.port)
+    print("Serving fake Solr at {}".format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -6,11 +6,13 @@ import xml.etree.cElementTree as ET
 from tds_utils.aggregation import (NetcdfDatasetReader, BaseAggregationCreator,
                                    AggregationType, NcMLVariable)
 
+from esacci_esgf.aggregation.throttle import ThrottledReaderMixin
+
 
 UNITS = "days since 1970-01-01 00:00:00 UTC"
 
 
-class CCIAerosolDatasetReader(NetcdfDatasetReader):
+class CCIAerosolDatasetReader(ThrottledReaderMixin, NetcdfDatasetReader):
 
     # datetime formats to try (in order of preference)
     time_formats = (
@@ -6,7 +6,10 @@ from uuid import uuid4
 from netCDF4 import Dataset
 import isodate
 
-from tds_utils.aggregation import AggregationCreator, AggregatedGlobalAttr
+from tds_utils.aggregation import (AggregationCreator, AggregatedGlobalAttr,
+                                   NetcdfDatasetReader)
+
+from esacci_esgf.aggregation.throttle import LIMITER, ThrottledReaderMixin
 
 
 # Functions to convert between ISO datetime string and datetime objects
@@ -58,8 +61,16 @@ def unique_strings(strings):
     return ",".join(sorted(set(filter(None, map(str.strip, strings)))))
 
 
+class CCIDatasetReader(ThrottledReaderMixin, NetcdfDatasetReader):
+    """
+    Dataset reader that limits the number of files open at once
+    """
+
+
 class CCIAggregationCreator(AggregationCreator):
 
+    dataset_reader_cls = CCIDatasetReader
+
     # List of (start_attr, end_attr) for possible attribute names for time
     # coverage
     date_range_formats = [
@@ -85,7 +96,8 @@ class CCIAggregationCreator(AggregationCreator):
 
         # Add aggregated global attributes
         attr_aggs = kwargs.pop("attr_aggs", [])
-        ds = Dataset(file_list[0])
+        with LIMITER.open_file(Dataset, file_list[0]) as ds:
+            first_attrs = set(ds.ncattrs())
 
         # Platform, sensor and source
         attr_aggs += [
@@ -96,7 +108,7 @@ class CCIAggregationCreator(AggregationCreator):
 
         # Time coverage
         for start_attr, end_attr in self.date_range_formats:
-            if hasattr(ds, start_attr) and hasattr(ds, end_attr):
+            if start_attr in first_attrs and end_attr in first_attrs:
                 attr_aggs += [
                     AggregatedGlobalAttr(attr=start_attr, callback=min_date),
                     AggregatedGlobalAttr(attr=end_attr, callback=max_date)
@@ -104,7 +116,7 @@ class CCIAggregationCreator(AggregationCreator):
 
         # Geospatial bounds
         for attr_names in self.geospatial_bounds_formats:
-            if all(hasattr(ds, attr) for attr in attr_names):
+            if all(attr in first_attrs for attr in attr_names):
                 n_attr, e_attr, s_attr, w_attr = attr_names
                 attr_aggs += [
                     AggregatedGlobalAttr(attr=n_attr, callback=max),
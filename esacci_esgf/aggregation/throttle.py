@@ -0,0 +1,291 @@
+"""
+Limit the number of netCDF files that are open at once when reading headers
+for aggregations, so that the metadata servers behind shared storage are not
+overloaded.
+
+The limit is adjusted as files are opened, in the same way as TCP congestion
+control (additive increase, multiplicative decrease). It grows by roughly one
+for every `limit' files opened while the recent open latency is within the
+target, and is halved when it is not. It always stays between a floor and a
+ceiling.
+
+A thread that already has a file open may open more without waiting (e.g. to
+read a second file while the first is still open), since otherwise it could
+wait forever for a slot that only it can free. Such nested opens are still
+counted while they are in progress.
+
+The floor, ceiling and target latency of the limiter shared by the scripts
+can be set with the options added by add_limit_arguments(), whose defaults
+are taken from the environment.
+
+This module does not import netCDF4, so that lightweight scripts can report
+its metrics without paying the cost of importing it.
+"""
+import os
+import threading
+import time
+from array import array
+from collections import deque
+from contextlib import contextmanager
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """
+    Return a dictionary mapping 'p<n>' to the n-th percentile of `values'
+    (using the nearest-rank method) for each n in `points', and 'max' to the
+    maximum. Values are None if `values' is empty
+    """
+    values = sorted(values)
+    result = {}
+    for point in points:
+        rank = max(0, -(-point * len(values) // 100) - 1)
+        result["p{}".format(point)] = values[rank] if values else None
+    result["max"] = values[-1] if values else None
+    return result
+
+
+class AdaptiveLimiter(object):
+    """
+    Limit the number of operations in progress at once, adjusting the limit
+    based on how long recent operations took to start.
+
+    `target_latency' is the time in seconds that the 95th percentile of the
+    last `window' open times should stay within. The limit starts at `floor'.
+    The limiter may be shared between threads, and acquire() does not wait in
+    a thread that already holds a slot
+    """
+    def __init__(self, floor=1, ceiling=16, target_latency=0.5, window=50,
+                 min_samples=5, decrease_factor=0.5):
+        self.cond = threading.Condition()
+        # configure() raises the limit to the floor
+        self.limit = 1.0
+        self.configure(floor, ceiling, target_latency)
+        self.min_samples = min_samples
+        self.decrease_factor = decrease_factor
+
+        # Number of slots held by the current thread
+        self.held = threading.local()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.decreases = 0
+        self.failed = 0
+        self.recent = deque(maxlen=window)
+        self.open_latencies = array("d")
+        self.read_latencies = array("d")
+
+    def configure(self, floor, ceiling, target_latency):
+        """
+        Set the floor, ceiling and target latency. The current limit is moved
+        within the new bounds if necessary
+        """
+        if not 1 <= floor <= ceiling:
+            raise ValueError("Must have 1 <= floor <= ceiling")
+        if target_latency <= 0:
+            raise ValueError("Target latency must be positive")
+        with self.cond:
+            self.floor = floor
+            self.ceiling = ceiling
+            self.target_latency = target_latency
+            self.limit = min(ceiling, max(floor, self.limit))
+            self.cond.notify_all()
+
+    @property
+    def current_limit(self):
+        return int(self.limit)
+
+    def acquire(self):
+        """
+        Wait until another operation may start, and record that it has. Does
+        not wait if the current thread already holds a slot. The slot must be
+        released by the same thread
+        """
+        with self.cond:
+            held = getattr(self.held, "count", 0)
+            while not held and self.in_flight >= self.current_limit:
+                self.cond.wait()
+            self.held.count = held + 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def release(self, open_seconds, read_seconds=None):
+        """
+        Record that an operation has finished, along with the time taken to
+        open the file and the time it was then in use for. `read_seconds'
+        should be None if the open failed
+        """
+        with self.cond:
+            self.held.count -= 1
+            self.in_flight -= 1
+            self.open_latencies.append(open_seconds)
+            if read_seconds is None:
+                self.failed += 1
+            else:
+                self.read_latencies.append(read_seconds)
+            self.adjust(open_seconds)
+            self.cond.notify_all()
+
+    def adjust(self, open_seconds):
+        """
+        Update the limit after an open that took `open_seconds'. Must be
+        called with the lock held
+        """
+        self.recent.append(open_seconds)
+        if (len(self.recent) >= self.min_samples and
+                percentiles(self.recent, (95,))["p95"] > self.target_latency):
+            self.limit = max(self.floor, self.limit * self.decrease_factor)
+            self.decreases += 1
+            # Start afresh, so that the opens that caused this decrease do
+            # not cause another one before the new limit has taken effect
+            self.recent.clear()
+        elif open_seconds <= self.target_latency:
+            self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+
+    @contextmanager
+    def throttled(self):
+        """
+        Context manager to wrap code that opens a file and reads from it. The
+        file should be opened before calling the `opened' function yielded,
+        so that the open and read times can be recorded separately
+        """
+        self.acquire()
+        start = time.monotonic()
+        times = []
+        try:
+            yield lambda: times.append(time.monotonic())
+        finally:
+            end = time.monotonic()
+            if times:
+                self.release(times[0] - start, end - times[0])
+            else:
+                self.release(end - start)
+
+    @contextmanager
+    def open_file(self, opener, *args, **kwargs):
+        """
+        Context manager to open a file with `opener(*args, **kwargs)' and
+        close it afterwards
+        """
+        with self.throttled() as opened:
+            f = opener(*args, **kwargs)
+            opened()
+            try:
+                yield f
+            finally:
+                f.close()
+
+    def metrics(self):
+        """
+        Return a dictionary describing the current limit and the latencies
+        seen so far
+        """
+        with self.cond:
+            return {
+                "limit": self.current_limit,
+                "floor": self.floor,
+                "ceiling": self.ceiling,
+                "target_latency": self.target_latency,
+                "max_in_flight": self.max_in_flight,
+                "opens": len(self.open_latencies),
+                "failed_opens": self.failed,
+                "decreases": self.decreases,
+                "open_latency": percentiles(self.open_latencies),
+                "read_latency": percentiles(self.read_latencies)
+            }
+
+    def summary(self):
+        """
+        Return a one-line description of the metrics, or None if no files
+        have been opened
+        """
+        m = self.metrics()
+        if not m["opens"]:
+            return None
+        latency = "p50 {p50:.3f} s, p90 {p90:.3f} s, p99 {p99:.3f} s"
+        return ("Opened {opens} files ({failed_opens} failed), at most "
+                "{max_in_flight} at once; limit {limit} (between {floor} and "
+                "{ceiling}); open latency ".format(**m) +
+                latency.format(**m["open_latency"]))
+
+
+class ThrottledReaderMixin(object):
+    """
+    Mixin for tds_utils dataset readers so that files are opened through an
+    AdaptiveLimiter. The file is counted as in use until the reader is
+    closed
+    """
+    limiter = None
+
+    def __enter__(self):
+        limiter = self.limiter or LIMITER
+        self._throttle = limiter.throttled()
+        opened = self._throttle.__enter__()
+        try:
+            reader = super().__enter__()
+        except BaseException:
+            self._throttle.__exit__(None, None, None)
+            raise
+        opened()
+        return reader
+
+    def __exit__(self, *args):
+        try:
+            return super().__exit__(*args)
+        finally:
+            self._throttle.__exit__(None, None, None)
+
+
+def add_limit_arguments(parser):
+    """
+    Add options to an argparse parser for the floor, ceiling and target
+    latency of LIMITER. The defaults are taken from the environment
+    """
+    env = os.environ.get
+    group = parser.add_argument_group("limits on open netCDF files")
+    group.add_argument(
+        "--min-open-files",
+        type=int,
+        default=int(env("MIN_OPEN_FILES", 1)),
+        help="Minimum limit on the number of files open at once "
+             "[default: $MIN_OPEN_FILES or %(default)s]"
+    )
+    group.add_argument(
+        "--max-open-files",
+        type=int,
+        default=int(env("MAX_OPEN_FILES", 16)),
+        help="Maximum limit on the number of files open at once "
+             "[default: $MAX_OPEN_FILES or %(default)s]"
+    )
+    group.add_argument(
+        "--open-latency-target",
+        type=float,
+        default=float(env("OPEN_LATENCY_TARGET", 0.5)),
+        help="Time in seconds that the 95th percentile of recent open times "
+             "should stay within [default: $OPEN_LATENCY_TARGET or "
+             "%(default)s]"
+    )
+
+
+def configure_limiter(parser, args):
+    """
+    Apply the options added by add_limit_arguments() to LIMITER, exiting with
+    a usage error if they are invalid
+    """
+    try:
+        LIMITER.configure(args.min_open_files, args.max_open_files,
+                          args.open_latency_target)
+    except ValueError as ex:
+        parser.error("Invalid open file limits: {}".format(ex))
+
+
+def limit_options(args):
+    """
+    Return a list of command line options that pass on the values of the
+    options added by add_limit_arguments()
+    """
+    return ["--min-open-files", str(args.min_open_files),
+            "--max-open-files", str(args.max_open_files),
+            "--open-latency-target", str(args.open_latency_target)]
+
+
+# Limiter shared by all aggregations created in this process
+LIMITER = AdaptiveLimiter()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Make requests to the OPeNDAP (and WMS, where enabled) endpoints of each NcML
+aggregation in a dataset JSON file, so that THREDDS builds and caches the
+aggregations before users access them.
+"""
+import sys
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from esacci_esgf.http_session import make_session
+from esacci_esgf.input.manifest import load_datasets
+
+
+def aggregation_urls(thredds_url, dsid, include_in_wms=False):
+    """
+    Return a list of URLs to request to warm the cache for the aggregation
+    for the given dataset
+    """
+    thredds_url = thredds_url.rstrip("/")
+    urls = [
+        "{}/dodsC/{}.dds".format(thredds_url, dsid),
+        "{}/dodsC/{}.das".format(thredds_url, dsid)
+    ]
+    if include_in_wms:
+        urls.append("{}/wms/{}?service=WMS&version=1.3.0"
+                    "&request=GetCapabilities".format(thredds_url, dsid))
+    return urls
+
+
+def warm_dataset(session, dsid, urls):
+    """
+    Request each URL in turn and return (dataset ID, seconds taken, list of
+    error messages)
+    """
+    start = time.time()
+    errors = []
+    for url in urls:
+        try:
+            response = session.get(url)
+        except requests.RequestException as ex:
+            errors.append("{}: {}".format(url, ex))
+            continue
+        if response.status_code != 200:
+            errors.append("{}: status code {}".format(url,
+                                                      response.status_code))
+    return dsid, time.time() - start, errors
+
+
+def cache_aggregations(datasets, thredds_url, concurrency=4, session=None):
+    """
+    Warm the cache for all datasets with aggregations in `datasets' (a
+    dictionary in dataset JSON format), requesting up to `concurrency'
+    datasets at once.
+
+    Yield (dataset ID, seconds taken, list of error messages) for each
+    dataset as it finishes
+    """
+    session = session or make_session(pool_size=concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = []
+        for dsid, ds in datasets.items():
+            if not ds["generate_aggregation"]:
+                continue
+            urls = aggregation_urls(thredds_url, dsid,
+                                    include_in_wms=ds["include_in_wms"])
+            futures.append(executor.submit(warm_dataset, session, dsid, urls))
+
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "dataset_json",
+        help="Path to dataset JSON file or manifest"
+    )
+    parser.add_argument(
+        "thredds_url",
+        help="Base URL of the THREDDS server, e.g. http://<host>/thredds/"
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        default=False,
+        help="Print the time taken for each dataset"
+    )
+    parser.add_argument(
+        "-c", "--concurrency",
+        type=int,
+        default=4,
+        help="Number of datasets to request at once [default: %(default)s]"
+    )
+    parser.add_argument(
+        "-t", "--timeout",
+        type=float,
+        default=600,
+        help="Number of seconds to wait for a response. Building a large "
+             "aggregation can take several minutes [default: %(default)s]"
+    )
+    parser.add_argument(
+        "-r", "--retries",
+        type=int,
+        default=3,
+        help="Number of times to retry requests that fail to connect or "
+             "return a server error [default: %(default)s]"
+    )
+    args = parser.parse_args(sys.argv[1:])
+
+    datasets = load_datasets(args.dataset_json)
+    session = make_session(retries=args.retries,
+                           timeout=(10, args.timeout),
+                           pool_size=args.concurrency)
+
+    start = time.time()
+    count = 0
+    failed = 0
+    results = cache_aggregations(datasets, args.thredds_url,
+                                 concurrency=args.concurrency,
+                                 session=session)
+    for dsid, seconds, errors in results:
+        count += 1
+        if errors:
+            failed += 1
+            for error in errors:
+                print("WARNING: {}: {}".format(dsid, error), file=sys.stderr)
+        if args.verbose:
+            print("{:.2f} s {} {}".format(seconds, dsid,
+                                          "FAILED" if errors else "ok"))
+
+    print("Cached {} of {} aggregations in {:.2f} s"
+          .format(count - failed, count, time.time() - start))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Find the locations of NcML aggregations referenced by THREDDS catalogs.
+
+If a single catalog is given, the location of each NcML file is printed on its
+own line. Otherwise, catalogs may be given as files or directories (which are
+searched for '.xml' files), and a line containing the catalog path and NcML
+location separated by a tab is printed for each NcML file.
+"""
+import sys
+import os
+import argparse
+import json
+from collections import OrderedDict
+
+from esacci_esgf.modify_catalogs import ThreddsXMLBase
+
+
+def find_catalogs(paths):
+    """
+    Yield paths of catalogs from a list of files and directories
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.endswith(".xml"):
+                    yield os.path.join(dirpath, name)
+
+
+def find_ncml(paths):
+    """
+    Return an OrderedDict mapping the path of each catalog found in `paths' to
+    a list of the NcML locations it references
+    """
+    parser = ThreddsXMLBase()
+    return OrderedDict((catalog, list(parser.iter_ncml_locations(catalog)))
+                       for catalog in find_catalogs(paths))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "paths",
+        nargs="+",
+        metavar="path",
+        help="THREDDS catalog, or directory containing catalogs"
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        default=False,
+        help="Print a JSON object mapping each catalog to a list of NcML "
+             "locations, including catalogs that do not reference any"
+    )
+    args = parser.parse_args(sys.argv[1:])
+
+    mapping = find_ncml(args.paths)
+    if args.json:
+        json.dump(mapping, sys.stdout, indent=4)
+        print("")
+    elif len(args.paths) == 1 and not os.path.isdir(args.paths[0]):
+        for locations in mapping.values():
+            for location in locations:
+                print(location)
+    else:
+        for catalog, locations in mapping.items():
+            for location in locations:
+                print("{}\t{}".format(catalog, location))
+
+
+if __name__ == "__main__":
+    main()
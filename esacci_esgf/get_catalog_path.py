@@ -25,8 +25,8 @@ def main():
     )
 
     args = parser.parse_args(sys.argv[1:])
-    getter = CatalogGetter(args.esg_ini)
-    locations = getter.get_catalog_locations(args.dataset_name)
+    with CatalogGetter(args.esg_ini) as getter:
+        locations = getter.get_catalog_locations([args.dataset_name])
 
     if args.dataset_name not in locations:
         sys.exit(1)
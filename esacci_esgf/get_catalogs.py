@@ -6,56 +6,107 @@ run `modify_catalogs.py' on each with appropriate arguments.
 Also copy the top-level catalog generated by the publisher into the output
 directory.
 
-The JSON input file should be in the format as required by `make_mapfiles.py'.
+With --shard i/N, only the i-th of N shards of the datasets is processed, so
+that the work can be spread over several hosts. Datasets are split between
+shards by number of files, and every shard must be given the same input files.
+Output is written to a directory for the shard under --shard-dir, and
+`merge_shards' should be run once all shards have finished to move it into the
+output and NcML directories.
+
+The JSON input file should be in the format as required by `make_mapfiles.py',
+or be a dataset manifest.
 """
 import os
 import sys
 import argparse
-import json
 import shutil
+import time
 
-import psycopg2
-
-from esacci_esgf.modify_catalogs import ProcessBatch
+from esacci_esgf.aggregation.throttle import (LIMITER, add_limit_arguments,
+                                              configure_limiter, limit_options)
 from esacci_esgf.input.parse_esg_ini import EsgIniParser
+from esacci_esgf.input.manifest import load_datasets
+from esacci_esgf.shards import (CATALOG_SUBDIR, NCML_SUBDIR, METRICS_FILE,
+                                parse_shard, assign_shards, dataset_sizes,
+                                shard_dir, write_metrics)
 
 
 class CatalogGetter(object):
     def __init__(self, esg_ini, output_dir=None, ncml_dir=None,
-                 remote_agg_dir=None):
+                 remote_agg_dir=None, extra_options=None):
         self.output_dir = output_dir
         self.ncml_dir = ncml_dir
         self.remote_agg_dir = remote_agg_dir
+        # Further options to pass to modify_catalogs
+        self.extra_options = extra_options or []
 
         # Parse esg.ini config file
-        self.dburl = EsgIniParser.get_value(esg_ini, "publication_db_url")
+        values = EsgIniParser.get_values(esg_ini, [
+            "publication_db_url", "thredds_root", "thredds_data_path",
+            "thredds_host"
+        ])
+        self.dburl = values["publication_db_url"]
         # This is the directory that paths in the DB are relative to
-        self.thredds_root = EsgIniParser.get_value(esg_ini, "thredds_root")
+        self.thredds_root = values["thredds_root"]
         # Directory in which data is stored -- required to translate thredds
         # dataset roots to real paths
-        self.data_dir = EsgIniParser.get_value(esg_ini, "thredds_data_path")
+        self.data_dir = values["thredds_data_path"]
         # The hostname of the THREDDS server that will host the data. Required
         # to link to THREDDS catalogues within global attributes in
         # aggregations
-        self.thredds_host = EsgIniParser.get_value(esg_ini, "thredds_host")
+        self.thredds_host = values["thredds_host"]
+        # DB connection shared between lookups (see connect())
+        self.conn = None
+
+    def connect(self):
+        """
+        Return the DB connection, opening it if necessary. The connection is
+        shared by all lookups until close() is called
+        """
+        import psycopg2
+
+        if self.conn is None:
+            self.conn = psycopg2.connect(self.dburl)
+            # Each query should see catalogs published since the last one,
+            # and the connection should not sit idle in a transaction
+            self.conn.autocommit = True
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def get_catalog_locations(self, ds_names):
         """
         Return a dictionary mapping dataset name to path of the corresponding
         THREDDS catalog produced by the ESGF publisher
         """
-        conn = psycopg2.connect(self.dburl)
-        cursor = conn.cursor()
-        cursor.execute("SELECT dataset_name, version, location FROM catalog;")
+        ds_names = set(ds_names)
+        if not ds_names:
+            return {}
 
-        locations = {}
+        # Name from JSON file contains version whereas name in DB does not,
+        # since several versions of a dataset may exist. Thus only query for
+        # the unversioned names, and then look up the concatenated name and
+        # version
+        unversioned = sorted(set(name.rsplit(".v", 1)[0] for name in ds_names))
+        query = ("SELECT dataset_name, version, location FROM catalog "
+                 "WHERE dataset_name = ANY(%s);")
 
-        for name, version, location in cursor:
-            # Name from JSON file contains version whereas name in DB does not,
-            # since several versions of a dataset may exist. Thus we lookup the
-            # concatenated name and version
-            versioned_ds_name = "{}.v{}".format(name, version)
+        cursor = self.connect().cursor()
+        cursor.execute(query, (unversioned,))
+        rows = cursor.fetchall()
 
+        locations = {}
+        for name, version, location in rows:
+            versioned_ds_name = "{}.v{}".format(name, version)
             if versioned_ds_name in ds_names:
                 locations[versioned_ds_name] = location
 
@@ -66,14 +117,90 @@ class CatalogGetter(object):
         Parse a JSON file to get dataset names, retrieve the associated
         catalogs and modify them as necessary
         """
-        with open(json_filename) as f:
-            json_doc = json.load(f)
+        json_doc = load_datasets(json_filename)
 
         ds_names = json_doc.keys()
         cat_locations = self.get_catalog_locations(ds_names)
 
         # Print a warning if not all datasets in JSON were found in the DB
-        not_found = set(ds_names) - set(cat_locations.keys())
+        self.warn_not_found(set(ds_names) - set(cat_locations.keys()))
+
+        for ds_name, cat_loc in cat_locations.items():
+            self.modify_catalog(cat_loc, json_doc[ds_name])
+
+    def get_and_modify_shard(self, json_filenames, index, count, shard_root):
+        """
+        As get_and_modify(), but only process the datasets in shard `index'
+        of `count', and write output to the shard's directory under
+        `shard_root'. Write a metrics file recording the output for each
+        dataset once finished, and return the metrics dictionary
+        """
+        start = time.time()
+        assignment = assign_shards(dataset_sizes(json_filenames), count)
+        shard_ds_names = set(assignment[index])
+
+        directory = shard_dir(shard_root, index, count)
+        self.output_dir = os.path.join(directory, CATALOG_SUBDIR)
+        self.ncml_dir = os.path.join(directory, NCML_SUBDIR)
+        for d in (self.output_dir, self.ncml_dir):
+            if not os.path.isdir(d):
+                os.makedirs(d)
+        # Remove metrics from a previous run, so that the shard does not look
+        # finished if this run fails
+        metrics_path = os.path.join(directory, METRICS_FILE)
+        if os.path.isfile(metrics_path):
+            os.remove(metrics_path)
+
+        metrics = {
+            "shard": "{}/{}".format(index, count),
+            "datasets": {},
+            "not_found": []
+        }
+        for json_filename in json_filenames:
+            json_doc = load_datasets(json_filename)
+            ds_names = sorted(name for name in json_doc.keys()
+                              if name in shard_ds_names and
+                              name not in metrics["datasets"])
+            cat_locations = self.get_catalog_locations(ds_names)
+
+            not_found = set(ds_names) - set(cat_locations.keys())
+            self.warn_not_found(not_found)
+            metrics["not_found"] += sorted(not_found)
+
+            for ds_name in ds_names:
+                ds_start = time.time()
+                info = json_doc[ds_name]
+                ds_metrics = {"files": len(info["files"]), "catalog": None,
+                              "ncml": []}
+                if ds_name in cat_locations:
+                    cat_path = self.modify_catalog(cat_locations[ds_name],
+                                                   info)
+                    if os.path.isfile(cat_path):
+                        ds_metrics["catalog"] = os.path.relpath(
+                            cat_path, self.output_dir
+                        )
+                        ds_metrics["ncml"] = self.ncml_paths(cat_path)
+                ds_metrics["seconds"] = time.time() - ds_start
+                metrics["datasets"][ds_name] = ds_metrics
+
+            if hasattr(json_doc, "close"):
+                json_doc.close()
+
+        # Only one shard needs to provide the top-level catalog
+        if index == 0:
+            self.copy_top_level_catalog()
+
+        metrics["files"] = sum(ds["files"]
+                               for ds in metrics["datasets"].values())
+        metrics["seconds"] = time.time() - start
+        metrics["io"] = LIMITER.metrics()
+        write_metrics(metrics_path, metrics)
+        return metrics
+
+    def warn_not_found(self, not_found):
+        """
+        Print a warning listing datasets that were not found in the DB
+        """
         if not_found:
             print("WARNING: Failed to find the following datasets in the DB:",
                   file=sys.stderr)
@@ -81,30 +208,53 @@ class CatalogGetter(object):
                 print(ds_name, file=sys.stderr)
             print("", file=sys.stderr)
 
-        for ds_name, cat_loc in cat_locations.items():
-            info = json_doc[ds_name]
-            # Need to preserve the directory structure found under
-            # thredds catalog root so that the links in the top-level catalog
-            # are correct when catalogs are moved.
-            #
-            # Thus take the directory name from the cat_loc and append it to
-            # output dir
-            output_dir = os.path.join(self.output_dir, os.path.dirname(cat_loc))
-            if not os.path.isdir(output_dir):
-                os.mkdir(output_dir)
-
-            options = ["--output-dir", output_dir, "--ncml-dir", self.ncml_dir,
-                       "--remote-agg-dir", self.remote_agg_dir, "--data-dir",
-                       self.data_dir, "--server", self.thredds_host]
-            if info["generate_aggregation"]:
-                options.append("--aggregate")
-
-                if info["include_in_wms"]:
-                    options.append("--wms")
-
-            options.append(os.path.join(self.thredds_root, cat_loc))
-            pb = ProcessBatch(options)
-            pb.do_all()
+    def modify_catalog(self, cat_loc, info):
+        """
+        Modify the catalog at `cat_loc' (relative to the THREDDS root) for a
+        dataset, where `info' is the dataset's entry in dataset JSON. Return
+        the path of the modified catalog
+        """
+        # Imported here so that get_catalog_path, which only needs the DB
+        # lookup, does not pay the cost of importing modify_catalogs
+        from esacci_esgf.modify_catalogs import ProcessBatch
+
+        # Need to preserve the directory structure found under
+        # thredds catalog root so that the links in the top-level catalog
+        # are correct when catalogs are moved.
+        #
+        # Thus take the directory name from the cat_loc and append it to
+        # output dir
+        output_dir = os.path.join(self.output_dir, os.path.dirname(cat_loc))
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        options = ["--output-dir", output_dir, "--ncml-dir", self.ncml_dir,
+                   "--remote-agg-dir", self.remote_agg_dir, "--data-dir",
+                   self.data_dir, "--server", self.thredds_host]
+        options += self.extra_options
+        if info["generate_aggregation"]:
+            options.append("--aggregate")
+
+            if info["include_in_wms"]:
+                options.append("--wms")
+
+        options.append(os.path.join(self.thredds_root, cat_loc))
+        pb = ProcessBatch(options)
+        pb.do_all()
+        return os.path.join(output_dir, os.path.basename(cat_loc))
+
+    def ncml_paths(self, cat_path):
+        """
+        Return the paths of the NcML files referenced by a modified catalog,
+        relative to the NcML directory
+        """
+        # Imported here for the same reason as in modify_catalog
+        from esacci_esgf.modify_catalogs import ThreddsXMLBase
+
+        agg_root = os.path.join(os.path.normpath(self.remote_agg_dir), "")
+        return [os.path.relpath(location, agg_root)
+                for location in ThreddsXMLBase().iter_ncml_locations(cat_path)
+                if location.startswith(agg_root)]
 
     def copy_top_level_catalog(self):
         """
@@ -125,8 +275,8 @@ def main():
     parser.add_argument(
         "input_json",
         nargs="*",
-        help="JSON file(s) containing IDs of datasets to obtain the modified "
-             "catalog for"
+        help="JSON file(s) or dataset manifest(s) containing IDs of datasets "
+             "to obtain the modified catalog for"
     )
     parser.add_argument(
         "-e", "--esg-ini",
@@ -154,10 +304,38 @@ def main():
         help="Directory under which NcML aggregations are stored on the "
              "TDS server"
     )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="i/N",
+        help="Only process the i-th of N shards of the datasets (numbered "
+             "from 0), writing output under --shard-dir instead of the "
+             "output and NcML directories"
+    )
+    parser.add_argument(
+        "--shard-dir",
+        help="Directory to write the output of each shard to if using "
+             "--shard"
+    )
+    add_limit_arguments(parser)
 
     args = parser.parse_args(sys.argv[1:])
+    if args.shard and not args.shard_dir:
+        parser.error("--shard-dir is required with --shard")
+    configure_limiter(parser, args)
+
     getter = CatalogGetter(args.esg_ini, args.output_dir, args.ncml_dir,
-                           args.remote_agg_dir)
-    for json_filename in args.input_json:
-        getter.get_and_modify(json_filename)
-    getter.copy_top_level_catalog()
+                           args.remote_agg_dir, limit_options(args))
+    with getter:
+        if args.shard:
+            index, count = args.shard
+            getter.get_and_modify_shard(args.input_json, index, count,
+                                        args.shard_dir)
+        else:
+            for json_filename in args.input_json:
+                getter.get_and_modify(json_filename)
+            getter.copy_top_level_catalog()
+
+    summary = LIMITER.summary()
+    if summary:
+        print(summary)
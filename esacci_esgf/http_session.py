@@ -0,0 +1,50 @@
+"""
+Shared configuration for HTTP requests made to ESGF services
+"""
+import requests
+from requests.adapters import HTTPAdapter
+# Use the copy of urllib3 bundled with requests for compatibility with older
+# versions of requests
+from requests.packages.urllib3.util.retry import Retry
+
+# Number of seconds to wait for a connection to be established, and for data
+# to be received
+DEFAULT_TIMEOUT = (10, 300)
+
+# Status codes that indicate a request is worth retrying
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+
+class TimeoutSession(requests.Session):
+    """
+    requests.Session subclass that applies a default timeout to all requests
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(*args, **kwargs)
+
+
+def make_session(retries=3, backoff_factor=1, timeout=DEFAULT_TIMEOUT,
+                 auth=None, pool_size=10):
+    """
+    Return a requests session that retries failed connections and requests
+    that fail with a server error, waiting for backoff_factor * (2 ** n)
+    seconds before the nth retry.
+
+    `pool_size' is the number of connections to each host to keep open, and
+    should be at least the number of threads that share the session
+    """
+    session = TimeoutSession(timeout=timeout)
+    session.auth = auth
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=RETRY_STATUS_CODES,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size,
+                          pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
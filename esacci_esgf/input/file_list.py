@@ -0,0 +1,190 @@
+"""
+Compact storage for the list of files in a dataset.
+
+Storing each file as a dictionary costs several hundred bytes of Python object
+overhead per file, which adds up for datasets containing millions of files.
+`FileList' stores the same information in typed arrays, and produces
+dictionaries of the form used in dataset JSON one at a time on iteration.
+"""
+import os
+from array import array
+from binascii import hexlify, unhexlify
+
+FIELDS = ("path", "size", "mtime", "sha256")
+
+# Length of a SHA-256 digest in bytes
+DIGEST_SIZE = 32
+
+# Range of sizes that fit in the sizes array
+MIN_SIZE = -2 ** 63
+MAX_SIZE = 2 ** 63 - 1
+
+
+class FileList(object):
+    """
+    List-like container of file records, where each record has a path, size,
+    mtime and SHA-256 checksum.
+
+    Directory names are interned in a table and referenced by index, base
+    names are stored in a single byte string, sizes and mtimes in typed arrays
+    and checksums as fixed-width binary digests. Values that cannot be stored
+    in this way without changing them (e.g. sizes given as strings, or
+    checksums that are not lower-case hex digests) are kept as they are.
+    """
+    def __init__(self, file_dicts=None):
+        self._dirs = []
+        self._dir_indices = {}
+        self._file_dirs = array("L")
+        self._names = bytearray()
+        self._name_offsets = array("Q", [0])
+        self._sizes = array("q")
+        self._mtimes = array("d")
+        # Whether each mtime was given as an int rather than a float
+        self._int_mtimes = bytearray()
+        self._checksums = bytearray()
+        # Map record index to a dictionary of values that could not be packed
+        self._extra = {}
+
+        if file_dicts is not None:
+            self.extend(file_dicts)
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def intern_dir(self, dirname):
+        """
+        Return the index of a directory name in the directory table, adding it
+        if necessary
+        """
+        try:
+            return self._dir_indices[dirname]
+        except KeyError:
+            index = len(self._dirs)
+            self._dirs.append(dirname)
+            self._dir_indices[dirname] = index
+            return index
+
+    def append(self, path, size, mtime, sha256):
+        dirname, basename = os.path.split(path)
+        self.append_split(dirname, basename, size, mtime, sha256)
+
+    def append_split(self, dirname, basename, size, mtime, sha256):
+        """
+        Append a record whose path has already been split into directory and
+        base name. `sha256' may be a hex string or a binary digest
+        """
+        index = len(self)
+        extra = {}
+
+        self._file_dirs.append(self.intern_dir(dirname))
+        self._names += basename.encode("utf-8", "surrogateescape")
+        self._name_offsets.append(len(self._names))
+
+        # Values are only packed if they come back unchanged, including their
+        # type, so that e.g. an mtime of 3 is not written out as 3.0
+        if type(size) is int and MIN_SIZE <= size <= MAX_SIZE:
+            self._sizes.append(size)
+        else:
+            self._sizes.append(0)
+            extra["size"] = size
+
+        if type(mtime) in (int, float) and float(mtime) == mtime:
+            self._mtimes.append(mtime)
+            self._int_mtimes.append(type(mtime) is int)
+        else:
+            self._mtimes.append(0)
+            self._int_mtimes.append(False)
+            extra["mtime"] = mtime
+
+        digest = None
+        if isinstance(sha256, bytes) and len(sha256) == DIGEST_SIZE:
+            digest = sha256
+        elif isinstance(sha256, str) and len(sha256) == DIGEST_SIZE * 2:
+            try:
+                digest = unhexlify(sha256)
+            except ValueError:
+                pass
+            # Only lower-case hex round-trips exactly
+            if digest is not None and hexlify(digest).decode() != sha256:
+                digest = None
+        if digest is None:
+            digest = bytes(DIGEST_SIZE)
+            extra["sha256"] = sha256
+        self._checksums += digest
+
+        if extra:
+            self._extra[index] = extra
+
+    def append_dict(self, file_dict, path_key="path"):
+        """
+        Append a record from a dictionary. `path_key' is the key under which
+        the path is stored (this is 'file' in CSV JSON)
+        """
+        try:
+            self.append(file_dict[path_key], file_dict["size"],
+                        file_dict["mtime"], file_dict["sha256"])
+        except KeyError as ex:
+            raise KeyError("Missing key for file: {}".format(ex))
+
+    def extend(self, file_dicts, path_key="path"):
+        for file_dict in file_dicts:
+            self.append_dict(file_dict, path_key=path_key)
+
+    def get_path(self, index):
+        start, end = self._name_offsets[index], self._name_offsets[index + 1]
+        basename = self._names[start:end].decode("utf-8", "surrogateescape")
+        return os.path.join(self._dirs[self._file_dirs[index]], basename)
+
+    def get_mtime(self, index):
+        mtime = self._mtimes[index]
+        return int(mtime) if self._int_mtimes[index] else mtime
+
+    def __getitem__(self, index):
+        """
+        Return the record at the given index as a dictionary
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("FileList index out of range")
+
+        offset = index * DIGEST_SIZE
+        digest = bytes(self._checksums[offset:offset + DIGEST_SIZE])
+        file_dict = {
+            "path": self.get_path(index),
+            "size": self._sizes[index],
+            "mtime": self.get_mtime(index),
+            "sha256": hexlify(digest).decode()
+        }
+        file_dict.update(self._extra.get(index, {}))
+        return file_dict
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(
+                a == b for a, b in zip(self, other)
+            )
+        except TypeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return "<FileList of {} files>".format(len(self))
+
+
+def json_default(obj):
+    """
+    Function to pass as `default' to json.dump() so that FileList objects can
+    be serialised
+    """
+    if isinstance(obj, FileList):
+        return list(obj)
+    raise TypeError("Object of type '{}' is not JSON serializable"
+                    .format(type(obj).__name__))
@@ -20,6 +20,8 @@ Create mapfiles for use with the ESGF publisher from a JSON file of the form
     ...
 }
 
+The input may also be a dataset manifest (see `manifest.py').
+
 Mapfiles are written to <output dir>/A/B/C/D/E/<dsid> where A.B.C.D.E are the
 leading elements of the dataset ID.
 
@@ -29,10 +31,11 @@ The paths of the output mapfiles are written on stdout.
 """
 import sys
 import argparse
-import json
 import os
 import re
 
+from esacci_esgf.input.manifest import load_datasets
+
 
 class MakeMapfile(object):
 
@@ -43,11 +46,7 @@ class MakeMapfile(object):
         self.out_root = out_root
 
     def parse_json(self, filename):
-        f = open(filename)
-        content = f.read()
-        j = json.loads(content)
-        f.close()
-        return j
+        return load_datasets(filename)
 
     def get_mapfile_path(self, dsid):
         path_els = [self.out_root] + dsid.split(".")[:self.depth] + [dsid]
@@ -77,24 +76,29 @@ class MakeMapfile(object):
         return " | ".join(parts) + "\n"
 
     def make_mapfile(self, dsid, file_dicts, tech_notes):
+        """
+        Write the mapfile for a dataset and return its path. `file_dicts' may
+        be a list of dictionaries or a FileList; lines are written as they are
+        generated so that the whole mapfile is never held in memory
+        """
         path = self.get_mapfile_path(dsid)
-        content = ""
         unversioned_dsid, version = self.split_versioned_dsid(dsid)
-        for i, file_dict in enumerate(file_dicts):
-            # Only include tech notes in the first line
-            tn = tech_notes if i == 0 else None
-            content += self.get_mapfile_line(unversioned_dsid, version,
-                                             file_dict, tn)
-        self.write_file(path, content)
-        print(path)
-
-    def write_file(self, path, content):
+        with self.open_file(path) as f:
+            for i, file_dict in enumerate(file_dicts):
+                # Only include tech notes in the first line
+                tn = tech_notes if i == 0 else None
+                f.write(self.get_mapfile_line(unversioned_dsid, version,
+                                              file_dict, tn))
+        return path
+
+    def open_file(self, path):
+        """
+        Open a file for writing, creating its parent directory if necessary
+        """
         parent = os.path.dirname(path)
         if not os.path.isdir(parent):
             os.makedirs(parent)
-        f = open(path, "w")
-        f.write(content)
-        f.close()
+        return open(path, "w")
 
     def split_versioned_dsid(self, dsid):
         """
@@ -112,7 +116,7 @@ class MakeMapfile(object):
         for dsid, ds_dict in j.items():
             tech_note = {"url": ds_dict["tech_note_url"],
                          "title": ds_dict["tech_note_title"]}
-            self.make_mapfile(dsid, ds_dict["files"], tech_note)
+            print(self.make_mapfile(dsid, ds_dict["files"], tech_note))
 
 
 def main():
@@ -122,7 +126,7 @@ def main():
     )
     parser.add_argument(
         "input_json",
-        help="JSON file to generate mapfile from"
+        help="JSON file or dataset manifest to generate mapfile from"
     )
     parser.add_argument(
         "output_dir",
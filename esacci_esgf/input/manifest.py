@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Convert between 'dataset JSON' and an indexed dataset manifest.
+
+A dataset manifest is an SQLite database containing the same information as
+dataset JSON (see `make_mapfiles.py'). Datasets can be looked up individually
+by ID without parsing the whole file, and files are stored as rows rather than
+as a list of dictionaries.
+
+All scripts that accept dataset JSON also accept a manifest.
+"""
+import sys
+import argparse
+import json
+import os
+import sqlite3
+from binascii import hexlify, unhexlify
+
+from esacci_esgf.input.file_list import FileList, DIGEST_SIZE
+
+# The first 16 bytes of every SQLite 3 database
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+# Files are stored compactly: directory names are stored once in their own
+# table, and checksums that are hex digests are stored as 32-byte blobs.
+# 'size', 'mtime' and 'sha256' are declared without a type so that values
+# which cannot be stored this way are kept exactly as they appear in the JSON
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE datasets (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    generate_aggregation INTEGER NOT NULL,
+    include_in_wms INTEGER NOT NULL,
+    tech_note_url TEXT,
+    tech_note_title TEXT
+);
+CREATE TABLE dirs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL
+);
+CREATE TABLE files (
+    dataset INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    dir INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    size,
+    mtime,
+    sha256,
+    PRIMARY KEY (dataset, position)
+) WITHOUT ROWID;
+PRAGMA user_version = {};
+""".format(SCHEMA_VERSION)
+
+
+def pack_checksum(sha256):
+    """
+    Return a checksum as a binary digest if it is a lower-case hex SHA-256
+    digest, or unchanged otherwise
+    """
+    if isinstance(sha256, str) and len(sha256) == DIGEST_SIZE * 2:
+        try:
+            digest = unhexlify(sha256)
+        except ValueError:
+            return sha256
+        if hexlify(digest).decode() == sha256:
+            return digest
+    return sha256
+
+
+class DatasetManifest(object):
+    """
+    Dictionary-like access to a dataset manifest. Keys are versioned dataset
+    IDs, and values are dictionaries in the dataset JSON format which are
+    loaded on demand.
+
+    Changes are committed when the manifest is closed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        # Cache of directory IDs for files added in this session
+        self.dir_ids = {}
+
+        (version,) = self.conn.execute("PRAGMA user_version").fetchone()
+        if version == 0 and not self.conn.execute(
+                "SELECT 1 FROM sqlite_master").fetchone():
+            self.conn.executescript(SCHEMA)
+        elif version != SCHEMA_VERSION:
+            self.conn.close()
+            raise ValueError(
+                "'{}' was written by a different version of esacci-esgf; "
+                "re-create it with convert_manifest".format(filename)
+            )
+
+    @classmethod
+    def is_manifest(cls, filename):
+        """
+        Return True if the given file is a dataset manifest rather than JSON
+        """
+        try:
+            with open(filename, "rb") as f:
+                return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+        except (IOError, OSError):
+            return False
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM datasets").fetchone()
+        return count
+
+    def __contains__(self, dsid):
+        cursor = self.conn.execute("SELECT 1 FROM datasets WHERE name = ?",
+                                   (dsid,))
+        return cursor.fetchone() is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        cursor = self.conn.execute("SELECT name FROM datasets ORDER BY id")
+        return [dsid for (dsid,) in cursor]
+
+    def items(self):
+        """
+        Yield (dataset ID, dataset dict) for each dataset in the order they
+        were added. Only one dataset is held in memory at a time
+        """
+        for dsid in self.keys():
+            yield dsid, self[dsid]
+
+    def get_files(self, dsid):
+        """
+        Return a FileList containing the files in a dataset
+        """
+        cursor = self.conn.execute(
+            "SELECT dirs.path, files.name, size, mtime, sha256 "
+            "FROM datasets JOIN files ON files.dataset = datasets.id "
+            "JOIN dirs ON dirs.id = files.dir "
+            "WHERE datasets.name = ? ORDER BY position", (dsid,)
+        )
+        files = FileList()
+        for row in cursor:
+            files.append_split(*row)
+        return files
+
+    def __getitem__(self, dsid):
+        row = self.conn.execute(
+            "SELECT generate_aggregation, include_in_wms, tech_note_url, "
+            "tech_note_title FROM datasets WHERE name = ?", (dsid,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(dsid)
+
+        return {
+            "generate_aggregation": bool(row[0]),
+            "include_in_wms": bool(row[1]),
+            "tech_note_url": row[2],
+            "tech_note_title": row[3],
+            "files": self.get_files(dsid)
+        }
+
+    def get_dir_id(self, dirname):
+        """
+        Return the ID of a directory name, adding it to the manifest if
+        necessary
+        """
+        try:
+            return self.dir_ids[dirname]
+        except KeyError:
+            pass
+        self.conn.execute("INSERT OR IGNORE INTO dirs (path) VALUES (?)",
+                          (dirname,))
+        (dir_id,) = self.conn.execute("SELECT id FROM dirs WHERE path = ?",
+                                      (dirname,)).fetchone()
+        self.dir_ids[dirname] = dir_id
+        return dir_id
+
+    def file_rows(self, ds_id, file_dicts):
+        """
+        Yield a row of the files table for each file in a dataset
+        """
+        for i, f in enumerate(file_dicts):
+            dirname, basename = os.path.split(f["path"])
+            yield (ds_id, i, self.get_dir_id(dirname), basename, f["size"],
+                   f["mtime"], pack_checksum(f["sha256"]))
+
+    def __setitem__(self, dsid, ds_dict):
+        if dsid in self:
+            del self[dsid]
+
+        cursor = self.conn.execute(
+            "INSERT INTO datasets (name, generate_aggregation, include_in_wms, "
+            "tech_note_url, tech_note_title) VALUES (?, ?, ?, ?, ?)",
+            (dsid, ds_dict["generate_aggregation"], ds_dict["include_in_wms"],
+             ds_dict["tech_note_url"], ds_dict["tech_note_title"])
+        )
+        try:
+            self.conn.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self.file_rows(cursor.lastrowid, ds_dict["files"])
+            )
+        except KeyError as ex:
+            raise KeyError("Missing key for dataset '{}': {}".format(dsid, ex))
+
+    def __delitem__(self, dsid):
+        row = self.conn.execute("SELECT id FROM datasets WHERE name = ?",
+                                (dsid,)).fetchone()
+        if row is None:
+            raise KeyError(dsid)
+        self.conn.execute("DELETE FROM files WHERE dataset = ?", row)
+        self.conn.execute("DELETE FROM datasets WHERE id = ?", row)
+
+
+class ManifestWriter(object):
+    """
+    Write datasets to a new manifest one at a time. This has the same
+    interface as merge_csv_json.JsonObjectWriter
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.manifest = None
+
+    def start(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.manifest = DatasetManifest(self.filename)
+
+    def write_item(self, key, value):
+        self.manifest[key] = value
+
+    def end(self):
+        self.manifest.close()
+
+
+def load_datasets(filename):
+    """
+    Load datasets from a file in either dataset JSON or manifest format.
+    Return a dictionary for JSON, or a DatasetManifest otherwise
+    """
+    if DatasetManifest.is_manifest(filename):
+        return DatasetManifest(filename)
+
+    with open(filename) as f:
+        return json.load(f)
+
+
+def json_to_manifest(json_filename, manifest_filename):
+    """
+    Convert a dataset JSON file to a new manifest
+    """
+    with open(json_filename) as f:
+        doc = json.load(f)
+
+    writer = ManifestWriter(manifest_filename)
+    writer.start()
+    for dsid, ds_dict in doc.items():
+        writer.write_item(dsid, ds_dict)
+    writer.end()
+
+
+def manifest_to_json(manifest_filename, out=None, compact=False):
+    """
+    Write the contents of a manifest to `out' (stdout by default) as dataset
+    JSON
+    """
+    from esacci_esgf.input.merge_csv_json import JsonObjectWriter
+
+    writer = JsonObjectWriter(out or sys.stdout, compact=compact)
+    writer.start()
+    with DatasetManifest(manifest_filename) as manifest:
+        for dsid, ds_dict in manifest.items():
+            writer.write_item(dsid, ds_dict)
+    writer.end()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    subparsers = parser.add_subparsers(
+        dest="mode",
+        metavar="MODE",
+        help="Conversion to perform"
+    )
+    subparsers.required = True
+
+    to_manifest = subparsers.add_parser(
+        "to-manifest",
+        help="Convert dataset JSON to a manifest"
+    )
+    to_manifest.add_argument(
+        "input_json",
+        help="Dataset JSON file to convert"
+    )
+    to_manifest.add_argument(
+        "output_manifest",
+        help="Path to write the manifest to. Any existing file is replaced"
+    )
+
+    to_json = subparsers.add_parser(
+        "to-json",
+        help="Convert a manifest to dataset JSON and print it to stdout"
+    )
+    to_json.add_argument(
+        "input_manifest",
+        help="Manifest to convert"
+    )
+    to_json.add_argument(
+        "--compact",
+        action="store_true",
+        default=False,
+        help="Write compact JSON with one dataset per line"
+    )
+
+    args = parser.parse_args(sys.argv[1:])
+    if args.mode == "to-manifest":
+        json_to_manifest(args.input_json, args.output_manifest)
+    elif args.mode == "to-json":
+        if not DatasetManifest.is_manifest(args.input_manifest):
+            parser.error("'{}' is not a dataset manifest"
+                         .format(args.input_manifest))
+        manifest_to_json(args.input_manifest, compact=args.compact)
@@ -11,7 +11,12 @@ ESGF DRS,No of files,Tech note URL,Tech note title,Aggregate,Include in WMS,JSON
 
 Booleans values should be `Yes' or `No'. Extraneous whitespace is ignored.
 
-The output is formatted as required by `make_mapfiles.py'.
+The output is formatted as required by `make_mapfiles.py'. Each dataset is
+written as soon as its row has been processed, so the whole document is never
+held in memory at once.
+
+Alternatively the output can be written to an indexed dataset manifest (see
+`manifest.py').
 """
 import sys
 import json
@@ -19,6 +24,9 @@ from csv import reader
 import argparse
 from collections import namedtuple
 
+from esacci_esgf.input.manifest import ManifestWriter
+from esacci_esgf.input.file_list import FileList, json_default
+
 HEADER_ROW = ["ESGF DRS", "No of files", "Tech note URL", "Tech note title",
               "Aggregate", "Include in WMS", "JSON file"]
 
@@ -70,7 +78,7 @@ class Dataset(namedtuple("Dataset", ["drs", "num_files", "tech_note_url",
             "include_in_wms": self.include_in_wms,
             "tech_note_url": self.tech_note_url,
             "tech_note_title": self.tech_note_title,
-            "files": []
+            "files": FileList()
         }
 
         with open(self.json_filename) as json_file:
@@ -82,19 +90,58 @@ class Dataset(namedtuple("Dataset", ["drs", "num_files", "tech_note_url",
             raise KeyError("Dataset '{}' not found in JSON file '{}'"
                            .format(self.drs, self.json_filename))
 
-        for file_dict in ds_info:
-            # Rename 'file' to 'path'...
-            file_dict["path"] = file_dict["file"]
-            del file_dict["file"]
-            output["files"].append(file_dict)
+        # Note that the path is under 'file' in the CSV JSON, but under 'path'
+        # in the output
+        try:
+            output["files"].extend(ds_info, path_key="file")
+        except KeyError as ex:
+            raise KeyError("Dataset '{}' in JSON file '{}': {}"
+                           .format(self.drs, self.json_filename, ex))
 
         return output
 
 
-def parse_file(csv_filename):
+class JsonObjectWriter(object):
     """
-    Parse a CSV file and construct JSON output, and print the JSON output to
-    stdout
+    Write a JSON object to a stream one key at a time, so that the values do
+    not all need to be in memory at once
+    """
+    def __init__(self, stream, compact=False):
+        self.stream = stream
+        self.compact = compact
+        self.count = 0
+
+    def start(self):
+        self.stream.write("{")
+
+    def write_item(self, key, value):
+        """
+        Serialise `value' and write it under `key'. Each item is written on
+        its own line in compact mode, or indented with 4 spaces otherwise
+        """
+        sep = "," if self.count else ""
+        if self.compact:
+            value_str = json.dumps(value, separators=(",", ":"),
+                                   default=json_default)
+            self.stream.write("{}\n{}:{}".format(sep, json.dumps(key),
+                                                 value_str))
+        else:
+            value_str = json.dumps(value, indent=4, default=json_default)
+            value_str = value_str.replace("\n", "\n    ")
+            self.stream.write("{}\n    {}: {}".format(sep, json.dumps(key),
+                                                     value_str))
+        self.count += 1
+
+    def end(self):
+        self.stream.write("\n}" if self.count else "}")
+        self.stream.write("\n")
+        self.stream.flush()
+
+
+def iter_rows(csv_filename):
+    """
+    Parse a CSV file and yield a Dataset for each row. Data files are not
+    read until Dataset.get_dict() is called
     """
     with open(csv_filename) as csv_file:
         r = reader(csv_file)
@@ -103,11 +150,51 @@ def parse_file(csv_filename):
             raise ValueError("Incorrect header row in '{}' - see {} --help"
                              .format(csv_filename, sys.argv[0]))
 
-        output = {}
+        seen = set([])
         for values in r:
             ds = Dataset.from_strings(values)
-            output[ds.drs] = ds.get_dict()
-        json.dump(output, sys.stdout, indent=4)
+            # Datasets cannot be overwritten once written, so duplicates must
+            # be treated as an error
+            if ds.drs in seen:
+                raise ValueError("Duplicate dataset '{}' in '{}'"
+                                 .format(ds.drs, csv_filename))
+            seen.add(ds.drs)
+            yield ds
+
+
+def iter_datasets(csv_filename):
+    """
+    Parse a CSV file and yield (dataset ID, dictionary in dataset JSON format)
+    for each row
+    """
+    for ds in iter_rows(csv_filename):
+        yield ds.drs, ds.get_dict()
+
+
+def parse_file(csv_filename, out=None, compact=False, manifest=None):
+    """
+    Parse a CSV file and construct JSON output, and write the JSON output to
+    `out' (stdout by default). Each dataset is written as soon as its row has
+    been processed.
+
+    If `manifest' is given, write a dataset manifest at that path instead of
+    JSON.
+    """
+    datasets = iter_datasets(csv_filename)
+    # Read the header row before starting the output, so that nothing is
+    # written for an invalid file
+    first = next(datasets, None)
+
+    if manifest is not None:
+        writer = ManifestWriter(manifest)
+    else:
+        writer = JsonObjectWriter(out or sys.stdout, compact=compact)
+    writer.start()
+    if first is not None:
+        writer.write_item(*first)
+        for dsid, ds_dict in datasets:
+            writer.write_item(dsid, ds_dict)
+    writer.end()
 
 
 def main():
@@ -119,5 +206,17 @@ def main():
         "input_csv",
         help="CSV file to parse"
     )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        default=False,
+        help="Write compact JSON with one dataset per line instead of "
+             "indenting the output"
+    )
+    parser.add_argument(
+        "--manifest",
+        help="Write a dataset manifest to the given path instead of printing "
+             "JSON"
+    )
     args = parser.parse_args(sys.argv[1:])
-    parse_file(args.input_csv)
+    parse_file(args.input_csv, compact=args.compact, manifest=args.manifest)
@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 """
-Parse an ESGF ini config file and extract a value
+Parse an ESGF ini config file and extract one or more values.
+
+With --export, values are printed as shell `export' statements so that several
+values can be set in one go; e.g.
+
+    eval "$(parse_esg_ini esg.ini --export HOST=thredds_host)"
 """
+import os
+import re
 import sys
 import argparse
 import configparser
+import shlex
 from urllib.parse import urlparse
 
 
@@ -21,16 +29,48 @@ class EsgIniParser(object):
         """
         return urlparse(url).netloc
 
+    # Map path of ini file to (mtime, ConfigParser object) so that each file
+    # is only parsed once unless it changes
+    _config_cache = {}
+
+    @classmethod
+    def get_config(cls, esg_ini):
+        """
+        Return a ConfigParser object for the given ini file
+        """
+        path = os.path.abspath(esg_ini)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+
+        try:
+            cached_mtime, config = cls._config_cache[path]
+            if cached_mtime == mtime:
+                return config
+        except KeyError:
+            pass
+
+        config = configparser.ConfigParser()
+        config.read(path)
+        cls._config_cache[path] = (mtime, config)
+        return config
+
     @classmethod
     def get_value(cls, esg_ini, key):
         """
         Read the ini file and extract the required value. 'key' should be a key
         in VALUES_MAPPING
         """
-        config = configparser.ConfigParser()
-        config.read(esg_ini)
         func = VALUES_MAPPING[key]
-        return func(config)
+        return func(cls.get_config(esg_ini))
+
+    @classmethod
+    def get_values(cls, esg_ini, keys):
+        """
+        Return a dictionary mapping each key in `keys' to its value
+        """
+        return {key: cls.get_value(esg_ini, key) for key in keys}
 
     @classmethod
     def get_solr_hostname(cls, config):
@@ -100,6 +140,27 @@ VALUES_MAPPING = {
 }
 
 
+def export_spec(spec):
+    """
+    Parse a string of the form NAME=KEY as given to --export, and return
+    (NAME, KEY)
+    """
+    try:
+        name, key = spec.split("=", 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{}' is not of the form NAME=KEY"
+                                         .format(spec))
+    if not re.match("^[A-Za-z_][A-Za-z0-9_]*$", name):
+        raise argparse.ArgumentTypeError("invalid variable name '{}'"
+                                         .format(name))
+    if key not in VALUES_MAPPING:
+        raise argparse.ArgumentTypeError(
+            "invalid key '{}' (choose from {})"
+            .format(key, ", ".join(sorted(VALUES_MAPPING.keys())))
+        )
+    return name, key
+
+
 def main():
     parser = argparse.ArgumentParser(
         description=__doc__,
@@ -112,10 +173,38 @@ def main():
     )
 
     parser.add_argument(
-        "key",
-        choices=VALUES_MAPPING.keys(),
-        help="Value to extract from esg.ini"
+        "keys",
+        nargs="*",
+        metavar="key",
+        help="Value(s) to extract from esg.ini. Values are printed one per "
+             "line. Choose from: {}".format(", ".join(sorted(VALUES_MAPPING)))
+    )
+
+    parser.add_argument(
+        "-x", "--export",
+        dest="exports",
+        default=[],
+        action="append",
+        type=export_spec,
+        metavar="NAME=KEY",
+        help="Print a shell statement that exports the value for KEY as "
+             "the variable NAME. Can be given multiple times"
     )
 
     args = parser.parse_args(sys.argv[1:])
-    print(EsgIniParser.get_value(args.esg_ini, args.key))
+    for key in args.keys:
+        if key not in VALUES_MAPPING:
+            parser.error("invalid key '{}' (choose from {})"
+                         .format(key, ", ".join(sorted(VALUES_MAPPING))))
+    if not args.keys and not args.exports:
+        parser.error("No keys given")
+
+    # Get all values before printing anything, so that nothing is printed if
+    # any value is missing
+    values = EsgIniParser.get_values(
+        args.esg_ini, args.keys + [key for _, key in args.exports]
+    )
+    for key in args.keys:
+        print(values[key])
+    for name, key in args.exports:
+        print("export {}={}".format(name, shlex.quote(values[key])))
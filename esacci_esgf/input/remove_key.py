@@ -1,12 +1,29 @@
 #!/usr/bin/env python3
 """
-Remove a key from the top level of a JSON dictionary, and print the new
-dictionary to stdout.
+Remove one or more keys from the top level of a JSON dictionary, and print the
+new dictionary to stdout.
+
+If the file is a dataset manifest (see `manifest.py') then the datasets are
+removed from the manifest in place and nothing is printed.
 """
 import sys
 import argparse
 import json
 
+from esacci_esgf.input.manifest import DatasetManifest
+
+
+def remove_keys(doc, keys):
+    """
+    Remove keys from a dictionary-like object. Raises KeyError if any key is
+    not present, in which case no keys are removed
+    """
+    missing = [key for key in keys if key not in doc]
+    if missing:
+        raise KeyError("Keys not found: {}".format(", ".join(missing)))
+    for key in set(keys):
+        del doc[key]
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -14,16 +31,38 @@ def main():
         formatter_class=argparse.RawDescriptionHelpFormatter
     )
     parser.add_argument(
-        "key",
-        help="Key to remove from the JSON file"
+        "keys",
+        nargs="*",
+        metavar="key",
+        help="Key(s) to remove from the JSON file"
     )
     parser.add_argument(
         "file",
+        help="Path to JSON file or dataset manifest ('-' to read JSON from "
+             "stdin)"
+    )
+    parser.add_argument(
+        "-f", "--keys-from",
         type=argparse.FileType("r"),
-        help="Path to JSON file"
+        help="File containing keys to remove, one per line"
     )
 
     args = parser.parse_args(sys.argv[1:])
-    doc = json.load(args.file)
-    del doc[args.key]
+    keys = list(args.keys)
+    if args.keys_from:
+        keys += filter(None, map(str.strip, args.keys_from))
+    if not keys:
+        parser.error("No keys given")
+
+    if DatasetManifest.is_manifest(args.file):
+        with DatasetManifest(args.file) as manifest:
+            remove_keys(manifest, keys)
+        return
+
+    if args.file == "-":
+        doc = json.load(sys.stdin)
+    else:
+        with open(args.file) as f:
+            doc = json.load(f)
+    remove_keys(doc, keys)
     json.dump(doc, sys.stdout)
@@ -0,0 +1,141 @@
+"""
+Record the stages of publication that have been completed for each dataset,
+so that an interrupted run can be resumed without repeating work.
+
+The journal is an SQLite database. Each completed stage is stored with a hash
+of its inputs, and only counts as done if the hash still matches. A change to
+a dataset, or to the files produced for it by an earlier stage, therefore
+causes the work to be repeated.
+"""
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+
+from esacci_esgf.input.file_list import FileList
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    dataset_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    input_hash TEXT NOT NULL,
+    completed REAL NOT NULL,
+    PRIMARY KEY (dataset_id, stage)
+) WITHOUT ROWID;
+"""
+
+
+SEPARATORS = (",", ":")
+
+
+def update_hash(h, value):
+    """
+    Feed the compact JSON serialisation of `value' (with sorted keys) to the
+    hash object `h' piece by piece. FileList objects are serialised one file
+    at a time, so that the JSON for a whole dataset is never built in memory
+    """
+    if isinstance(value, FileList):
+        h.update(b"[")
+        for i, file_dict in enumerate(value):
+            if i:
+                h.update(b",")
+            h.update(json.dumps(file_dict, sort_keys=True,
+                                separators=SEPARATORS).encode("utf-8"))
+        h.update(b"]")
+    elif isinstance(value, dict):
+        h.update(b"{")
+        for i, key in enumerate(sorted(value)):
+            if i:
+                h.update(b",")
+            h.update(json.dumps(str(key)).encode("utf-8") + b":")
+            update_hash(h, value[key])
+        h.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        h.update(b"[")
+        for i, item in enumerate(value):
+            if i:
+                h.update(b",")
+            update_hash(h, item)
+        h.update(b"]")
+    else:
+        h.update(json.dumps(value).encode("utf-8"))
+
+
+def hash_inputs(*values):
+    """
+    Return the hex SHA-256 checksum of one or more JSON-serialisable values
+    (which may contain FileList objects)
+    """
+    h = hashlib.sha256()
+    for value in values:
+        update_hash(h, value)
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class StageJournal(object):
+    """
+    Journal of completed stages for each dataset. `stages' lists the names of
+    stages in the order they are carried out. The journal may be used from
+    several threads at once
+    """
+    def __init__(self, filename, stages):
+        self.filename = filename
+        self.stages = list(stages)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def is_done(self, dsid, stage, input_hash):
+        """
+        Return True if a stage has been completed for a dataset with the given
+        inputs
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT input_hash FROM stages WHERE dataset_id = ? AND "
+                "stage = ?", (dsid, stage)
+            ).fetchone()
+        return row is not None and row[0] == input_hash
+
+    def mark_done(self, dsid, stage, input_hash, forget_later=True):
+        """
+        Record that a stage has been completed for a dataset. The change is
+        committed immediately, so that it survives the process being killed.
+
+        If `forget_later' is True, records for later stages of the dataset
+        are removed, since their work is based on the output of this stage and
+        must be repeated
+        """
+        later = []
+        if forget_later:
+            later = self.stages[self.stages.index(stage) + 1:]
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?)",
+                (dsid, stage, input_hash, time.time())
+            )
+            self.conn.executemany(
+                "DELETE FROM stages WHERE dataset_id = ? AND stage = ?",
+                [(dsid, s) for s in later]
+            )
+
+    def completed(self, dsid):
+        """
+        Return the stages recorded as completed for a dataset, in order
+        """
+        with self.lock:
+            done = set(row[0] for row in self.conn.execute(
+                "SELECT stage FROM stages WHERE dataset_id = ?", (dsid,)
+            ))
+        return [stage for stage in self.stages if stage in done]
@@ -13,12 +13,13 @@ from collections import namedtuple
 
 from cached_property import cached_property
 
-from tds_utils.partition_files import partition_files
-from tds_utils.aggregation import AggregationError, CoordinatesError
-
+from esacci_esgf.aggregation.throttle import (LIMITER, add_limit_arguments,
+                                              configure_limiter)
 from esacci_esgf.input.parse_esg_ini import EsgIniParser
-from esacci_esgf.aggregation.base import CCIAggregationCreator
-from esacci_esgf.aggregation.aerosol import CCIAerosolAggregationCreator
+from esacci_esgf.shards import parse_shard, assign_shards
+
+# Note that tds_utils and the aggregation classes (which require netCDF4) are
+# only imported when aggregations are created, since they are slow to import
 
 
 def get_thredds_url(host, in_file):
@@ -126,6 +127,34 @@ class ThreddsXMLBase(object):
         parent.append(child)
         return child
 
+    def iter_ncml_locations(self, filename):
+        """
+        Parse a catalog incrementally and yield the location of each 'netcdf'
+        element. Elements are discarded once parsed so that the whole tree is
+        never held in memory
+        """
+        for _, element in ET.iterparse(filename, events=("end",)):
+            # Match on local name only, since 'netcdf' elements are in the
+            # NcML namespace rather than the THREDDS one
+            if element.tag.rsplit("}", 1)[-1] == "netcdf":
+                location = element.get("location")
+                if location is not None:
+                    yield location
+            element.clear()
+
+    def count_files(self, filename):
+        """
+        Parse a catalog incrementally and return the number of datasets
+        served over HTTP (i.e. the number of files in the dataset)
+        """
+        count = 0
+        for _, element in ET.iterparse(filename, events=("end",)):
+            if (element.tag == self.tag_full_name("dataset") and
+                    element.get("serviceName") == "HTTPServer"):
+                count += 1
+            element.clear()
+        return count
+
 
 class ThreddsXMLDataset(ThreddsXMLBase):
     """
@@ -241,6 +270,9 @@ class ThreddsXMLDataset(ThreddsXMLBase):
         Return a subclass of CCIAggregationCreator used to create the NcML
         aggregation
         """
+        from esacci_esgf.aggregation.base import CCIAggregationCreator
+        from esacci_esgf.aggregation.aerosol import CCIAerosolAggregationCreator
+
         return (CCIAerosolAggregationCreator if "AEROSOL" in self.dataset_id
                 else CCIAggregationCreator)
 
@@ -251,6 +283,9 @@ class ThreddsXMLDataset(ThreddsXMLBase):
 
         The NcML document and related info is saved in self.aggregation
         """
+        from tds_utils.partition_files import partition_files
+        from tds_utils.aggregation import AggregationError, CoordinatesError
+
         # Get directory to store aggregation in by splitting file name into
         # its facets and having a subdirectory for each component.
         components = os.path.basename(self.in_filename).split(".")
@@ -414,14 +449,45 @@ class ProcessBatch(object):
                  "dataset root can be translated to give the real path on "
                  "disk [default: %(default)s]"
         )
+        parser.add_argument(
+            "--shard",
+            type=parse_shard,
+            metavar="i/N",
+            help="Only process the i-th of N shards of the input catalogs "
+                 "(numbered from 0). Catalogs are split between shards by "
+                 "number of files, so every shard must be given the same "
+                 "catalogs"
+        )
+        add_limit_arguments(parser)
 
         self.args = parser.parse_args(arg_list)
+        configure_limiter(parser, self.args)
 
         if self.args.wms and not self.args.aggregate:
             parser.error("Cannot add WMS/WCS aggregations without --aggregate")
 
+    def shard_catalogs(self):
+        """
+        Return the input catalogs to process: all of them, or those in this
+        process's shard if --shard was given
+        """
+        if not self.args.shard:
+            return self.args.catalogs
+        index, count = self.args.shard
+        parser = ThreddsXMLBase()
+        sizes = []
+        for fn in set(self.args.catalogs):
+            try:
+                sizes.append((parser.count_files(fn), fn))
+            except (OSError, ET.ParseError):
+                # Let process_file() report the error in whichever shard
+                # the catalog ends up in
+                sizes.append((0, fn))
+        shard = set(assign_shards(sizes, count)[index])
+        return [fn for fn in self.args.catalogs if fn in shard]
+
     def do_all(self):
-        for fn in self.args.catalogs:
+        for fn in self.shard_catalogs():
             try:
                 print(fn)
                 self.process_file(fn)
@@ -451,3 +517,6 @@ class ProcessBatch(object):
 def main():
     pb = ProcessBatch(sys.argv[1:])
     pb.do_all()
+    summary = LIMITER.summary()
+    if summary:
+        print(summary)
@@ -3,48 +3,333 @@
 Script that modifies the WMS, WCS and OpenDAP links in Solr.
 """
 import sys
-import os
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import pysolr
 
+from esacci_esgf.http_session import make_session
+from esacci_esgf.input.manifest import load_datasets
+
 DEFAULT_SOLR_NODE = "http://cci-odp-index.ceda.ac.uk:8984"
 
+# Fields to retrieve from Solr. Since documents are updated with atomic
+# updates, only the fields that are changed are needed
+FIELDS = ("id", "url")
+
+CORES = ("datasets", "files")
+
+# Number of datasets to fix links for in each job when updating specific
+# datasets
+DATASETS_PER_JOB = 100
+
+# Filter query matching documents with at least one entry in 'url' that
+# update_urls() would change. Entries are of the form 'URL|MIME type|service'
+# and the regular expressions must match a whole entry. Note that '/' has to
+# be escaped since it delimits regular expressions in Solr queries
+NEEDS_UPDATE_QUERY = "url:({})".format(" OR ".join([
+    # WMS/WCS endpoints without query parameters
+    r"/[^?|]*\|[^|]*\|WMS/",
+    r"/[^?|]*\|[^|]*\|WCS/",
+    # OPeNDAP endpoints ending in .html or with the HTML MIME type
+    r"/.*\.html\|[^|]*\|OPENDAP/",
+    r"/.*\|application\/opendap-html\|OPENDAP/",
+]))
 
-def solr_update_doc(s, doc, func):
+
+class SolrUpdater(object):
     """
-    Given a document from Solr, call the specified function
-    (which should return a dictionary of field updates), and then update
-    Solr if the dictionary is not empty.
+    Class to apply a function to documents from Solr and send any changes back
+    to Solr in batches.
+
+    The function should modify the document in place and return True if it
+    changed anything. Changed fields are sent as atomic updates, so fields that
+    were not retrieved from Solr are preserved. Changes are committed once, by
+    finish(), unless `commit_within' (milliseconds) is given, in which case
+    Solr is left to commit within that time of each batch
     """
-    doc_id = doc["id"]
+    # Number of example changes to keep in dry-run mode
+    MAX_SAMPLES = 10
 
-    updated = func(doc)
+    def __init__(self, s, func, fields=("url",), batch_size=500,
+                 commit_within=None, verbose=False, dry_run=False):
+        self.s = s
+        self.func = func
+        self.fields = fields
+        self.batch_size = batch_size
+        self.commit_within = commit_within
+        self.verbose = verbose
+        # In dry-run mode no changes are sent to Solr, and a sample of the
+        # changes that would have been made is kept as a list of
+        # (document ID, field, old value, new value)
+        self.dry_run = dry_run
+        self.samples = []
+        self.batch = []
+        self.updated = 0
+        self.unchanged = 0
+        self.start_time = time.time()
 
-    # if it is actually any different from before, then
-    # update it in Solr
-    if updated:
-        print("updating:", doc_id)
-        s.add([doc])
-    else:
-        print("unchanged:", doc_id)
+    def process(self, doc):
+        before = None
+        if self.dry_run and len(self.samples) < self.MAX_SAMPLES:
+            before = {field: list(doc[field]) for field in self.fields}
+
+        if self.func(doc):
+            if self.verbose:
+                print("updating:", doc["id"])
+            if before is not None:
+                self.add_samples(doc, before)
+            update = {"id": doc["id"]}
+            update.update((field, doc[field]) for field in self.fields)
+            self.batch.append(update)
+            self.updated += 1
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+        else:
+            if self.verbose:
+                print("unchanged:", doc["id"])
+            self.unchanged += 1
+
+    def add_samples(self, doc, before):
+        for field in self.fields:
+            for old, new in zip(before[field], doc[field]):
+                if old != new and len(self.samples) < self.MAX_SAMPLES:
+                    self.samples.append((doc["id"], field, old, new))
+
+    def flush(self):
+        """
+        Send the current batch of updates to Solr
+        """
+        if not self.batch:
+            return
+        if self.dry_run:
+            self.batch = []
+            return
+        kwargs = {"commit": False}
+        if self.commit_within is not None:
+            kwargs["commitWithin"] = self.commit_within
+        self.s.add(self.batch,
+                   fieldUpdates={field: "set" for field in self.fields},
+                   **kwargs)
+        self.batch = []
+
+    def finish(self, commit=True):
+        """
+        Send any remaining updates and commit them (if `commit' is True)
+        """
+        self.flush()
+        if commit and self.commit_within is None and self.updated and \
+                not self.dry_run:
+            self.s.commit()
 
+    def add_counts(self, other):
+        """
+        Add the counts from another SolrUpdater to this one
+        """
+        self.updated += other.updated
+        self.unchanged += other.unchanged
+        space = self.MAX_SAMPLES - len(self.samples)
+        self.samples += other.samples[:max(space, 0)]
 
-def query_all(s, query="*.*", chunk=1000):
+    def summary(self):
+        seconds = time.time() - self.start_time
+        total = self.updated + self.unchanged
+        rate = total / seconds if seconds else 0
+        lines = ["{} {}, {} unchanged in {:.2f} s ({:.1f} documents/s)".format(
+            self.updated, "to update" if self.dry_run else "updated",
+            self.unchanged, seconds, rate
+        )]
+        for doc_id, field, old, new in self.samples:
+            lines += ["  {} ({}):".format(doc_id, field),
+                      "    - {}".format(old),
+                      "    + {}".format(new)]
+        return "\n".join(lines)
+
+
+def update_all(s, docs, func, commit=True, **kwargs):
     """
-    Get a list of documents from Solr all into memory, querying in
-    chunks of 1000.  Each one will be a dictionary.
+    Apply `func' to each document in `docs' and update Solr with the changes.
+    Keyword arguments are passed to SolrUpdater. Return the SolrUpdater used
     """
-    results = []
-    start = 0
+    updater = SolrUpdater(s, func, **kwargs)
+    for doc in docs:
+        updater.process(doc)
+    updater.finish(commit=commit)
+    return updater
+
+
+def query_all(s, query="*:*", chunk=1000, fields=FIELDS, filter_query=None,
+              verbose=False, report_count=True):
+    """
+    Generator to yield each document matching a query (and optional filter
+    query, or list of filter queries) from Solr, as a dictionary containing
+    the given fields.
+
+    Documents are retrieved in pages of `chunk' documents using a cursor, so
+    that the cost of each page does not depend on how far through the results
+    it is. The time taken for each page is printed if `verbose' is True, and
+    the number of documents found at the end if `report_count' is True
+    """
+    cursor = "*"
+    count = 0
+    kwargs = {}
+    if filter_query is not None:
+        kwargs["fq"] = filter_query
     while True:
-        print("querying from %s" % start)
-        resp = s.search(query, start=start, rows=chunk)
-        these_results = resp.docs
-        if not these_results:
-            print("%s results found" % len(results))
-            return results
-        results.extend(these_results)
-        start += chunk
+        start = time.time()
+        resp = s.search(query, rows=chunk, sort="id asc", cursorMark=cursor,
+                        fl=",".join(fields), **kwargs)
+        count += len(resp.docs)
+        if verbose:
+            print("fetched %s results in %.2f s" % (len(resp.docs),
+                                                    time.time() - start))
+        for doc in resp.docs:
+            yield doc
+
+        # The cursor stays the same once all results have been returned, but
+        # a short page also means there are no more results
+        if len(resp.docs) < chunk or resp.nextCursorMark in (None, cursor):
+            if report_count:
+                print("%s results found" % count)
+            return
+        cursor = resp.nextCursorMark
+
+
+def quote_value(value):
+    """
+    Return a value quoted for use in a Solr query
+    """
+    return '"{}"'.format(value.replace("\\", "\\\\").replace('"', '\\"'))
+
+
+def query_by_values(s, field, values, batch_size=100, filter_query=None,
+                    **kwargs):
+    """
+    Generator to yield documents where `field' has one of the given values
+    (and that match `filter_query', if given). Values are looked up
+    `batch_size' at a time using a filter query, and other keyword arguments
+    are passed to query_all(). The total number of documents found is printed
+    at the end
+    """
+    values = list(values)
+    count = 0
+    for i in range(0, len(values), batch_size):
+        batch = values[i:i + batch_size]
+        values_query = " OR ".join(map(quote_value, batch))
+        filter_queries = ["{}:({})".format(field, values_query)]
+        if filter_query is not None:
+            filter_queries.append(filter_query)
+        for doc in query_all(s, filter_query=filter_queries,
+                             report_count=False, **kwargs):
+            count += 1
+            yield doc
+    print("%s results found" % count)
+
+
+def query_datasets_and_files(datasets_solr, files_solr, ds_names,
+                             prefilter=False, **kwargs):
+    """
+    Generator to yield (Solr instance, document) for the dataset documents
+    for the given versioned dataset names, followed by the file documents in
+    those datasets. If `prefilter' is True, only file documents that need
+    updating are returned. Keyword arguments are passed to query_by_values()
+    """
+    dataset_ids = []
+    for doc in query_by_values(datasets_solr, "instance_id", ds_names,
+                               **kwargs):
+        dataset_ids.append(doc["id"])
+        yield datasets_solr, doc
+
+    # The 'dataset_id' field in file documents is the ID of the dataset
+    # document, which includes the data node as well as the dataset name
+    filter_query = NEEDS_UPDATE_QUERY if prefilter else None
+    for doc in query_by_values(files_solr, "dataset_id", dataset_ids,
+                               filter_query=filter_query, **kwargs):
+        yield files_solr, doc
+
+
+def fix_core(core, s, prefilter=False, query="esacci", **kwargs):
+    """
+    Fix links in all documents matching a query in one Solr core. If
+    `prefilter' is True, only documents that need updating are retrieved.
+    Return a list of (core name, SolrUpdater)
+    """
+    filter_query = NEEDS_UPDATE_QUERY if prefilter else None
+    docs = query_all(s, query=query, filter_query=filter_query,
+                     verbose=kwargs.get("verbose", False))
+    return [(core, update_all(s, docs, update_urls, commit=False, **kwargs))]
+
+
+def fix_datasets(datasets_solr, files_solr, ds_names, prefilter=False,
+                 **kwargs):
+    """
+    Fix links in the dataset and file documents for the given datasets.
+    Return a list of (core name, SolrUpdater)
+    """
+    updaters = {
+        datasets_solr: SolrUpdater(datasets_solr, update_urls, **kwargs),
+        files_solr: SolrUpdater(files_solr, update_urls, **kwargs)
+    }
+    docs = query_datasets_and_files(datasets_solr, files_solr, ds_names,
+                                    prefilter=prefilter,
+                                    verbose=kwargs.get("verbose", False))
+    for solr, doc in docs:
+        updaters[solr].process(doc)
+    for updater in updaters.values():
+        updater.finish(commit=False)
+    return [("datasets", updaters[datasets_solr]),
+            ("files", updaters[files_solr])]
+
+
+def run_jobs(jobs, solrs, concurrency=2, **kwargs):
+    """
+    Run jobs that fix links using up to `concurrency' threads. Each job is a
+    tuple (func, args) where func is fix_core or fix_datasets, and is called
+    with `args' and the keyword arguments given here.
+
+    `solrs' is a dictionary mapping core name to Solr instance. Each core is
+    committed once all jobs have finished. Return a dictionary mapping core
+    name to a SolrUpdater containing the total counts
+    """
+    totals = {core: SolrUpdater(s, update_urls, **kwargs)
+              for core, s in solrs.items()}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(func, *args, **kwargs)
+                   for func, args in jobs]
+        for future in futures:
+            for core, updater in future.result():
+                totals[core].add_counts(updater)
+
+    for total in totals.values():
+        total.finish()
+    return totals
+
+
+def make_solrs(solr_node, concurrency=2):
+    """
+    Return a dictionary mapping core name to a Solr instance for each core on
+    the given node
+    """
+    solr_node = solr_node.rstrip("/")
+    # Share a single session, so that connections are kept alive and reused
+    # across threads
+    session = make_session(pool_size=concurrency)
+    solrs = {}
+    for core in CORES:
+        solrs[core] = pysolr.Solr("{}/solr/{}".format(solr_node, core))
+        solrs[core].session = session
+    return solrs
+
+
+def dataset_jobs(solrs, ds_names, prefilter=True):
+    """
+    Return a list of jobs for run_jobs() that fix links for the given
+    datasets, in batches of DATASETS_PER_JOB
+    """
+    return [(fix_datasets, (solrs["datasets"], solrs["files"],
+                            ds_names[i:i + DATASETS_PER_JOB], prefilter))
+            for i in range(0, len(ds_names), DATASETS_PER_JOB)]
 
 
 def update_urls(doc):
@@ -81,29 +366,101 @@ def update_urls(doc):
     return changed
 
 
-def usage():
-    prog = os.path.basename(sys.argv[0])
-    print("""Usage: %s [SOLR NODE]
-
-Modify Solr documents to correct WMS, WCS and OpenDAP endpoints for
-aggregate datasets
+def main():
+    parser = argparse.ArgumentParser(
+        description="Modify Solr documents to correct WMS, WCS and OpenDAP "
+                    "endpoints for aggregate datasets"
+    )
+    parser.add_argument(
+        "solr_node",
+        nargs="?",
+        default=DEFAULT_SOLR_NODE,
+        help="Base URL of Solr node [default: %(default)s]"
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        default=False,
+        help="Print the ID of each document and whether it was updated"
+    )
+    parser.add_argument(
+        "--dataset-json",
+        help="Only update documents for the datasets in this dataset JSON "
+             "file or manifest, and the files in those datasets"
+    )
+    parser.add_argument(
+        "-d", "--dataset",
+        dest="datasets",
+        default=[],
+        action="append",
+        metavar="DATASET_NAME",
+        help="Only update documents for this versioned dataset name, and the "
+             "files in the dataset. Can be given multiple times"
+    )
+    parser.add_argument(
+        "-c", "--core",
+        dest="cores",
+        action="append",
+        choices=CORES,
+        help="Solr core to update when not using --dataset-json or -d. Can be "
+             "given multiple times [default: all cores]"
+    )
+    parser.add_argument(
+        "-j", "--concurrency",
+        type=int,
+        default=2,
+        help="Maximum number of requests to make to Solr at once "
+             "[default: %(default)s]"
+    )
+    parser.add_argument(
+        "--no-prefilter",
+        dest="prefilter",
+        action="store_false",
+        default=True,
+        help="Retrieve all documents and check them locally, instead of "
+             "asking Solr for only the documents that need updating"
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        default=False,
+        help="Do not update Solr, but print the number of documents that "
+             "would be updated and a sample of the changes"
+    )
+    parser.add_argument(
+        "-b", "--batch-size",
+        type=int,
+        default=500,
+        help="Number of updated documents to send to Solr at once "
+             "[default: %(default)s]"
+    )
+    parser.add_argument(
+        "--commit-within",
+        type=int,
+        metavar="MS",
+        help="Ask Solr to commit each batch within this many milliseconds, "
+             "instead of committing once at the end"
+    )
+    args = parser.parse_args(sys.argv[1:])
 
-SOLR NODE defaults to %s""" % (prog, DEFAULT_SOLR_NODE))
+    ds_names = list(args.datasets)
+    if args.dataset_json:
+        ds_names += list(load_datasets(args.dataset_json).keys())
 
+    solrs = make_solrs(args.solr_node, concurrency=args.concurrency)
 
-def main():
-    solr_node = DEFAULT_SOLR_NODE
-    if len(sys.argv) > 1:
-        if sys.argv[1] in ("-h", "--help"):
-            usage()
-            sys.exit(0)
-        else:
-            solr_node = sys.argv[1]
-
-    while solr_node.endswith('/'):
-        solr_node = solr_node[:-1]
+    # Documents are updated as they are retrieved, rather than all being
+    # loaded into memory first. Each core, or batch of datasets, is processed
+    # in a separate job
+    if ds_names:
+        jobs = dataset_jobs(solrs, ds_names, prefilter=args.prefilter)
+    else:
+        jobs = [(fix_core, (core, solrs[core], args.prefilter))
+                for core in args.cores or CORES]
 
-    s = pysolr.Solr("%s/solr/datasets" % solr_node)
-    dsets = query_all(s, query="esacci")
-    for ds in dsets:
-        solr_update_doc(s, ds, update_urls)
+    totals = run_jobs(jobs, solrs, concurrency=args.concurrency,
+                      batch_size=args.batch_size,
+                      commit_within=args.commit_within, verbose=args.verbose,
+                      dry_run=args.dry_run)
+    for core in CORES:
+        print("{}: {}".format(core, totals[core].summary()))
@@ -0,0 +1,20 @@
+"""
+Split work into parts of roughly equal size
+"""
+import heapq
+
+
+def split_by_size(files, num_chunks):
+    """
+    Split a list of (size, path) into at most `num_chunks' lists of paths with
+    roughly equal total size. Each list of paths is sorted
+    """
+    # Assign each file to the chunk with the smallest total size so far,
+    # starting with the largest files
+    chunks = [(0, i, []) for i in range(min(num_chunks, len(files)))]
+    for size, path in sorted(files, reverse=True):
+        total, i, chunk = heapq.heappop(chunks)
+        chunk.append(path)
+        heapq.heappush(chunks, (total + size, i, chunk))
+    chunks.sort(key=lambda c: c[1])
+    return [sorted(chunk) for _, _, chunk in chunks]
@@ -0,0 +1,720 @@
+#!/usr/bin/env python3
+"""
+Publish the datasets described in a CSV file (see `merge_csv_json.py') in a
+single process. This carries out the same steps as `scripts/publish.sh':
+
+- parse the CSV and check the facets in each DRS with esgcheckvocab
+- generate mapfiles
+- publish each dataset to the PostgreSQL database and create its THREDDS
+  catalog with esgpublish, then create the top-level catalog
+- modify the catalogs and create NcML aggregations
+- transfer the catalogs and aggregations to the remote THREDDS server, and
+  reinit THREDDS
+- request the OPeNDAP/WMS endpoints of each aggregation to cache them
+- publish to Solr with esgpublish
+- correct OPeNDAP/WMS links in Solr
+
+The ESGF publisher commands are run as subprocesses in the publisher's conda
+environment. Everything else runs in this process, so the CSV is parsed once
+and SSH, HTTP and DB connections are reused between steps. Each dataset's
+files are read and written to its mapfile one dataset at a time, so memory use
+does not grow with the size of the batch.
+
+Independent steps overlap: each dataset's catalog is modified as soon as
+esgpublish has created it, and modified catalogs and aggregations are copied
+to the remote server while later datasets are still being published and
+aggregated. Aggregations are cached while datasets are published to Solr.
+
+The stages completed for each dataset are recorded in a journal (an SQLite
+database), along with a hash of their inputs. If a run is interrupted, run it
+again with --resume to skip work that has already been done and is still
+valid. A stage is repeated if its inputs have changed (e.g. the dataset's
+files in the CSV, or the catalog generated by the publisher), and all later
+stages for that dataset are then repeated too.
+
+Settings default to the environment variables used by `scripts/common.sh'.
+"""
+import sys
+import os
+import argparse
+import queue
+import subprocess
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from esacci_esgf.get_catalogs import CatalogGetter
+from esacci_esgf.input.make_mapfiles import MakeMapfile
+from esacci_esgf.input.merge_csv_json import iter_rows
+from esacci_esgf.input.parse_esg_ini import EsgIniParser
+from esacci_esgf.journal import StageJournal, hash_inputs
+from esacci_esgf.sync_manifest import hash_file
+from esacci_esgf.transfer_catalogs import RemoteCatalogHandler
+
+PROJECT = "esacci"
+
+# Number of hours the user certificate must be valid for at the start of
+# publication, and before each call to esgpublish
+CERT_START_HOURS = 70
+CERT_STEP_HOURS = 1
+
+# Stages recorded in the journal for each dataset, in order
+STAGES = ("mapfile", "publish", "modify", "transfer", "reinit", "cache",
+          "solr", "solr_links")
+
+
+def log(msg):
+    print("publish: {}".format(msg))
+    sys.stdout.flush()
+
+
+def warn(msg):
+    print("publish: WARNING: {}".format(msg), file=sys.stderr)
+
+
+def get_ready(in_queue):
+    """
+    Wait for an item on a queue, and return a list of it and any other items
+    already waiting
+    """
+    items = [in_queue.get()]
+    while True:
+        try:
+            items.append(in_queue.get_nowait())
+        except queue.Empty:
+            return items
+
+
+class PublicationError(Exception):
+    """
+    Error that means publication cannot continue
+    """
+
+
+class EsgPublisher(object):
+    """
+    Class to run ESGF publisher commands as subprocesses in the publisher's
+    conda environment
+    """
+    def __init__(self, ini_dir, conda_root, conda_env, cert_file,
+                 project=PROJECT, verbose=False):
+        self.ini_dir = ini_dir
+        self.conda_root = conda_root
+        self.conda_env = conda_env
+        self.cert_file = cert_file
+        self.project = project
+        self.verbose = verbose
+
+    def command(self, args):
+        """
+        Return a command that activates the conda environment and runs `args'
+        """
+        script = '. "$0/bin/activate" "$1" || exit 1; shift; exec "$@"'
+        return (["bash", "-c", script, self.conda_root, self.conda_env] +
+                list(args))
+
+    def call(self, args, **kwargs):
+        """
+        Run a command in the conda environment and return True if it
+        succeeded
+        """
+        cmd = self.command(args)
+        if self.verbose:
+            print(" ".join(cmd))
+        return subprocess.call(cmd, **kwargs) == 0
+
+    def certificate_valid(self, hours):
+        """
+        Return True if the user certificate does not expire within the given
+        number of hours
+        """
+        cmd = ["openssl", "x509", "-in", self.cert_file, "-noout",
+               "-checkend", str(int(hours * 60 * 60))]
+        return subprocess.call(cmd, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL) == 0
+
+    def wait_for_certificate(self, hours=CERT_STEP_HOURS):
+        """
+        Wait until the user certificate is valid for at least the given number
+        of hours
+        """
+        shown = False
+        while not self.certificate_valid(hours):
+            if not shown:
+                log("certificate at '{}' has less than {} hour(s) before "
+                    "expiry. waiting for it to be renewed"
+                    .format(self.cert_file, hours))
+                shown = True
+            time.sleep(1)
+
+    def esgpublish(self, args):
+        self.wait_for_certificate()
+        return self.call(["esgpublish", "-i", self.ini_dir, "--project",
+                          self.project] + list(args))
+
+    def check_vocab(self, ds_names):
+        """
+        Return True if facet values in the given DRSes match those defined in
+        the project INI
+        """
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("\n".join(ds_names) + "\n")
+            f.flush()
+            # esgcheckvocab writes its report to stdout, but it belongs on
+            # stderr
+            return self.call(["esgcheckvocab", "-i", self.ini_dir,
+                              "--project", self.project, "--dataset-list",
+                              f.name],
+                             stdout=sys.stderr, stderr=subprocess.DEVNULL)
+
+    def publish_db(self, mapfile):
+        return self.esgpublish(["--map", mapfile, "--commit-every", "100"])
+
+    def create_catalogs(self, mapfile):
+        return self.esgpublish(["--map", mapfile, "--noscan", "--thredds",
+                                "--service", "fileservice",
+                                "--no-thredds-reinit"])
+
+    def thredds_reinit(self):
+        return self.esgpublish(["--thredds-reinit"])
+
+    def publish_solr(self, mapfile):
+        return self.esgpublish(["--map", mapfile, "--noscan", "--publish"])
+
+
+class Publisher(object):
+    """
+    Class to run every step of publication for a batch of datasets. `esg' is
+    an EsgPublisher, `getter' a CatalogGetter whose output directory is the
+    local catalog directory, and `handler' a RemoteCatalogHandler with reinit
+    enabled.
+
+    If `journal' (a StageJournal) is given, the stages completed for each
+    dataset are recorded in it. If `resume' is also True, stages already
+    completed with the same inputs are skipped
+    """
+    def __init__(self, esg, getter, handler, mapfiles_dir, thredds_url,
+                 solr_url, cache_concurrency=4, journal=None, resume=False):
+        self.esg = esg
+        self.getter = getter
+        self.handler = handler
+        self.mapfiles_dir = mapfiles_dir
+        self.thredds_url = thredds_url
+        self.solr_url = solr_url
+        self.cache_concurrency = cache_concurrency
+        self.journal = journal
+        self.resume = resume
+        # Hash of each dataset's entry in dataset JSON, which is the input to
+        # most stages
+        self.hashes = {}
+        # Datasets that could not be published
+        self.excluded = []
+
+    def is_done(self, dsid, stage, input_hash=None):
+        """
+        Return True if a stage can be skipped for a dataset when resuming
+        """
+        if not self.resume or self.journal is None:
+            return False
+        input_hash = input_hash or self.hashes[dsid]
+        if self.journal.is_done(dsid, stage, input_hash):
+            log("skipping {} for {}: already done".format(stage, dsid))
+            return True
+        return False
+
+    def mark_done(self, dsid, stage, input_hash=None, forget_later=True):
+        if self.journal is not None:
+            self.journal.mark_done(dsid, stage,
+                                   input_hash or self.hashes[dsid],
+                                   forget_later=forget_later)
+
+    def run(self, csv_filename):
+        """
+        Publish the datasets in a CSV file. Raise PublicationError if
+        publication cannot continue
+        """
+        # The DB connection used to look up catalog locations is kept open
+        # for the whole run
+        with self.getter:
+            self.publish_all(csv_filename)
+
+    def publish_all(self, csv_filename):
+        """
+        Carry out each step of publication for the datasets in a CSV file
+        """
+        # Only the CSV rows are held in memory for all datasets
+        rows = list(iter_rows(csv_filename))
+
+        log("checking facets in DRSes...")
+        if not self.esg.check_vocab([row.drs for row in rows]):
+            raise PublicationError("Invalid facet values found in DRSes")
+
+        log("generating mapfiles in {}...".format(self.mapfiles_dir))
+        datasets, mapfiles = self.make_mapfiles(rows)
+
+        self.publish_and_modify(datasets, mapfiles)
+        for dsid in self.excluded:
+            del datasets[dsid]
+            del mapfiles[dsid]
+
+        self.finish_transfer(datasets)
+        self.publish_solr_and_cache(datasets, mapfiles)
+
+        log("modifying WMS links in Solr...")
+        ds_names = [dsid for dsid in datasets
+                    if not self.is_done(dsid, "solr_links")]
+        try:
+            if ds_names:
+                self.fix_solr_links(ds_names)
+        except Exception as ex:
+            raise PublicationError("failed to modify Solr links: {}"
+                                   .format(ex))
+        for dsid in ds_names:
+            self.mark_done(dsid, "solr_links")
+
+        log("publication complete")
+        if self.excluded:
+            log("The following datasets could not be published:")
+            log(" ".join(self.excluded))
+
+    def make_mapfiles(self, rows):
+        """
+        Read the files in each dataset from its JSON file, hash the dataset
+        and write its mapfile. Only one dataset's files are held in memory at
+        a time.
+
+        Return (datasets, mapfiles), where `datasets' is an OrderedDict
+        mapping dataset ID to its entry in dataset JSON without the list of
+        files, and `mapfiles' maps dataset ID to mapfile path
+        """
+        mm = MakeMapfile(self.mapfiles_dir)
+        datasets = OrderedDict()
+        mapfiles = OrderedDict()
+        for row in rows:
+            dsid = row.drs
+            ds = row.get_dict()
+            self.hashes[dsid] = hash_inputs(ds)
+            path = mm.get_mapfile_path(dsid)
+            if not (os.path.isfile(path) and self.is_done(dsid, "mapfile")):
+                tech_note = {"url": ds["tech_note_url"],
+                             "title": ds["tech_note_title"]}
+                path = mm.make_mapfile(dsid, ds["files"], tech_note)
+                # An identical mapfile does not mean the dataset needs to be
+                # published again
+                self.mark_done(dsid, "mapfile", forget_later=False)
+            del ds["files"]
+            datasets[dsid] = ds
+            mapfiles[dsid] = path
+        return datasets, mapfiles
+
+    def publish_dataset(self, dsid, mapfile):
+        """
+        Publish a dataset to the DB and create its THREDDS catalog. Return
+        True on success
+        """
+        if self.is_done(dsid, "publish"):
+            return True
+        log("processing mapfile {}...".format(mapfile))
+        # This may be slow as the publisher will need to open each data file
+        if not self.esg.publish_db(mapfile):
+            warn("failed to publish to postgres")
+            return False
+        if not self.esg.create_catalogs(mapfile):
+            warn("failed to create THREDDS catalogs")
+            return False
+        self.mark_done(dsid, "publish")
+        return True
+
+    def publish_and_modify(self, datasets, mapfiles):
+        """
+        Publish each dataset to the DB with esgpublish and create the
+        top-level catalog. Meanwhile, modify each catalog as soon as it has
+        been created, and copy finished catalogs and aggregations to the
+        remote server. Datasets that could not be published are added to
+        self.excluded
+        """
+        to_modify = queue.Queue()
+        to_transfer = queue.Queue()
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            modifier = executor.submit(self.modify_worker, datasets,
+                                       to_modify, to_transfer)
+            transferrer = executor.submit(self.transfer_worker, to_transfer)
+            try:
+                for dsid, mapfile in mapfiles.items():
+                    # Stop early if catalogs can no longer be processed
+                    if modifier.done() or transferrer.done():
+                        break
+                    if self.publish_dataset(dsid, mapfile):
+                        to_modify.put(dsid)
+                    else:
+                        warn("excluding '{}' from publication".format(dsid))
+                        self.excluded.append(dsid)
+            finally:
+                to_modify.put(None)
+
+            if len(self.excluded) == len(mapfiles):
+                raise PublicationError("all datasets have been excluded -- "
+                                       "aborting")
+
+            # Create the top-level catalog (this must be done by reinit-ing
+            # THREDDS through the publisher) while catalogs are still being
+            # modified
+            if not self.esg.thredds_reinit():
+                raise PublicationError("failed to create top level catalog "
+                                       "or THREDDS reinit")
+
+        try:
+            modifier.result()
+        except Exception as ex:
+            raise PublicationError("failed to retrieve/modify THREDDS "
+                                   "catalogs: {}".format(ex))
+        try:
+            transferrer.result()
+        except Exception as ex:
+            raise PublicationError("failed to transfer catalogs: {}"
+                                   .format(ex))
+
+    def modify_worker(self, datasets, in_queue, out_queue):
+        """
+        Modify catalogs for dataset IDs read from `in_queue' until None is
+        read, and put (dataset ID, catalog path, list of NcML paths) on
+        `out_queue' for each, where paths are relative to the local catalog
+        and NcML directories. None is put on `out_queue' when finished
+        """
+        try:
+            finished = False
+            while not finished:
+                ds_names = get_ready(in_queue)
+                finished = None in ds_names
+                ds_names = [dsid for dsid in ds_names if dsid is not None]
+                if not ds_names:
+                    continue
+                # Look up the catalogs of every dataset that is ready at once
+                locations = self.getter.get_catalog_locations(ds_names)
+                for dsid in ds_names:
+                    paths = self.modify_dataset(dsid, datasets[dsid],
+                                                locations.get(dsid))
+                    if paths is not None:
+                        out_queue.put((dsid,) + paths)
+        finally:
+            out_queue.put(None)
+
+    def modify_dataset(self, dsid, ds, cat_loc):
+        """
+        Modify the catalog for a dataset and create its aggregation, where
+        `cat_loc' is the location of its catalog (relative to the THREDDS
+        root) or None if it was not found in the DB. Return (catalog path,
+        list of NcML paths) relative to the local catalog and NcML
+        directories, or None if the catalog could not be modified
+        """
+        if cat_loc is None:
+            warn("failed to find '{}' in the DB".format(dsid))
+            return None
+
+        # The catalog only needs to be modified again if the dataset or the
+        # catalog generated by the publisher has changed
+        src_path = os.path.join(self.getter.thredds_root, cat_loc)
+        src_hash = hash_file(src_path) if os.path.isfile(src_path) else None
+        input_hash = hash_inputs(self.hashes[dsid], src_hash)
+        cat_path = os.path.join(self.getter.output_dir, cat_loc)
+        if not (os.path.isfile(cat_path) and
+                self.is_done(dsid, "modify", input_hash)):
+            log("modifying catalog for {}...".format(dsid))
+            cat_path = self.getter.modify_catalog(cat_loc, ds)
+            if not os.path.isfile(cat_path):
+                warn("failed to modify catalog for '{}'".format(dsid))
+                return None
+            self.mark_done(dsid, "modify", input_hash)
+
+        return (os.path.relpath(cat_path, self.getter.output_dir),
+                self.getter.ncml_paths(cat_path))
+
+    def transfer_hash(self, cat_path, ncml_paths):
+        """
+        Return a hash of the contents of a modified catalog and its NcML files
+        """
+        paths = [os.path.join(self.getter.output_dir, cat_path)]
+        paths += [os.path.join(self.getter.ncml_dir, p) for p in ncml_paths]
+        return hash_inputs([hash_file(p) if os.path.isfile(p) else None
+                            for p in paths])
+
+    def transfer_worker(self, in_queue):
+        """
+        Copy catalogs and NcML files read from `in_queue' (as put there by
+        modify_worker()) to the remote server until None is read. Everything
+        that is ready is copied in a single transfer
+        """
+        finished = False
+        while not finished:
+            items = get_ready(in_queue)
+            finished = None in items
+            items = [(dsid, cat, ncml, self.transfer_hash(cat, ncml))
+                     for dsid, cat, ncml in filter(None, items)]
+            items = [item for item in items
+                     if not self.is_done(item[0], "transfer", item[3])]
+            if not items:
+                continue
+
+            log("transferring {} catalog(s) to remote machine..."
+                .format(len(items)))
+            self.handler.copy_relative(
+                self.getter.output_dir, [item[1] for item in items],
+                self.handler.remote_catalog_dir
+            )
+            self.handler.copy_relative(
+                self.getter.ncml_dir,
+                [path for item in items for path in item[2]],
+                self.handler.remote_agg_dir
+            )
+            for dsid, _, _, input_hash in items:
+                self.mark_done(dsid, "transfer", input_hash)
+
+    def finish_transfer(self, datasets):
+        """
+        Copy the top-level catalog and anything else not yet copied to the
+        remote server, and reinit THREDDS
+        """
+        log("transferring catalogs to remote machine...")
+        try:
+            self.getter.copy_top_level_catalog()
+            self.handler.copy_to_server([self.getter.output_dir],
+                                        [self.getter.ncml_dir])
+            # Catalogs copied by an earlier run that stopped before THREDDS
+            # was reinitialised would not count as changes this time
+            if self.journal is not None and any(
+                    not self.journal.is_done(dsid, "reinit", self.hashes[dsid])
+                    for dsid in datasets):
+                self.handler.request_reinit()
+            self.handler.flush_reinit()
+        except Exception as ex:
+            raise PublicationError("failed to transfer catalogs: {}"
+                                   .format(ex))
+        for dsid in datasets:
+            self.mark_done(dsid, "reinit", forget_later=False)
+
+    def publish_solr_and_cache(self, datasets, mapfiles):
+        """
+        Publish datasets to Solr while caching aggregations on the remote
+        server
+        """
+        to_cache = OrderedDict((dsid, ds) for dsid, ds in datasets.items()
+                               if not self.is_done(dsid, "cache"))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            caching = executor.submit(self.cache_aggregations, to_cache)
+
+            log("publishing to Solr...")
+            for dsid, mapfile in mapfiles.items():
+                if self.is_done(dsid, "solr"):
+                    continue
+                log("processing mapfile {}...".format(mapfile))
+                # Publish to Solr by looking at endpoints on THREDDS server
+                if self.esg.publish_solr(mapfile):
+                    self.mark_done(dsid, "solr")
+                else:
+                    warn("failed to publish '{}' to Solr".format(dsid))
+
+            try:
+                cached = caching.result()
+            except Exception as ex:
+                warn("failed to cache remote aggregations: {}".format(ex))
+            else:
+                for dsid in cached:
+                    self.mark_done(dsid, "cache", forget_later=False)
+
+    def cache_aggregations(self, datasets):
+        """
+        Request the OPeNDAP/WMS endpoints of each aggregation on the remote
+        server so that they are cached ready for users to access. Return a
+        list of the datasets that were cached successfully
+        """
+        from esacci_esgf.cache_remote_aggregations import cache_aggregations
+
+        log("caching aggregations on the remote machine...")
+        results = cache_aggregations(datasets, self.thredds_url,
+                                     concurrency=self.cache_concurrency)
+        cached = []
+        for dsid, seconds, errors in results:
+            for error in errors:
+                warn("failed to cache aggregation for {}: {}"
+                     .format(dsid, error))
+            if not errors:
+                cached.append(dsid)
+            log("cached {} in {:.2f} s".format(dsid, seconds))
+        return cached
+
+    def fix_solr_links(self, ds_names):
+        """
+        Correct OPeNDAP/WMS links in Solr for the given datasets
+        """
+        from esacci_esgf.modify_solr_links import (CORES, dataset_jobs,
+                                                   make_solrs, run_jobs)
+
+        solrs = make_solrs(self.solr_url)
+        totals = run_jobs(dataset_jobs(solrs, ds_names), solrs)
+        for core in CORES:
+            log("{}: {}".format(core, totals[core].summary()))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    env = os.environ.get
+
+    parser.add_argument(
+        "csv_file",
+        help="CSV file describing the datasets to publish"
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        default=False,
+        help="Print external commands as they are run"
+    )
+    parser.add_argument(
+        "--ini-dir",
+        default=env("INI_DIR"),
+        help="Directory containing esg.ini and the project INI "
+             "[default: $INI_DIR]"
+    )
+    parser.add_argument(
+        "--conda-root",
+        default=env("CONDA_ROOT"),
+        help="Root directory of the conda installation containing the "
+             "publisher's environment [default: $CONDA_ROOT]"
+    )
+    parser.add_argument(
+        "--pub-conda-env",
+        default=env("PUB_CONDA_ENV"),
+        help="Name of the ESGF publisher's conda environment "
+             "[default: $PUB_CONDA_ENV]"
+    )
+    parser.add_argument(
+        "--mapfiles-dir",
+        default=env("MAPFILES_DIR"),
+        help="Directory to write mapfiles to [default: $MAPFILES_DIR]"
+    )
+    parser.add_argument(
+        "--catalog-dir",
+        default=env("CATALOG_DIR"),
+        help="Local directory to write modified catalogs to "
+             "[default: $CATALOG_DIR]"
+    )
+    parser.add_argument(
+        "--ncml-dir",
+        default=env("NCML_DIR"),
+        help="Local directory to write NcML aggregations to "
+             "[default: $NCML_DIR]"
+    )
+    parser.add_argument(
+        "--remote-tds-user",
+        default=env("REMOTE_TDS_USER", "root"),
+        help="Username to connect to the THREDDS server as "
+             "[default: $REMOTE_TDS_USER or %(default)s]"
+    )
+    parser.add_argument(
+        "--remote-catalog-dir",
+        default=env("REMOTE_CATALOG_DIR",
+                    "/var/lib/tomcat/content/thredds/esacci"),
+        help="Directory under which catalogs are stored on the THREDDS server "
+             "[default: $REMOTE_CATALOG_DIR or %(default)s]"
+    )
+    parser.add_argument(
+        "--remote-ncml-dir",
+        default=env("REMOTE_NCML_DIR", "/usr/local/aggregations/"),
+        help="Directory under which NcML aggregations are stored on the "
+             "THREDDS server [default: $REMOTE_NCML_DIR or %(default)s]"
+    )
+    parser.add_argument(
+        "--cert-file",
+        default=env("CERT_FILE",
+                    os.path.expanduser("~/.globus/certificate-file")),
+        help="User certificate used by the publisher "
+             "[default: $CERT_FILE or %(default)s]"
+    )
+    parser.add_argument(
+        "--journal",
+        help="SQLite file in which to record the stages completed for each "
+             "dataset [default: publish_journal.sqlite in the mapfiles "
+             "directory]"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Skip stages recorded in the journal as completed, unless their "
+             "inputs have changed since"
+    )
+    parser.add_argument(
+        "-c", "--cache-concurrency",
+        type=int,
+        default=4,
+        help="Number of aggregations to cache at once [default: %(default)s]"
+    )
+    args = parser.parse_args(sys.argv[1:])
+
+    for name in ("ini_dir", "conda_root", "pub_conda_env", "mapfiles_dir",
+                 "catalog_dir", "ncml_dir"):
+        if not getattr(args, name):
+            parser.error("--{} or ${} must be set"
+                         .format(name.replace("_", "-"), name.upper()))
+
+    ini_file = os.path.join(args.ini_dir, "esg.ini")
+    values = EsgIniParser.get_values(ini_file, [
+        "thredds_host", "solr_host", "thredds_username", "thredds_password"
+    ])
+
+    esg = EsgPublisher(args.ini_dir, args.conda_root, args.pub_conda_env,
+                       args.cert_file, verbose=args.verbose)
+    getter = CatalogGetter(ini_file, output_dir=args.catalog_dir,
+                           ncml_dir=args.ncml_dir,
+                           remote_agg_dir=args.remote_ncml_dir)
+    handler = RemoteCatalogHandler(
+        user=args.remote_tds_user, server=values["thredds_host"],
+        remote_catalog_dir=args.remote_catalog_dir,
+        remote_agg_dir=args.remote_ncml_dir, verbose=args.verbose,
+        reinit=True, thredds_credentials=(values["thredds_username"],
+                                          values["thredds_password"])
+    )
+    if not os.path.isdir(args.mapfiles_dir):
+        os.makedirs(args.mapfiles_dir)
+    journal = StageJournal(
+        args.journal or os.path.join(args.mapfiles_dir,
+                                     "publish_journal.sqlite"),
+        STAGES
+    )
+    publisher = Publisher(
+        esg, getter, handler, args.mapfiles_dir,
+        thredds_url="http://{}/thredds/".format(values["thredds_host"]),
+        solr_url="http://{}:8984".format(values["solr_host"]),
+        cache_concurrency=args.cache_concurrency, journal=journal,
+        resume=args.resume
+    )
+
+    with handler, journal:
+        try:
+            # Check SSH access and user certificate before starting
+            log("checking SSH access to {}...".format(values["thredds_host"]))
+            try:
+                handler.connect()
+            except subprocess.CalledProcessError:
+                raise PublicationError("cannot SSH to {}"
+                                       .format(values["thredds_host"]))
+            log("checking certificate expiry time...")
+            if not esg.certificate_valid(CERT_START_HOURS):
+                raise PublicationError(
+                    "certificate at '{}' is not valid or expires within {} "
+                    "hours. please renew and try again"
+                    .format(args.cert_file, CERT_START_HOURS)
+                )
+
+            publisher.run(args.csv_file)
+        except PublicationError as ex:
+            print("publish: {}".format(ex), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
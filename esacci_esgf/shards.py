@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+Merge the output of `get_catalogs --shard i/N' from each of N shards into the
+final catalog and NcML directories.
+
+Each shard writes its catalogs, NcML files and a metrics file (recording the
+datasets it processed) to its own directory under the shard directory. Before
+anything is moved, the assignment of datasets to shards is recalculated from
+the dataset JSON, and every shard is checked to have finished and produced a
+catalog for each dataset assigned to it. If any output is missing, nothing is
+merged and the exit status is non-zero.
+"""
+import sys
+import os
+import argparse
+import json
+import tempfile
+
+from esacci_esgf.input.manifest import load_datasets
+from esacci_esgf.partition import split_by_size
+
+# Names of the directories and files written for each shard
+CATALOG_SUBDIR = "catalogs"
+NCML_SUBDIR = "ncml"
+METRICS_FILE = "metrics.json"
+
+
+def parse_shard(spec):
+    """
+    Parse a string of the form 'i/N' as given to --shard, and return (i, N).
+    Shards are numbered from 0 to N-1
+    """
+    try:
+        index, count = map(int, spec.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{}' is not of the form i/N"
+                                         .format(spec))
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            "invalid shard '{}': must have 0 <= i < N".format(spec)
+        )
+    return index, count
+
+
+def assign_shards(sizes, num_shards):
+    """
+    Split items between shards so that the total size in each shard is
+    roughly equal. `sizes' is a list of (size, name). Return a list of
+    `num_shards' lists of names. The result only depends on `sizes' (not on
+    its order), so every process computes the same assignment
+    """
+    shards = split_by_size(sizes, num_shards)
+    return shards + [[] for _ in range(num_shards - len(shards))]
+
+
+def dataset_sizes(json_filenames):
+    """
+    Return a list of (number of files, dataset ID) for the datasets in the
+    given dataset JSON files or manifests
+    """
+    sizes = {}
+    for filename in json_filenames:
+        datasets = load_datasets(filename)
+        for dsid, ds in datasets.items():
+            sizes[dsid] = len(ds["files"])
+        if hasattr(datasets, "close"):
+            datasets.close()
+    return [(num_files, dsid) for dsid, num_files in sizes.items()]
+
+
+def shard_dir(root, index, count):
+    return os.path.join(root, "shard-{}-of-{}".format(index, count))
+
+
+def write_metrics(path, metrics):
+    """
+    Write a metrics dictionary as JSON. The file is written atomically, since
+    its existence marks a shard as finished
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(metrics, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def verify_shards(root, assignment):
+    """
+    Check the output of each shard against the expected assignment (as
+    returned by assign_shards()). Return (list of metrics dictionaries, list
+    of problems found)
+    """
+    count = len(assignment)
+    all_metrics = []
+    problems = []
+    for index, expected in enumerate(assignment):
+        directory = shard_dir(root, index, count)
+        try:
+            with open(os.path.join(directory, METRICS_FILE)) as f:
+                metrics = json.load(f)
+        except FileNotFoundError:
+            problems.append("shard {}/{} has not finished".format(index,
+                                                                  count))
+            continue
+        all_metrics.append(metrics)
+
+        done = metrics["datasets"]
+        missing = [dsid for dsid in expected if dsid not in done]
+        unexpected = sorted(set(done) - set(expected))
+        problems += ["shard {}/{} did not process '{}'"
+                     .format(index, count, dsid) for dsid in missing]
+        problems += ["shard {}/{} processed '{}', which belongs to another "
+                     "shard".format(index, count, dsid)
+                     for dsid in unexpected]
+
+        if index == 0:
+            top_level = os.path.join(directory, CATALOG_SUBDIR, "catalog.xml")
+            if not os.path.isfile(top_level):
+                problems.append("'{}' is missing".format(top_level))
+
+        for dsid, info in sorted(done.items()):
+            if dsid in metrics["not_found"]:
+                continue
+            if info["catalog"] is None:
+                problems.append("no catalog was written for '{}'"
+                                .format(dsid))
+                continue
+            paths = [os.path.join(directory, CATALOG_SUBDIR,
+                                  info["catalog"])]
+            paths += [os.path.join(directory, NCML_SUBDIR, p)
+                      for p in info["ncml"]]
+            problems += ["'{}' is missing".format(p) for p in paths
+                         if not os.path.isfile(p)]
+
+    return all_metrics, problems
+
+
+def move_tree(src_dir, dest_dir):
+    """
+    Move every file under `src_dir' to the same relative path under
+    `dest_dir', replacing existing files. Return the number of files moved
+    """
+    moved = 0
+    for dirpath, _, filenames in os.walk(src_dir):
+        target_dir = os.path.join(dest_dir, os.path.relpath(dirpath, src_dir))
+        if filenames and not os.path.isdir(target_dir):
+            os.makedirs(target_dir)
+        for name in filenames:
+            os.replace(os.path.join(dirpath, name),
+                       os.path.join(target_dir, name))
+            moved += 1
+    return moved
+
+
+def merge_metrics(all_metrics):
+    """
+    Combine the metrics from each shard into a single dictionary
+    """
+    datasets = {}
+    not_found = []
+    for metrics in all_metrics:
+        datasets.update(metrics["datasets"])
+        not_found += metrics["not_found"]
+    return {
+        "num_shards": len(all_metrics),
+        "datasets": datasets,
+        "not_found": sorted(not_found),
+        "files": sum(info["files"] for info in datasets.values()),
+        "shards": [
+            {key: metrics[key] for key in ("shard", "files", "seconds", "io")}
+            for metrics in all_metrics
+        ]
+    }
+
+
+def merge_shards(root, assignment, output_dir, ncml_dir):
+    """
+    Verify the output of each shard and move it into `output_dir' and
+    `ncml_dir'. Return (merged metrics dictionary, list of problems). If any
+    problems were found, nothing is moved and the metrics are None
+    """
+    all_metrics, problems = verify_shards(root, assignment)
+    if problems:
+        return None, problems
+
+    for index in range(len(assignment)):
+        directory = shard_dir(root, index, len(assignment))
+        move_tree(os.path.join(directory, CATALOG_SUBDIR), output_dir)
+        move_tree(os.path.join(directory, NCML_SUBDIR), ncml_dir)
+
+    merged = merge_metrics(all_metrics)
+    write_metrics(os.path.join(root, METRICS_FILE), merged)
+    return merged, []
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "input_json",
+        nargs="+",
+        help="JSON file(s) or dataset manifest(s) given to get_catalogs"
+    )
+    parser.add_argument(
+        "-s", "--shard-dir",
+        required=True,
+        help="Directory containing the output of each shard"
+    )
+    parser.add_argument(
+        "-N", "--num-shards",
+        type=int,
+        required=True,
+        help="Number of shards"
+    )
+    parser.add_argument(
+        "-o", "--output-dir",
+        required=True,
+        help="Directory to move catalogs to"
+    )
+    parser.add_argument(
+        "-n", "--ncml-dir",
+        required=True,
+        help="Directory to move NcML aggregations to"
+    )
+    args = parser.parse_args(sys.argv[1:])
+
+    assignment = assign_shards(dataset_sizes(args.input_json),
+                               args.num_shards)
+    merged, problems = merge_shards(args.shard_dir, assignment,
+                                    args.output_dir, args.ncml_dir)
+    if problems:
+        print("ERROR: shard output is incomplete -- nothing merged:",
+              file=sys.stderr)
+        for problem in problems:
+            print("  {}".format(problem), file=sys.stderr)
+        sys.exit(1)
+
+    print("Merged {} datasets ({} files) from {} shards".format(
+        len(merged["datasets"]), merged["files"], merged["num_shards"]
+    ))
+    for shard in merged["shards"]:
+        print("shard {}: {} files in {:.2f} s, file open limit {}".format(
+            shard["shard"], shard["files"], shard["seconds"],
+            shard["io"]["limit"]
+        ))
+    if merged["not_found"]:
+        print("WARNING: {} dataset(s) were not found in the DB"
+              .format(len(merged["not_found"])), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Keep a record of the files last copied to a directory on a remote server, so
+that subsequent copies only need to transfer files that have changed.
+
+A manifest is stored locally for each (server, remote directory) pair, and
+maps the path of each file relative to the remote directory to the SHA-256
+checksum of its contents.
+"""
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+
+def hash_file(path, block_size=2 ** 20):
+    """
+    Return the hex SHA-256 checksum of a file's contents
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def scan_sources(sources):
+    """
+    Find the files that would be copied by rsync'ing each path in `sources' to
+    a directory, and return an OrderedDict mapping the path of each file
+    relative to the destination to (source base directory, local path).
+
+    As with rsync, the contents of a directory are copied if its path ends
+    with '/', and a file is copied to the top level of the destination
+    """
+    files = OrderedDict()
+    for src in sources:
+        if os.path.isdir(src):
+            base = src if src.endswith("/") else os.path.dirname(src)
+            for dirpath, dirnames, filenames in os.walk(src):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    path = os.path.join(dirpath, name)
+                    files[os.path.relpath(path, base)] = (base, path)
+        else:
+            files[os.path.basename(src)] = (os.path.dirname(src) or ".", src)
+    return files
+
+
+class SyncManifest(object):
+    """
+    Record of the checksums of files copied to a remote directory
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.files = json.load(f)["files"]
+
+    @classmethod
+    def for_remote(cls, manifest_dir, hostname, remote_dir):
+        """
+        Return the manifest for the given server and remote directory, stored
+        in `manifest_dir'
+        """
+        remote_dir = os.path.normpath(remote_dir)
+        digest = hashlib.sha1(remote_dir.encode()).hexdigest()[:12]
+        filename = "{}-{}.json".format(hostname, digest)
+        return cls(os.path.join(manifest_dir, filename))
+
+    def save(self):
+        parent = os.path.dirname(self.path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"files": self.files}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def changed(self, hashes):
+        """
+        Given a dictionary mapping relative path to checksum for local files,
+        return a list of paths that differ from the remote copy
+        """
+        return [rel_path for rel_path, checksum in hashes.items()
+                if self.files.get(rel_path) != checksum]
+
+    def orphans(self, rel_paths):
+        """
+        Return a sorted list of files recorded in the manifest that are not
+        in `rel_paths'
+        """
+        rel_paths = set(rel_paths)
+        return sorted(p for p in self.files if p not in rel_paths)
+
+    def update(self, hashes):
+        self.files.update(hashes)
+
+    def remove(self, rel_paths):
+        for rel_path in rel_paths:
+            self.files.pop(rel_path, None)
+
+    def verify(self, remote_hashes):
+        """
+        Compare the manifest to checksums computed on the remote server, and
+        return (modified, missing, untracked) lists of relative paths
+        """
+        modified = sorted(p for p, checksum in remote_hashes.items()
+                          if p in self.files and self.files[p] != checksum)
+        missing = sorted(p for p in self.files if p not in remote_hashes)
+        untracked = sorted(p for p in remote_hashes if p not in self.files)
+        return modified, missing, untracked
@@ -2,20 +2,59 @@ import os
 import sys
 import re
 import json
+import hashlib
+import argparse
+import subprocess
 import xml.etree.cElementTree as ET
+import shutil
+import copy
+import types
+import tarfile
+import sqlite3
+import threading
+import time
+import multiprocessing
+import socketserver
+import http.server
 from glob import glob
-from io import StringIO
+from io import StringIO, BytesIO
 import freezegun
 
 import pytest
 import numpy as np
 from netCDF4 import Dataset
 
-from esacci_esgf.modify_catalogs import ProcessBatch, get_thredds_url
+from esacci_esgf.modify_catalogs import ProcessBatch, ThreddsXMLBase, get_thredds_url
+from esacci_esgf.find_ncml import find_ncml
+from esacci_esgf.get_catalogs import CatalogGetter
+from esacci_esgf.unpublish import BatchUnpublisher
+from esacci_esgf import unpublish
+from esacci_esgf.publish import Publisher, STAGES
+from esacci_esgf.shards import (parse_shard, assign_shards, dataset_sizes,
+                                shard_dir, merge_shards)
+from esacci_esgf.journal import StageJournal, hash_inputs
+from esacci_esgf.modify_solr_links import (NEEDS_UPDATE_QUERY, SolrUpdater,
+                                           fix_core, query_all,
+                                           query_by_values,
+                                           query_datasets_and_files, run_jobs,
+                                           update_all, update_urls)
 from esacci_esgf.input.merge_csv_json import Dataset as CsvRowDataset, parse_file, HEADER_ROW
 from esacci_esgf.input.parse_esg_ini import EsgIniParser
 from esacci_esgf.input.make_mapfiles import MakeMapfile
+from esacci_esgf.input.file_list import FileList
+from esacci_esgf.input.remove_key import remove_keys
+from esacci_esgf.input.manifest import (DatasetManifest, json_to_manifest,
+                                        manifest_to_json, load_datasets)
 from esacci_esgf.aggregation.base import CCIAggregationCreator
+from esacci_esgf.aggregation.throttle import (AdaptiveLimiter, percentiles,
+                                              ThrottledReaderMixin, LIMITER,
+                                              add_limit_arguments,
+                                              configure_limiter)
+from esacci_esgf.sync_manifest import hash_file
+from esacci_esgf.http_session import make_session
+from esacci_esgf.cache_remote_aggregations import cache_aggregations
+from esacci_esgf.transfer_catalogs import (RemoteCatalogHandler, LocalTransport,
+                                           SSHTransport)
 
 
 def get_full_tag(tag, ns="http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0"):
@@ -203,6 +242,50 @@ class TestMergeCSV(object):
 
         assert parsed == expected
 
+    def test_parse_streaming(self, tmpdir):
+        """
+        Check the output is the same in compact and indented modes, and that
+        compact mode writes one dataset per line
+        """
+        json_file = tmpdir.join("f.json")
+        obj = {
+            "ds1": [{"file": "one.nc", "size": 1, "mtime": 1, "sha256": "a"}],
+            "ds2": [{"file": "two.nc", "size": 2, "mtime": 2, "sha256": "b"},
+                    {"file": "three.nc", "size": 3, "mtime": 3, "sha256": "c"}]
+        }
+        with open(str(json_file), "w") as f:
+            json.dump(obj, f)
+
+        csv_file = tmpdir.join("f.csv")
+        csv_file.write("\n".join([
+            ",".join(HEADER_ROW),
+            "ds1,1,url,title,yes,no,{}".format(str(json_file)),
+            "ds2,2,url,title,no,no,{}".format(str(json_file))
+        ]))
+
+        indented = StringIO()
+        parse_file(str(csv_file), out=indented)
+        compact = StringIO()
+        parse_file(str(csv_file), out=compact, compact=True)
+
+        assert json.loads(indented.getvalue()) == json.loads(compact.getvalue())
+        assert set(json.loads(compact.getvalue()).keys()) == {"ds1", "ds2"}
+        lines = compact.getvalue().strip().split("\n")
+        assert len(lines) == 4
+        assert lines[1].startswith('"ds1":') and lines[1].endswith(",")
+        assert lines[2].startswith('"ds2":')
+
+    def test_duplicate_dataset(self, tmpdir):
+        json_file = tmpdir.join("f.json")
+        with open(str(json_file), "w") as f:
+            json.dump({"ds": []}, f)
+
+        csv_file = tmpdir.join("f.csv")
+        row = "ds,0,url,title,no,no,{}".format(str(json_file))
+        csv_file.write("\n".join([",".join(HEADER_ROW), row, row]))
+        with pytest.raises(ValueError):
+            parse_file(str(csv_file), out=StringIO())
+
 
 class TestMakeMapfile(object):
     def test_extract_version(self):
@@ -292,6 +375,165 @@ class TestMakeMapfile(object):
         assert "dataset_tech_notes" not in l2
 
 
+class TestFileList(object):
+    def test_round_trip(self):
+        checksum = "0123456789abcdef" * 4
+        file_dicts = [
+            {"path": "/data/dir1/a.nc", "size": 1, "mtime": 1.5, "sha256": checksum},
+            {"path": "/data/dir1/b.nc", "size": 2, "mtime": 2.0, "sha256": checksum},
+            {"path": "/data/dir2/c.nc", "size": 3, "mtime": 3.25, "sha256": "notahash"},
+            {"path": "relative.nc", "size": 4, "mtime": 4.0, "sha256": 0}
+        ]
+        files = FileList(file_dicts)
+        assert len(files) == 4
+        assert list(files) == file_dicts
+        assert files == file_dicts
+        assert files[-1] == file_dicts[-1]
+        with pytest.raises(IndexError):
+            files[4]
+
+        # Directory names should only be stored once
+        assert len(files._dirs) == 3
+
+    def test_values_preserved(self):
+        """
+        Check that values are returned exactly as they were given, including
+        their types, whether or not they can be packed
+        """
+        files = FileList()
+        files.append("/data/a.nc", "123", "4.5", "abc")
+        files.append("/data/b.nc", "big", None, "ABC")
+        files.append("/data/c.nc", 1.9, 3, "c")
+        files.append("/data/d.nc", 2 ** 64, 2 ** 60 + 1, "d")
+        files.append("/data/e.nc", True, 3.0, "e")
+        expected = [
+            {"path": "/data/a.nc", "size": "123", "mtime": "4.5",
+             "sha256": "abc"},
+            {"path": "/data/b.nc", "size": "big", "mtime": None,
+             "sha256": "ABC"},
+            {"path": "/data/c.nc", "size": 1.9, "mtime": 3, "sha256": "c"},
+            {"path": "/data/d.nc", "size": 2 ** 64, "mtime": 2 ** 60 + 1,
+             "sha256": "d"},
+            {"path": "/data/e.nc", "size": True, "mtime": 3.0, "sha256": "e"}
+        ]
+        for record, expected_record in zip(files, expected):
+            assert record == expected_record
+            for key, value in expected_record.items():
+                assert type(record[key]) is type(value)
+
+    def test_missing_key(self):
+        with pytest.raises(KeyError):
+            FileList([{"path": "/data/a.nc", "size": 1, "mtime": 1}])
+
+
+class TestDatasetManifest(object):
+    datasets = {
+        "one.v1": {
+            "generate_aggregation": True,
+            "include_in_wms": False,
+            "tech_note_url": "http://tech.notes/1",
+            "tech_note_title": "first",
+            "files": [
+                {"path": "/data/a.nc", "size": 10, "mtime": 1.5, "sha256": "aa"},
+                {"path": "/data/b.nc", "size": 20, "mtime": 2.5, "sha256": "bb"}
+            ]
+        },
+        "two.v2": {
+            "generate_aggregation": False,
+            "include_in_wms": False,
+            "tech_note_url": "http://tech.notes/2",
+            "tech_note_title": "second",
+            "files": [
+                {"path": "/data/c.nc", "size": "30", "mtime": 3, "sha256": "cc"}
+            ]
+        }
+    }
+
+    def make_manifest(self, tmpdir):
+        json_file = tmpdir.join("in.json")
+        json_file.write(json.dumps(self.datasets))
+        manifest_file = str(tmpdir.join("in.manifest"))
+        json_to_manifest(str(json_file), manifest_file)
+        return manifest_file
+
+    def test_round_trip(self, tmpdir):
+        manifest_file = self.make_manifest(tmpdir)
+        assert DatasetManifest.is_manifest(manifest_file)
+        assert not DatasetManifest.is_manifest(str(tmpdir.join("in.json")))
+
+        s = StringIO()
+        manifest_to_json(manifest_file, out=s)
+        assert json.loads(s.getvalue()) == self.datasets
+
+    def test_random_access(self, tmpdir):
+        manifest_file = self.make_manifest(tmpdir)
+        with load_datasets(manifest_file) as manifest:
+            assert len(manifest) == 2
+            assert "two.v2" in manifest
+            assert "three.v3" not in manifest
+            assert manifest["two.v2"] == self.datasets["two.v2"]
+            with pytest.raises(KeyError):
+                manifest["three.v3"]
+
+            del manifest["one.v1"]
+            assert list(manifest.keys()) == ["two.v2"]
+
+        with DatasetManifest(manifest_file) as manifest:
+            assert list(manifest.keys()) == ["two.v2"]
+
+    def test_compact_storage(self, tmpdir):
+        manifest_file = str(tmpdir.join("in.manifest"))
+        files = [{"path": "/data/{}.nc".format(i), "size": i, "mtime": 1.5,
+                  "sha256": "{:064x}".format(i)} for i in range(3)]
+        ds = dict(self.datasets["one.v1"], files=files)
+        with DatasetManifest(manifest_file) as manifest:
+            manifest["one.v1"] = ds
+            # Checksums are stored as binary digests and directory names only
+            # once
+            row = manifest.conn.execute("SELECT sha256 FROM files").fetchone()
+            assert row[0] == bytes(32)
+            dirs = manifest.conn.execute("SELECT path FROM dirs").fetchall()
+            assert dirs == [("/data",)]
+            assert manifest["one.v1"] == ds
+
+        # Manifests in an older format are rejected
+        old_file = str(tmpdir.join("old.manifest"))
+        conn = sqlite3.connect(old_file)
+        conn.execute("CREATE TABLE datasets (id TEXT PRIMARY KEY)")
+        conn.close()
+        with pytest.raises(ValueError):
+            DatasetManifest(old_file)
+
+    def test_make_mapfiles_from_manifest(self, tmpdir):
+        manifest_file = self.make_manifest(tmpdir)
+        mm = MakeMapfile(str(tmpdir.join("mapfiles")))
+
+        s = StringIO()
+        sys.stdout = s
+        mm.make_mapfiles(manifest_file)
+        sys.stdout = sys.__stdout__
+
+        paths = s.getvalue().strip().split("\n")
+        assert len(paths) == 2
+        assert all(os.path.isfile(p) for p in paths)
+
+
+class TestRemoveKey(object):
+    def test_remove_keys(self):
+        doc = {"a": 1, "b": 2, "c": 3}
+        remove_keys(doc, ["a", "c", "a"])
+        assert doc == {"b": 2}
+
+    def test_missing_key(self):
+        """
+        Check that nothing is removed if any key is missing
+        """
+        doc = {"a": 1, "b": 2}
+        with pytest.raises(KeyError):
+            remove_keys(doc, ["a", "z"])
+        assert doc == {"a": 1, "b": 2}
+
+
 class TestEsgIniParser(object):
     @classmethod
     def do_hostname_test(self, tmpdir, ini_lines, key):
@@ -371,6 +613,34 @@ class TestEsgIniParser(object):
         with pytest.raises(ValueError):
             EsgIniParser.get_value(str(ini), "thredds_data_path")
 
+    def test_get_values(self, tmpdir):
+        ini = tmpdir.join("esg.ini")
+        ini.write("\n".join([
+            "[DEFAULT]",
+            "thredds_url = http://tds.ac.uk/thredds",
+            "thredds_username = admin",
+            "thredds_password = secret",
+        ]))
+        values = EsgIniParser.get_values(str(ini), ["thredds_host",
+                                                    "thredds_username",
+                                                    "thredds_password"])
+        assert values == {"thredds_host": "tds.ac.uk",
+                          "thredds_username": "admin",
+                          "thredds_password": "secret"}
+
+    def test_config_cache(self, tmpdir):
+        """
+        Check that the ini file is only parsed again if it changes
+        """
+        ini = tmpdir.join("esg.ini")
+        ini.write("[DEFAULT]\nthredds_username = one\n")
+        config = EsgIniParser.get_config(str(ini))
+        assert EsgIniParser.get_config(str(ini)) is config
+
+        ini.write("[DEFAULT]\nthredds_username = two\n")
+        ini.setmtime(ini.mtime() + 10)
+        assert EsgIniParser.get_value(str(ini), "thredds_username") == "two"
+
 class TestAggregations:
     def netcdf_file(self, tmpdir, filename, dim="time", values=[1234],
                     units=None, global_attrs=None):
@@ -626,3 +896,1377 @@ class TestAggregations:
             assert attrs_dict[e_attr]["value"] == "175.0"
             assert attrs_dict[s_attr]["value"] == "-70.0"
             assert attrs_dict[n_attr]["value"] == "85.0"
+
+
+class TestThrottle(object):
+    def record(self, limiter, open_seconds, count=1):
+        for _ in range(count):
+            limiter.acquire()
+            limiter.release(open_seconds, 0.01)
+
+    def test_percentiles(self):
+        p = percentiles(range(1, 101))
+        assert p == {"p50": 50, "p90": 90, "p99": 99, "max": 100}
+        assert percentiles([3]) == {"p50": 3, "p90": 3, "p99": 3, "max": 3}
+        assert percentiles([])["p50"] is None
+
+    def test_aimd(self):
+        limiter = AdaptiveLimiter(floor=1, ceiling=4, target_latency=0.1,
+                                  window=10, min_samples=3)
+        assert limiter.current_limit == 1
+
+        # Fast opens increase the limit up to the ceiling
+        self.record(limiter, 0.01, count=2)
+        assert limiter.current_limit == 2
+        self.record(limiter, 0.01, count=20)
+        assert limiter.current_limit == 4
+
+        # Slow opens halve it once they dominate recent latencies
+        self.record(limiter, 1, count=2)
+        assert limiter.current_limit == 2
+        assert limiter.decreases == 1
+        # ...but not below the floor
+        self.record(limiter, 1, count=10)
+        assert limiter.current_limit == 1
+
+        metrics = limiter.metrics()
+        assert metrics["limit"] == 1
+        assert metrics["opens"] == 34
+        assert metrics["open_latency"]["max"] == 1
+        assert metrics["read_latency"]["p50"] == 0.01
+
+        with pytest.raises(ValueError):
+            AdaptiveLimiter(floor=3, ceiling=2)
+
+    def test_concurrency_limit(self):
+        limiter = AdaptiveLimiter(floor=2, ceiling=2)
+        lock = threading.Lock()
+        state = {"open": 0, "max_open": 0}
+
+        class FakeFile(object):
+            def __init__(self, path):
+                with lock:
+                    state["open"] += 1
+                    state["max_open"] = max(state["max_open"], state["open"])
+
+            def close(self):
+                with lock:
+                    state["open"] -= 1
+
+        def read(path):
+            with limiter.open_file(FakeFile, path):
+                time.sleep(0.01)
+
+        threads = [threading.Thread(target=read, args=(str(i),))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert state == {"open": 0, "max_open": 2}
+        metrics = limiter.metrics()
+        assert metrics["opens"] == 8
+        assert metrics["max_in_flight"] == 2
+        assert metrics["read_latency"]["p50"] >= 0.01
+
+        # A failed open is recorded and frees its slot
+        def fail(path):
+            raise OSError("no such file")
+        with pytest.raises(OSError):
+            with limiter.open_file(fail, "x"):
+                pass
+        assert limiter.in_flight == 0
+        assert limiter.metrics()["failed_opens"] == 1
+
+    def test_reader_mixin(self):
+        class FakeReader(object):
+            def __init__(self, filename):
+                self.filename = filename
+
+            def __enter__(self):
+                self.ds = "dataset for {}".format(self.filename)
+                return self
+
+            def __exit__(self, *args):
+                self.ds = None
+
+        class ThrottledReader(ThrottledReaderMixin, FakeReader):
+            limiter = AdaptiveLimiter()
+
+        with ThrottledReader("a.nc") as reader:
+            assert reader.ds == "dataset for a.nc"
+            assert ThrottledReader.limiter.in_flight == 1
+        assert reader.ds is None
+        metrics = ThrottledReader.limiter.metrics()
+        assert metrics["opens"] == 1
+        assert metrics["failed_opens"] == 0
+        assert ThrottledReader.limiter.in_flight == 0
+
+    def test_concurrent_readers(self):
+        lock = threading.Lock()
+        state = {"threads": set(), "max_threads": 0}
+
+        class FakeReader(object):
+            def __init__(self, filename):
+                self.filename = filename
+
+            def __enter__(self):
+                with lock:
+                    state["threads"].add(threading.get_ident())
+                    state["max_threads"] = max(state["max_threads"],
+                                               len(state["threads"]))
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        class ThrottledReader(ThrottledReaderMixin, FakeReader):
+            limiter = AdaptiveLimiter(floor=2, ceiling=2)
+
+        def read(i):
+            with ThrottledReader("{}.nc".format(i)):
+                time.sleep(0.01)
+                # Opening another file while the first is open must not wait
+                # for a slot held by this thread
+                with ThrottledReader("{}-other.nc".format(i)):
+                    time.sleep(0.01)
+                with lock:
+                    state["threads"].discard(threading.get_ident())
+
+        threads = [threading.Thread(target=read, args=(i,))
+                   for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(timeout=10)
+            assert not t.is_alive()
+
+        # At most two threads had files open at once, but nested opens may go
+        # beyond the limit
+        assert state["max_threads"] == 2
+        metrics = ThrottledReader.limiter.metrics()
+        assert metrics["opens"] == 16
+        assert 2 <= metrics["max_in_flight"] <= 4
+        assert ThrottledReader.limiter.in_flight == 0
+
+    def test_nested_open_at_floor(self):
+        limiter = AdaptiveLimiter(floor=1, ceiling=1)
+        with limiter.throttled():
+            with limiter.throttled():
+                assert limiter.in_flight == 2
+        assert limiter.in_flight == 0
+
+    def test_limit_arguments(self, monkeypatch):
+        monkeypatch.setenv("MAX_OPEN_FILES", "4")
+        parser = argparse.ArgumentParser()
+        add_limit_arguments(parser)
+        args = parser.parse_args(["--min-open-files", "2"])
+        assert (args.min_open_files, args.max_open_files,
+                args.open_latency_target) == (2, 4, 0.5)
+
+        limiter = AdaptiveLimiter(floor=1, ceiling=16)
+        limiter.limit = 10
+        limiter.configure(2, 4, 0.25)
+        assert limiter.current_limit == 4
+        assert limiter.metrics()["target_latency"] == 0.25
+        with pytest.raises(ValueError):
+            limiter.configure(0, 4, 0.5)
+        with pytest.raises(ValueError):
+            limiter.configure(1, 4, 0)
+
+        # Invalid limits are a usage error
+        args = parser.parse_args(["--min-open-files", "8"])
+        with pytest.raises(SystemExit):
+            configure_limiter(parser, args)
+        assert LIMITER.ceiling == 16
+
+
+class RecordingHandler(RemoteCatalogHandler):
+    """
+    RemoteCatalogHandler that records commands instead of running them
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("transport", LocalTransport())
+        super().__init__("user", "server", *args, **kwargs)
+        self.commands = []
+
+    def run_command(self, args):
+        self.commands.append(args)
+        return ""
+
+
+class TestTransferCatalogs(object):
+    def make_tree(self, root, num_files):
+        for i in range(num_files):
+            subdir = root.join(str(i % 3))
+            subdir.ensure(dir=True)
+            subdir.join("cat{}.xml".format(i)).write("x" * (i + 1))
+
+    def test_one_rsync_per_destination(self, tmpdir):
+        cats = tmpdir.mkdir("cats")
+        self.make_tree(cats, 5)
+        ncml = tmpdir.mkdir("ncml")
+        single = tmpdir.join("catalog.xml")
+        single.write("top")
+
+        handler = RecordingHandler("/remote/cats", "/remote/ncml")
+        handler.copy_to_server([str(cats), str(single)], [str(ncml)])
+        rsyncs = [c for c in handler.commands if c[0] == "rsync"]
+        assert len(rsyncs) == 2
+        assert rsyncs[0][-3:] == [str(cats) + "/", str(single), "/remote/cats"]
+        assert rsyncs[1][-2:] == [str(ncml) + "/", "/remote/ncml"]
+
+    def test_split_transfer(self, tmpdir):
+        cats = tmpdir.mkdir("cats")
+        self.make_tree(cats, 20)
+        list_dir = tmpdir.mkdir("lists")
+
+        handler = RecordingHandler("/remote/cats", "/remote/ncml", parallel=3)
+        jobs = handler.split_transfer([str(cats) + "/"], "/remote/cats",
+                                      str(list_dir))
+        assert len(jobs) == 3
+
+        listed = []
+        for sources, dest, files_from in jobs:
+            assert sources == [str(cats) + "/"]
+            assert dest == "/remote/cats"
+            with open(files_from) as f:
+                listed += f.read().split()
+        expected = [os.path.relpath(str(p), str(cats))
+                    for p in cats.visit(fil=lambda p: p.isfile())]
+        assert sorted(listed) == sorted(expected)
+
+    def test_multiplexed_ssh_commands(self):
+        """
+        Check that ssh and rsync commands share a master connection when
+        multiplexing, and count handshakes
+        """
+        handler = RemoteCatalogHandler("user", "server", "/cats", "/ncml",
+                                       dry_run=True)
+        transport = handler.transport
+        ssh_cmd = transport.command(["rm", "-f", "--", "/cats/a b.xml"])
+        assert ssh_cmd[0] == "ssh"
+        assert ssh_cmd[-1] == "rm -f -- '/cats/a b.xml'"
+        control_opts = [a for a in ssh_cmd if a.startswith("ControlPath=")]
+        assert len(control_opts) == 1
+        assert control_opts[0] in " ".join(transport.rsync_options())
+
+        handler.close()
+        assert transport.control_dir is None
+
+        # Without multiplexing each command is a new connection
+        handler = RemoteCatalogHandler("user", "server", "/cats", "/ncml",
+                                       dry_run=True, multiplex=False)
+        transport = handler.transport
+        transport.command(["ls"])
+        transport.rsync_options()
+        assert transport.handshakes == 2
+        assert not any("ControlPath" in a for a in transport.command(["ls"]))
+
+    def test_master_connection_error(self, tmpdir, monkeypatch, capsys):
+        """
+        Check that the reason a master connection failed is reported
+        """
+        fake_ssh = tmpdir.join("bin", "ssh")
+        fake_ssh.write("#!/bin/sh\necho 'Permission denied' >&2\nexit 255\n",
+                       ensure=True)
+        fake_ssh.chmod(0o755)
+        monkeypatch.setenv("PATH", "{}:{}".format(fake_ssh.dirname,
+                                                  os.environ["PATH"]))
+
+        transport = SSHTransport("user@server")
+        with pytest.raises(subprocess.CalledProcessError) as excinfo:
+            transport.connect()
+        assert excinfo.value.output == "Permission denied"
+        assert "Permission denied" in capsys.readouterr().err
+        assert not transport.connected
+        transport.close()
+
+    @pytest.mark.skipif(shutil.which("rsync") is None,
+                        reason="rsync not installed")
+    def test_parallel_copy(self, tmpdir):
+        cats = tmpdir.mkdir("cats")
+        self.make_tree(cats, 20)
+        remote = tmpdir.join("remote")
+        handler = RemoteCatalogHandler("user", "server", str(remote),
+                                       str(tmpdir.join("remote_ncml")),
+                                       parallel=4, transport=LocalTransport())
+        handler.copy_to_server([str(cats)], [])
+        copied = [p.relto(remote) for p in remote.visit(fil=lambda p: p.isfile())]
+        expected = [p.relto(cats) for p in cats.visit(fil=lambda p: p.isfile())]
+        assert sorted(copied) == sorted(expected)
+
+    def test_delta_copy(self, tmpdir):
+        """
+        Check that only changed files are copied when a sync manifest is used,
+        and that orphans are detected
+        """
+        cats = tmpdir.mkdir("cats")
+        self.make_tree(cats, 6)
+        manifest_dir = str(tmpdir.join("manifests"))
+
+        handler = RecordingHandler("/remote/cats", "/remote/ncml",
+                                   manifest_dir=manifest_dir)
+        handler.copy_to_server([str(cats)], [])
+        rsyncs = [c for c in handler.commands if c[0] == "rsync"]
+        assert len(rsyncs) == 1
+        assert len(handler.get_manifest("/remote/cats").files) == 6
+
+        # Nothing has changed so nothing should be copied
+        handler.commands = []
+        handler.copy_to_server([str(cats)], [])
+        assert not [c for c in handler.commands if c[0] == "rsync"]
+
+        # Change one file and remove another
+        cats.join("1", "cat1.xml").write("changed")
+        cats.join("2", "cat2.xml").remove()
+        handler.commands = []
+        list_contents = []
+
+        def run_command(args):
+            handler.commands.append(args)
+            for arg in args:
+                if arg.startswith("--files-from="):
+                    with open(arg.split("=", 1)[1]) as f:
+                        list_contents.append(f.read().split())
+            return ""
+        handler.run_command = run_command
+
+        handler.copy_to_server([str(cats)], [])
+        assert list_contents == [["1/cat1.xml"]]
+        assert not [c for c in handler.commands if c[0] == "sh"]
+        assert "2/cat2.xml" in handler.get_manifest("/remote/cats").files
+
+        # Orphans are deleted in a single command when requested
+        handler.delete_orphans = True
+        handler.commands = []
+        handler.copy_to_server([str(cats)], [])
+        assert [c for c in handler.commands if c[0] == "sh"] == [
+            ["sh", "-c", "rm -fv -- /remote/cats/2/cat2.xml && "
+                         "{ rmdir -- /remote/cats/2 2>/dev/null; true; }"]
+        ]
+        assert "2/cat2.xml" not in handler.get_manifest("/remote/cats").files
+
+    def test_delete_prunes_parent_dirs(self, tmpdir):
+        remote_cats = tmpdir.mkdir("remote_cats")
+        remote_ncml = tmpdir.mkdir("remote_ncml")
+        remote_cats.join("a", "b", "c", "cat.xml").ensure()
+        remote_cats.join("a", "other.xml").ensure()
+        remote_cats.join("unrelated", "empty").ensure(dir=True)
+        remote_ncml.join("x", "agg.ncml").ensure()
+
+        handler = RemoteCatalogHandler("user", "server", str(remote_cats),
+                                       str(remote_ncml),
+                                       transport=LocalTransport())
+        assert handler.delete_from_server(["a/b/c/cat.xml"], ["x/agg.ncml"])
+        assert not remote_cats.join("a", "b").exists()
+        assert remote_cats.join("a", "other.xml").exists()
+        assert not remote_ncml.join("x").exists()
+        assert remote_ncml.exists()
+        # Empty directories elsewhere in the tree are not touched
+        assert remote_cats.join("unrelated", "empty").exists()
+
+        assert not handler.delete_from_server(["a/b/c/cat.xml"], [])
+
+    def test_retrieve_archive(self, tmpdir):
+        remote_cats = tmpdir.mkdir("remote_cats")
+        remote_ncml = tmpdir.mkdir("remote_ncml")
+        remote_cats.join("a", "cat1.xml").write("cat1", ensure=True)
+        remote_cats.join("b", "cat2.xml").write("cat2", ensure=True)
+        remote_ncml.join("a", "agg.ncml").write("agg", ensure=True)
+        handler = RemoteCatalogHandler("user", "server", str(remote_cats),
+                                       str(remote_ncml),
+                                       transport=LocalTransport())
+
+        for compress in (False, True):
+            out_dir = tmpdir.mkdir("out{}".format(int(compress)))
+            num_files, num_bytes, _ = handler.retrieve_archive(
+                ["a/cat1.xml", "b/cat2.xml"], ["a/agg.ncml"],
+                output_dir=str(out_dir), compress=compress
+            )
+            assert num_files == 3
+            assert num_bytes > 0
+            assert out_dir.join("remote_cats", "b", "cat2.xml").read() == "cat2"
+            assert out_dir.join("remote_ncml", "a", "agg.ncml").read() == "agg"
+
+        # Write archive to a file object
+        out = BytesIO()
+        handler.retrieve_archive(["a/cat1.xml"], ["a/agg.ncml"], out=out)
+        out.seek(0)
+        with tarfile.open(fileobj=out) as tar:
+            assert sorted(tar.getnames()) == ["remote_cats/a/cat1.xml",
+                                              "remote_ncml/a/agg.ncml"]
+
+        with pytest.raises(subprocess.CalledProcessError):
+            handler.retrieve_archive(["missing.xml"], [],
+                                     output_dir=str(tmpdir))
+
+    def test_verify(self, tmpdir):
+        local = tmpdir.mkdir("local")
+        self.make_tree(local, 4)
+        remote_cats = tmpdir.mkdir("remote_cats")
+        remote_ncml = tmpdir.mkdir("remote_ncml")
+        handler = RemoteCatalogHandler("user", "server", str(remote_cats),
+                                       str(remote_ncml),
+                                       transport=LocalTransport(),
+                                       manifest_dir=str(tmpdir.join("m")))
+
+        # Simulate a copy by populating the remote directory and manifest
+        local.copy(remote_cats)
+        manifest = handler.get_manifest(str(remote_cats))
+        manifest.update({p.relto(local): hash_file(str(p))
+                         for p in local.visit(fil=lambda p: p.isfile())})
+        manifest.save()
+        assert handler.verify_server()[str(remote_cats)] == ([], [], [])
+
+        remote_cats.join("0", "cat0.xml").write("drift")
+        remote_cats.join("1", "cat1.xml").remove()
+        remote_cats.join("extra.xml").write("new")
+        assert handler.verify_server()[str(remote_cats)] == (
+            ["0/cat0.xml"], ["1/cat1.xml"], ["extra.xml"]
+        )
+        assert handler.verify_server()[str(remote_ncml)] == ([], [], [])
+
+    def test_reinit_only_on_change(self, tmpdir):
+        """
+        Check that THREDDS is reinitialised once when the handler is closed,
+        and only if something changed
+        """
+        class ReinitHandler(RecordingHandler):
+            def __init__(self, outputs, *args, **kwargs):
+                super().__init__("/remote/cats", "/remote/ncml", *args,
+                                 reinit=True, **kwargs)
+                self.outputs = outputs
+                self.reinits = 0
+
+            def run_command(self, args):
+                super().run_command(args)
+                return self.outputs.get(args[0], "")
+
+            def reinit_server(self):
+                self.reinits += 1
+
+        cats = tmpdir.mkdir("cats")
+        self.make_tree(cats, 2)
+
+        # rsync only reports a directory mtime change
+        with ReinitHandler({"rsync": ".d..t...... ./\n"}) as handler:
+            assert not handler.copy_to_server([str(cats)], [])
+        assert handler.reinits == 0
+
+        with ReinitHandler({"rsync": ">f+++++++++ 0/cat0.xml\n",
+                            "sh": "removed '/remote/cats/a.xml'\n"}) as handler:
+            assert handler.copy_to_server([str(cats)], [])
+            assert handler.delete_from_server(["a.xml"], [])
+            assert handler.reinits == 0
+        assert handler.reinits == 1
+
+        # A change made without --reinit is carried over to a later handler
+        # through the state file
+        state_file = str(tmpdir.join("reinit_state"))
+        handler = ReinitHandler({"sh": "removed '/remote/cats/a.xml'\n"},
+                                reinit_state_file=state_file)
+        handler.reinit = False
+        with handler:
+            handler.delete_from_server(["a.xml"], [])
+        assert os.path.exists(state_file)
+        with ReinitHandler({}, reinit_state_file=state_file) as handler:
+            assert not handler.copy_to_server([str(cats)], [])
+        assert handler.reinits == 1
+        assert not os.path.exists(state_file)
+
+
+class TestCacheRemoteAggregations(object):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        requested = []
+
+        def do_GET(self):
+            self.requested.append(self.path)
+            status = 500 if "broken" in self.path else 200
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    @pytest.fixture
+    def server_url(self):
+        self.Handler.requested = []
+        server = self.Server(("127.0.0.1", 0), self.Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield "http://127.0.0.1:{}/thredds/".format(server.server_address[1])
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    def test_cache_aggregations(self, server_url):
+        ds_template = {"generate_aggregation": True, "include_in_wms": False,
+                       "tech_note_url": None, "tech_note_title": None,
+                       "files": []}
+        datasets = {
+            "ds.plain": dict(ds_template),
+            "ds.wms": dict(ds_template, include_in_wms=True),
+            "ds.noagg": dict(ds_template, generate_aggregation=False),
+            "ds.broken": dict(ds_template)
+        }
+        session = make_session(retries=0)
+        results = {dsid: errors for dsid, _, errors in
+                   cache_aggregations(datasets, server_url, concurrency=3,
+                                      session=session)}
+
+        assert set(results.keys()) == {"ds.plain", "ds.wms", "ds.broken"}
+        assert results["ds.plain"] == []
+        assert results["ds.wms"] == []
+        assert len(results["ds.broken"]) == 2
+        assert sorted(p for p in self.Handler.requested if "broken" not in p) == [
+            "/thredds/dodsC/ds.plain.das",
+            "/thredds/dodsC/ds.plain.dds",
+            "/thredds/dodsC/ds.wms.das",
+            "/thredds/dodsC/ds.wms.dds",
+            "/thredds/wms/ds.wms?service=WMS&version=1.3.0"
+            "&request=GetCapabilities"
+        ]
+
+
+class TestFindNcml(object):
+    catalog_template = """<?xml version="1.0" encoding="UTF-8"?>
+<catalog xmlns="http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0">
+  <dataset name="top">
+    <dataset name="file.nc" urlPath="esg_esacci/file.nc"/>
+    {}
+  </dataset>
+</catalog>
+"""
+    netcdf_template = (
+        '<dataset name="{0}" urlPath="{0}">'
+        '<netcdf xmlns="http://www.unidata.ucar.edu/namespaces/netcdf/ncml-2.2"'
+        ' location="/aggs/{0}.ncml"/></dataset>'
+    )
+
+    def write_catalog(self, path, dsids):
+        path.write(self.catalog_template.format(
+            "".join(self.netcdf_template.format(d) for d in dsids)
+        ), ensure=True)
+
+    def test_find_ncml(self, tmpdir):
+        cat_dir = tmpdir.mkdir("catalogs")
+        self.write_catalog(cat_dir.join("1", "a.xml"), ["a"])
+        self.write_catalog(cat_dir.join("1", "b.xml"), ["b1", "b2"])
+        self.write_catalog(cat_dir.join("catalog.xml"), [])
+        cat_dir.join("notes.txt").write("not a catalog")
+
+        parser = ThreddsXMLBase()
+        catalog = str(cat_dir.join("1", "a.xml"))
+        assert list(parser.iter_ncml_locations(catalog)) == ["/aggs/a.ncml"]
+
+        mapping = find_ncml([str(cat_dir)])
+        assert list(mapping.items()) == [
+            (str(cat_dir.join("catalog.xml")), []),
+            (str(cat_dir.join("1", "a.xml")), ["/aggs/a.ncml"]),
+            (str(cat_dir.join("1", "b.xml")), ["/aggs/b1.ncml", "/aggs/b2.ncml"]),
+        ]
+
+
+class TestBatchUnpublish(object):
+    class FakeGetter(object):
+        def __init__(self, locations, thredds_root, output_dir):
+            self.locations = locations
+            self.thredds_root = thredds_root
+            self.output_dir = output_dir
+            self.queries = []
+
+        def get_catalog_locations(self, ds_names):
+            self.queries.append(list(ds_names))
+            return {n: self.locations[n] for n in ds_names
+                    if n in self.locations}
+
+        def copy_top_level_catalog(self):
+            shutil.copy(os.path.join(self.thredds_root, "catalog.xml"),
+                        self.output_dir)
+
+    class CopyRecordingHandler(RemoteCatalogHandler):
+        def copy_to_server(self, catalog_paths, ncml_paths):
+            self.copied = catalog_paths
+            self.request_reinit()
+
+        def reinit_server(self):
+            self.reinits = getattr(self, "reinits", 0) + 1
+
+    def test_batch_unpublish(self, tmpdir):
+        remote_cats = tmpdir.mkdir("remote_cats")
+        remote_ncml = tmpdir.mkdir("remote_ncml")
+        catalog_dir = tmpdir.mkdir("catalogs")
+        ncml_dir = tmpdir.mkdir("ncml")
+        thredds_root = tmpdir.mkdir("thredds")
+        thredds_root.join("catalog.xml").write("new top level")
+
+        locations = {"ds.a.v1": "1/ds.a.v1.xml", "ds.b.v1": "2/ds.b.v1.xml",
+                     "ds.c.v1": "2/ds.c.v1.xml"}
+        catalogs = TestFindNcml()
+        for dsid, cat_path in locations.items():
+            ncml_path = "{}/{}.ncml".format(dsid.split(".")[1], dsid)
+            xml = catalogs.catalog_template.format(
+                catalogs.netcdf_template.format(ncml_path[:-5])
+            ).replace("/aggs/", str(remote_ncml) + "/")
+            remote_cats.join(cat_path).write(xml, ensure=True)
+            catalog_dir.join(cat_path).write(xml, ensure=True)
+            remote_ncml.join(ncml_path).write("agg", ensure=True)
+            ncml_dir.join(ncml_path).write("agg", ensure=True)
+        # One catalog is only available on the remote server
+        catalog_dir.join("2", "ds.c.v1.xml").remove()
+        catalog_dir.join("3", "unrelated.xml").write("keep", ensure=True)
+
+        getter = self.FakeGetter(locations, str(thredds_root), str(catalog_dir))
+        handler = self.CopyRecordingHandler("user", "server", str(remote_cats),
+                                            str(remote_ncml), reinit=True,
+                                            transport=LocalTransport())
+        unpublisher = BatchUnpublisher(getter, handler, str(catalog_dir),
+                                       str(ncml_dir))
+        with handler:
+            paths = unpublisher.find_paths(["ds.a.v1", "ds.c.v1", "ds.x.v1"])
+            assert getter.queries == [["ds.a.v1", "ds.c.v1", "ds.x.v1"]]
+            assert paths == {
+                "ds.a.v1": {"catalog": "1/ds.a.v1.xml",
+                            "ncml": ["a/ds.a.v1.ncml"]},
+                "ds.c.v1": {"catalog": "2/ds.c.v1.xml",
+                            "ncml": ["c/ds.c.v1.ncml"]}
+            }
+            unpublisher.remove(paths)
+
+        assert handler.reinits == 1
+        assert handler.copied == [str(catalog_dir.join("catalog.xml"))]
+        assert catalog_dir.join("catalog.xml").read() == "new top level"
+        for root in (catalog_dir, remote_cats):
+            assert not root.join("1").exists()
+            assert not root.join("2", "ds.c.v1.xml").exists()
+            assert root.join("2", "ds.b.v1.xml").exists()
+        for root in (ncml_dir, remote_ncml):
+            assert not root.join("a").exists()
+            assert not root.join("c").exists()
+            assert root.join("b", "ds.b.v1.ncml").exists()
+        assert catalog_dir.join("3", "unrelated.xml").exists()
+
+    def test_find_verbose_output(self, tmpdir, monkeypatch, capsys):
+        """
+        Check that the output of 'find' is valid JSON in verbose mode when a
+        catalog has to be retrieved from the server over SSH
+        """
+        remote_cats = tmpdir.mkdir("remote_cats")
+        remote_ncml = tmpdir.mkdir("remote_ncml")
+        catalogs = TestFindNcml()
+        xml = catalogs.catalog_template.format(
+            catalogs.netcdf_template.format("a/ds.a.v1")
+        ).replace("/aggs/", str(remote_ncml) + "/")
+        remote_cats.join("1", "ds.a.v1.xml").write(xml, ensure=True)
+
+        # Fake ssh that runs commands on the local machine
+        fake_ssh = tmpdir.join("bin", "ssh")
+        fake_ssh.write("\n".join([
+            "#!/bin/sh",
+            'case " $* " in *" -N "*|*" -O "*) exit 0;; esac',
+            'while [ "$1" != "--" ]; do shift; done',
+            'exec sh -c "$2"',
+            ""
+        ]), ensure=True)
+        fake_ssh.chmod(0o755)
+        monkeypatch.setenv("PATH", "{}:{}".format(fake_ssh.dirname,
+                                                  os.environ["PATH"]))
+
+        locations = {"ds.a.v1": "1/ds.a.v1.xml"}
+
+        class Getter(self.FakeGetter):
+            def __init__(self, esg_ini, output_dir):
+                super().__init__(locations, None, output_dir)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        monkeypatch.setattr(unpublish, "CatalogGetter", Getter)
+        monkeypatch.setattr(sys, "argv", [
+            "unpublish_catalogs", "-e", "esg.ini", "-v", "-s", "server",
+            "--catalog-dir", str(tmpdir.mkdir("catalogs")),
+            "--ncml-dir", str(tmpdir.mkdir("ncml")),
+            "--remote-catalog-dir", str(remote_cats),
+            "--remote-agg-dir", str(remote_ncml),
+            "find", "ds.a.v1"
+        ])
+        unpublish.main()
+
+        out, err = capsys.readouterr()
+        assert json.loads(out) == {
+            "ds.a.v1": {"catalog": "1/ds.a.v1.xml", "ncml": ["a/ds.a.v1.ncml"]}
+        }
+        assert "ControlMaster=yes" in err
+
+
+class TestPublish(object):
+    class FakeEsg(object):
+        def __init__(self, failing, wait_for=None):
+            self.failing = failing
+            self.wait_for = wait_for
+            self.calls = []
+
+        def check_vocab(self, ds_names):
+            self.calls.append(("checkvocab", tuple(ds_names)))
+            return True
+
+        def publish_db(self, mapfile):
+            dsid = os.path.basename(mapfile)
+            # Publishing the last dataset waits until the first has been
+            # modified, to check the two happen at the same time
+            if self.wait_for is not None and dsid == "ds.c.v1":
+                assert self.wait_for.wait(timeout=10)
+            self.calls.append(("db", dsid))
+            return dsid not in self.failing
+
+        def create_catalogs(self, mapfile):
+            self.calls.append(("thredds", os.path.basename(mapfile)))
+            return True
+
+        def thredds_reinit(self):
+            self.calls.append(("reinit",))
+            return True
+
+        def publish_solr(self, mapfile):
+            self.calls.append(("solr", os.path.basename(mapfile)))
+            return True
+
+    class FakeGetter(CatalogGetter):
+        def __init__(self, output_dir, ncml_dir, remote_agg_dir,
+                     thredds_root):
+            self.output_dir = output_dir
+            self.ncml_dir = ncml_dir
+            self.remote_agg_dir = remote_agg_dir
+            self.thredds_root = thredds_root
+            self.modified = []
+            self.first_modified = threading.Event()
+            self.lookups = []
+            self.closed = False
+
+        def get_catalog_locations(self, ds_names):
+            self.lookups.append(list(ds_names))
+            return {n: "1/{}.xml".format(n) for n in ds_names}
+
+        def close(self):
+            self.closed = True
+
+        def modify_catalog(self, cat_loc, info):
+            dsid = os.path.basename(cat_loc)[:-4]
+            path = os.path.join(self.output_dir, cat_loc)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            catalogs = TestFindNcml()
+            with open(path, "w") as f:
+                f.write(catalogs.catalog_template.format(
+                    catalogs.netcdf_template.format(dsid)
+                ).replace("/aggs/", self.remote_agg_dir))
+            ncml = os.path.join(self.ncml_dir, "{}.ncml".format(dsid))
+            with open(ncml, "w") as f:
+                f.write("agg")
+            self.modified.append((dsid, info["generate_aggregation"]))
+            self.first_modified.set()
+            return path
+
+        def copy_top_level_catalog(self):
+            with open(os.path.join(self.output_dir, "catalog.xml"), "w") as f:
+                f.write("top level")
+
+    class RecordingHandler(RemoteCatalogHandler):
+        def copy_relative(self, local_dir, rel_paths, dest):
+            self.copied = getattr(self, "copied", [])
+            self.copied += [os.path.join(dest, p) for p in rel_paths]
+            self.request_reinit()
+            return True
+
+        def copy_to_server(self, catalog_paths, ncml_paths):
+            self.final_copy = (catalog_paths, ncml_paths)
+            return False
+
+        def reinit_server(self):
+            self.reinits = getattr(self, "reinits", 0) + 1
+
+    class RecordingPublisher(Publisher):
+        def cache_aggregations(self, datasets):
+            self.cached = list(datasets.keys())
+            return self.cached
+
+        def fix_solr_links(self, ds_names):
+            self.fixed = ds_names
+
+    def write_csv(self, tmpdir, aggregate=("yes", "yes", "no")):
+        json_file = tmpdir.join("files.json")
+        files = [{"file": "/neodc/esacci/data.nc", "size": 1, "mtime": 1,
+                  "sha256": "a"}]
+        json_file.write(json.dumps({d: files for d in
+                                    ("ds.a.v1", "ds.b.v1", "ds.c.v1")}))
+        csv_file = tmpdir.join("datasets.csv")
+        csv_file.write("\n".join([",".join(HEADER_ROW)] + [
+            "{},1,url,title,{},no,{}".format(dsid, agg, json_file)
+            for dsid, agg in zip(("ds.a.v1", "ds.b.v1", "ds.c.v1"),
+                                 aggregate)
+        ]))
+        return str(csv_file)
+
+    def make_publisher(self, tmpdir, failing=(), wait=False, **kwargs):
+        catalog_dir = tmpdir.join("catalogs")
+        catalog_dir.ensure("1", dir=True)
+        ncml_dir = tmpdir.join("ncml")
+        ncml_dir.ensure(dir=True)
+        thredds_root = tmpdir.join("thredds")
+        for dsid in ("ds.a.v1", "ds.b.v1", "ds.c.v1"):
+            thredds_root.join("1", dsid + ".xml").write("original",
+                                                        ensure=True)
+        getter = self.FakeGetter(str(catalog_dir), str(ncml_dir), "/aggs/",
+                                 str(thredds_root))
+        esg = self.FakeEsg(failing=set(failing),
+                           wait_for=getter.first_modified if wait else None)
+        handler = self.RecordingHandler("user", "server", "/cats", "/aggs",
+                                        reinit=True,
+                                        transport=LocalTransport())
+        return self.RecordingPublisher(
+            esg, getter, handler, str(tmpdir.join("mapfiles")),
+            "http://server/thredds/", "http://solr:8984", **kwargs
+        )
+
+    def test_publish(self, tmpdir):
+        csv_file = self.write_csv(tmpdir)
+        publisher = self.make_publisher(tmpdir, failing={"ds.b.v1"},
+                                        wait=True)
+        esg = publisher.esg
+        getter = publisher.getter
+        handler = publisher.handler
+        catalog_dir = tmpdir.join("catalogs")
+        ncml_dir = tmpdir.join("ncml")
+        with handler:
+            publisher.run(csv_file)
+            # THREDDS is reinitialised before publishing to Solr
+            assert handler.reinits == 1
+
+        assert publisher.excluded == ["ds.b.v1"]
+        assert getter.modified == [("ds.a.v1", True), ("ds.c.v1", False)]
+        # Each catalog is looked up once, over a connection closed at the end
+        assert sorted(sum(getter.lookups, [])) == ["ds.a.v1", "ds.c.v1"]
+        assert getter.closed
+        assert sorted(handler.copied) == ["/aggs/ds.a.v1.ncml",
+                                          "/aggs/ds.c.v1.ncml",
+                                          "/cats/1/ds.a.v1.xml",
+                                          "/cats/1/ds.c.v1.xml"]
+        assert handler.final_copy == ([str(catalog_dir)], [str(ncml_dir)])
+        assert catalog_dir.join("catalog.xml").read() == "top level"
+        assert handler.reinits == 1
+
+        # Datasets are published in order, the top-level catalog is created
+        # after all have been published to the DB, and excluded datasets are
+        # not published to Solr
+        assert esg.calls == [
+            ("checkvocab", ("ds.a.v1", "ds.b.v1", "ds.c.v1")),
+            ("db", "ds.a.v1"), ("thredds", "ds.a.v1"), ("db", "ds.b.v1"),
+            ("db", "ds.c.v1"), ("thredds", "ds.c.v1"), ("reinit",),
+            ("solr", "ds.a.v1"), ("solr", "ds.c.v1")
+        ]
+        assert publisher.cached == ["ds.a.v1", "ds.c.v1"]
+        assert publisher.fixed == ["ds.a.v1", "ds.c.v1"]
+
+        mapfile = tmpdir.join("mapfiles", "ds", "a", "v1", "ds.a.v1")
+        assert mapfile.read().startswith("ds.a#1 | /neodc/esacci/data.nc")
+
+    def test_resume(self, tmpdir):
+        journal_file = str(tmpdir.join("journal.sqlite"))
+        csv_file = self.write_csv(tmpdir)
+
+        # The first run is interrupted after publishing to Solr
+        with StageJournal(journal_file, STAGES) as journal:
+            publisher = self.make_publisher(tmpdir, journal=journal)
+
+            def interrupt(ds_names):
+                raise KeyboardInterrupt()
+            publisher.fix_solr_links = interrupt
+            with pytest.raises(KeyboardInterrupt):
+                with publisher.handler:
+                    publisher.run(csv_file)
+            assert journal.completed("ds.a.v1") == list(STAGES[:-1])
+
+        # Resuming only fixes Solr links, and does not reinit THREDDS
+        with StageJournal(journal_file, STAGES) as journal:
+            publisher = self.make_publisher(tmpdir, journal=journal,
+                                            resume=True)
+            with publisher.handler:
+                publisher.run(csv_file)
+            assert publisher.esg.calls == [
+                ("checkvocab", ("ds.a.v1", "ds.b.v1", "ds.c.v1")),
+                ("reinit",)
+            ]
+            assert publisher.getter.modified == []
+            assert not hasattr(publisher.handler, "copied")
+            assert not hasattr(publisher.handler, "reinits")
+            assert publisher.cached == []
+            assert publisher.fixed == ["ds.a.v1", "ds.b.v1", "ds.c.v1"]
+
+        # Changing a dataset, or the catalog generated for another, repeats
+        # only the affected stages for those datasets
+        csv_file = self.write_csv(tmpdir, aggregate=("yes", "no", "no"))
+        with StageJournal(journal_file, STAGES) as journal:
+            publisher = self.make_publisher(tmpdir, journal=journal,
+                                            resume=True)
+            tmpdir.join("thredds", "1", "ds.c.v1.xml").write("regenerated")
+            with publisher.handler:
+                publisher.run(csv_file)
+            calls = publisher.esg.calls
+            assert ("db", "ds.b.v1") in calls
+            assert ("db", "ds.a.v1") not in calls
+            assert ("db", "ds.c.v1") not in calls
+            assert publisher.getter.modified == [("ds.b.v1", False),
+                                                 ("ds.c.v1", False)]
+            assert sorted(publisher.handler.copied) == [
+                "/aggs/ds.b.v1.ncml", "/aggs/ds.c.v1.ncml",
+                "/cats/1/ds.b.v1.xml", "/cats/1/ds.c.v1.xml"
+            ]
+            assert publisher.handler.reinits == 1
+            assert publisher.fixed == ["ds.b.v1", "ds.c.v1"]
+            for dsid in ("ds.a.v1", "ds.b.v1", "ds.c.v1"):
+                assert journal.completed(dsid) == list(STAGES)
+
+    def test_journal(self, tmpdir):
+        stages = ("one", "two", "three")
+        journal_file = str(tmpdir.join("journal.sqlite"))
+        with StageJournal(journal_file, stages) as journal:
+            journal.mark_done("ds", "one", "h1")
+            journal.mark_done("ds", "two", "h2")
+            journal.mark_done("ds", "three", "h3")
+            journal.mark_done("other", "one", "h1")
+
+        with StageJournal(journal_file, stages) as journal:
+            assert journal.is_done("ds", "two", "h2")
+            assert not journal.is_done("ds", "two", "changed")
+            assert not journal.is_done("ds", "unknown", "h2")
+
+            # Repeating a stage forgets the later ones, unless told not to
+            journal.mark_done("ds", "two", "h2", forget_later=False)
+            assert journal.completed("ds") == ["one", "two", "three"]
+            journal.mark_done("ds", "one", "new")
+            assert journal.completed("ds") == ["one"]
+            assert journal.is_done("ds", "one", "new")
+            assert journal.completed("other") == ["one"]
+
+        assert hash_inputs({"a": 1, "b": 2}) == hash_inputs({"b": 2, "a": 1})
+        assert hash_inputs({"files": FileList([])}) == \
+            hash_inputs({"files": []})
+        assert hash_inputs("a", "b") != hash_inputs("ab")
+
+        # Hashing a FileList piece by piece gives the same result as hashing
+        # the whole dataset serialised as JSON
+        files = [{"path": "/data/{}.nc".format(i), "size": i, "mtime": 1.5,
+                  "sha256": "{:064x}".format(i)} for i in range(3)]
+        ds = {"generate_aggregation": True, "files": FileList(files),
+              "nested": [None, ("x", {"y": 2})]}
+        whole = json.dumps(dict(ds, files=files), sort_keys=True,
+                           separators=(",", ":"))
+        expected = hashlib.sha256(whole.encode("utf-8") + b"\0").hexdigest()
+        assert hash_inputs(ds) == expected
+
+
+class TestShards(object):
+    num_files = {"ds.a.v1": 10, "ds.b.v1": 7, "ds.c.v1": 4, "ds.d.v1": 3,
+                 "ds.e.v1": 1}
+
+    def write_json(self, tmpdir):
+        json_file = tmpdir.join("datasets.json")
+        json_file.write(json.dumps({
+            dsid: {
+                "generate_aggregation": True,
+                "include_in_wms": False,
+                "tech_note_url": "url",
+                "tech_note_title": "title",
+                "files": [{"path": "/neodc/{}/{}.nc".format(dsid, i),
+                           "size": 1, "mtime": 1, "sha256": "a"}
+                          for i in range(n)]
+            } for dsid, n in self.num_files.items()
+        }))
+        return str(json_file)
+
+    def test_parse_shard(self):
+        assert parse_shard("0/1") == (0, 1)
+        assert parse_shard("2/3") == (2, 3)
+        for spec in ("3/3", "-1/3", "0/0", "1", "a/b", "1/2/3"):
+            with pytest.raises(argparse.ArgumentTypeError):
+                parse_shard(spec)
+
+    def test_assign_shards(self, tmpdir):
+        sizes = dataset_sizes([self.write_json(tmpdir)])
+        assert sorted(sizes) == sorted((n, d)
+                                       for d, n in self.num_files.items())
+        shards = assign_shards(sizes, 2)
+        # The assignment does not depend on the order of the input
+        assert assign_shards(list(reversed(sizes)), 2) == shards
+        assert shards == [["ds.a.v1", "ds.d.v1"],
+                          ["ds.b.v1", "ds.c.v1", "ds.e.v1"]]
+        # Shards with nothing to do are still included
+        assert len(assign_shards(sizes, 7)) == 7
+        assert assign_shards(sizes, 7)[5:] == [[], []]
+
+    def run_shard(self, json_file, index, count, shard_root, tmpdir):
+        getter = TestPublish.FakeGetter(None, None, "/aggs/",
+                                        str(tmpdir.join("thredds")))
+        getter.get_and_modify_shard([json_file], index, count, shard_root)
+
+    def test_sharded_get_catalogs(self, tmpdir):
+        json_file = self.write_json(tmpdir)
+        tmpdir.join("thredds", "catalog.xml").write("top level", ensure=True)
+        shard_root = str(tmpdir.join("shards"))
+        count = 3
+
+        # Run each shard in its own process, as on a batch cluster
+        ctx = multiprocessing.get_context("fork")
+        procs = [ctx.Process(target=self.run_shard,
+                             args=(json_file, i, count, shard_root, tmpdir))
+                 for i in range(count)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join(timeout=30)
+            assert proc.exitcode == 0
+
+        assignment = assign_shards(dataset_sizes([json_file]), count)
+        for i, ds_names in enumerate(assignment):
+            with open(os.path.join(shard_dir(shard_root, i, count),
+                                   "metrics.json")) as f:
+                metrics = json.load(f)
+            assert sorted(metrics["datasets"]) == ds_names
+            assert metrics["files"] == sum(self.num_files[d]
+                                           for d in ds_names)
+
+        # A shard that has not finished prevents the merge
+        catalog_dir = tmpdir.join("catalogs")
+        ncml_dir = tmpdir.join("ncml")
+        last_metrics = os.path.join(shard_dir(shard_root, 2, count),
+                                    "metrics.json")
+        os.rename(last_metrics, last_metrics + ".bak")
+        merged, problems = merge_shards(shard_root, assignment,
+                                        str(catalog_dir), str(ncml_dir))
+        assert merged is None
+        assert problems == ["shard 2/3 has not finished"]
+        assert not catalog_dir.exists()
+        os.rename(last_metrics + ".bak", last_metrics)
+
+        # ...as does missing output
+        missing = os.path.join(shard_dir(shard_root, 1, count), "ncml",
+                               assignment[1][0] + ".ncml")
+        os.rename(missing, missing + ".bak")
+        merged, problems = merge_shards(shard_root, assignment,
+                                        str(catalog_dir), str(ncml_dir))
+        assert problems == ["'{}' is missing".format(missing)]
+        assert not catalog_dir.exists()
+        os.rename(missing + ".bak", missing)
+
+        merged, problems = merge_shards(shard_root, assignment,
+                                        str(catalog_dir), str(ncml_dir))
+        assert problems == []
+        assert sorted(merged["datasets"]) == sorted(self.num_files)
+        assert merged["files"] == sum(self.num_files.values())
+        assert merged["num_shards"] == count
+        assert all("limit" in shard["io"] for shard in merged["shards"])
+        assert catalog_dir.join("catalog.xml").read() == "top level"
+        for dsid in self.num_files:
+            assert catalog_dir.join("1", dsid + ".xml").check(file=True)
+            assert ncml_dir.join(dsid + ".ncml").read() == "agg"
+            assert merged["datasets"][dsid]["ncml"] == [dsid + ".ncml"]
+        assert tmpdir.join("shards", "metrics.json").check(file=True)
+
+    def test_sharded_modify_catalogs(self, tmpdir):
+        dataset = '<dataset name="{0}" urlPath="{0}" serviceName="HTTPServer"/>'
+        catalogs = []
+        for i, n in enumerate([5, 1, 3, 2, 2]):
+            path = tmpdir.join("{}.xml".format(i))
+            path.write(TestFindNcml.catalog_template.format(
+                "".join(dataset.format("f{}.nc".format(j)) for j in range(n))
+            ))
+            catalogs.append(str(path))
+
+        assert ThreddsXMLBase().count_files(catalogs[0]) == 5
+
+        shards = [ProcessBatch(["--shard", "{}/2".format(i)] + catalogs)
+                  .shard_catalogs() for i in range(2)]
+        assert sorted(shards[0] + shards[1]) == sorted(catalogs)
+        assert shards == [[catalogs[0], catalogs[3]],
+                          [catalogs[1], catalogs[2], catalogs[4]]]
+        assert ProcessBatch(catalogs).shard_catalogs() == catalogs
+
+
+class FakeSolr(object):
+    """
+    In-memory stand-in for a pysolr.Solr instance
+    """
+    class Results(object):
+        def __init__(self, docs, next_cursor):
+            self.docs = docs
+            self.nextCursorMark = next_cursor
+
+    def __init__(self, docs):
+        self.docs = {doc["id"]: doc for doc in docs}
+        self.searches = []
+        self.updates = []
+        self.commits = 0
+
+    def matches(self, doc, fq):
+        """
+        Return True if a document matches a filter query (or list of filter
+        queries) of the form 'field:("value" OR "value" ...)' or
+        'field:(/regex/ OR /regex/ ...)'
+        """
+        if fq is None:
+            return True
+        if isinstance(fq, list):
+            return all(self.matches(doc, q) for q in fq)
+
+        field, values = re.match(r'(\w+):\((.*)\)$', fq).groups()
+        doc_values = doc.get(field)
+        if not isinstance(doc_values, list):
+            doc_values = [doc_values]
+
+        if values.startswith("/"):
+            regexes = [r.replace("\\/", "/")
+                       for r in re.findall(r'/((?:[^/\\]|\\.)*)/', values)]
+            return any(re.fullmatch(r, v) for r in regexes for v in doc_values)
+
+        values = [re.sub(r'\\(.)', r'\1', v)
+                  for v in re.findall(r'"((?:[^"\\]|\\.)*)"', values)]
+        return any(v in values for v in doc_values)
+
+    def search(self, q, rows=10, cursorMark="*", fl="*", sort=None, **kwargs):
+        assert sort == "id asc"
+        self.searches.append(dict(kwargs, q=q, rows=rows, fl=fl))
+        ids = sorted(i for i, doc in self.docs.items()
+                     if (cursorMark == "*" or i > cursorMark) and
+                     self.matches(doc, kwargs.get("fq")))
+        page = ids[:rows]
+        fields = fl.split(",")
+        # Copy values so that changes to results do not affect the index
+        docs = [{k: copy.deepcopy(v) for k, v in self.docs[i].items()
+                 if k in fields}
+                for i in page]
+        return self.Results(docs, page[-1] if page else cursorMark)
+
+    def add(self, docs, fieldUpdates=None, **kwargs):
+        self.updates.append((docs, fieldUpdates, kwargs))
+        for doc in docs:
+            for field, value in doc.items():
+                if field != "id":
+                    assert fieldUpdates[field] == "set"
+                    self.docs[doc["id"]][field] = value
+
+    def commit(self):
+        self.commits += 1
+
+
+class TestModifySolrLinks(object):
+    def make_docs(self, num_docs):
+        docs = []
+        for i in range(num_docs):
+            url = "http://tds/thredds/dodsC/ds{}.html|application/opendap-html|OPENDAP"
+            docs.append({
+                "id": "esacci.ds{:03d}".format(i),
+                "url": [url.format(i) if i % 2 else "http://x|text/html|HTTPServer"],
+                "title": "Dataset {}".format(i)
+            })
+        return docs
+
+    def test_query_all(self):
+        solr = FakeSolr(self.make_docs(25))
+        results = query_all(solr, "esacci", chunk=10)
+        assert isinstance(results, types.GeneratorType)
+        ids = [doc["id"] for doc in results]
+        assert ids == sorted(solr.docs.keys())
+        assert len(solr.searches) == 3
+        assert all(search["fl"] == "id,url" for search in solr.searches)
+
+    def test_query_output(self, capsys):
+        """
+        Check that a line is only printed for each page in verbose mode, and
+        that the number of results is printed once
+        """
+        solr = FakeSolr(self.make_docs(25))
+        list(query_all(solr, "esacci", chunk=10))
+        assert capsys.readouterr().out == "25 results found\n"
+
+        list(query_all(solr, "esacci", chunk=10, verbose=True))
+        lines = capsys.readouterr().out.splitlines()
+        assert len(lines) == 4
+        assert all(line.startswith("fetched ") for line in lines[:3])
+        assert lines[3] == "25 results found"
+
+        # Batches of values are reported as a single total
+        ids = sorted(solr.docs.keys())
+        list(query_by_values(solr, "id", ids, batch_size=5))
+        assert capsys.readouterr().out == "25 results found\n"
+
+    def test_targeted_update(self):
+        data_node = "|data.node"
+        datasets = FakeSolr([
+            {"id": "esacci.ds{}.v1{}".format(i, data_node),
+             "instance_id": "esacci.ds{}.v1".format(i), "url": []}
+            for i in range(5)
+        ] + [{"id": 'odd"name\\|node', "instance_id": 'odd"name\\',
+              "url": []}])
+        files = FakeSolr([
+            {"id": "esacci.ds{}.v1.f{}{}".format(i, j, data_node),
+             "dataset_id": "esacci.ds{}.v1{}".format(i, data_node), "url": []}
+            for i in range(5) for j in range(3)
+        ])
+        wanted = ["esacci.ds1.v1", "esacci.ds3.v1", "esacci.ds4.v1",
+                  'odd"name\\']
+        results = list(query_datasets_and_files(datasets, files, wanted,
+                                                batch_size=2))
+        dataset_docs = [doc["id"] for solr, doc in results if solr is datasets]
+        file_docs = [doc["id"] for solr, doc in results if solr is files]
+        assert sorted(dataset_docs) == sorted(
+            ["esacci.ds{}.v1{}".format(i, data_node) for i in (1, 3, 4)] +
+            ['odd"name\\|node']
+        )
+        assert sorted(file_docs) == sorted(
+            "esacci.ds{}.v1.f{}{}".format(i, j, data_node)
+            for i in (1, 3, 4) for j in range(3)
+        )
+        # Datasets and files were each looked up in two batches
+        assert len(datasets.searches) == 2
+        assert len(files.searches) == 2
+
+    def test_concurrent_jobs(self):
+        datasets = FakeSolr(self.make_docs(30))
+        files = FakeSolr([dict(doc, id=doc["id"] + ".file")
+                          for doc in self.make_docs(50)])
+        solrs = {"datasets": datasets, "files": files}
+        jobs = [(fix_core, (core, solr)) for core, solr in solrs.items()]
+        totals = run_jobs(jobs, solrs, concurrency=2, batch_size=10)
+        counts = {core: (total.updated, total.unchanged)
+                  for core, total in totals.items()}
+        assert counts == {"datasets": (15, 15), "files": (25, 25)}
+        assert datasets.commits == 1
+        assert files.commits == 1
+        assert all(kwargs["commit"] is False for solr in (datasets, files)
+                   for _, _, kwargs in solr.updates)
+
+    def test_prefilter(self):
+        """
+        Check that the filter query matches exactly the documents that
+        update_urls() changes
+        """
+        base = "http://tds/thredds/{}/ds"
+        entries = [
+            base.format("wms") + "|application/xml|WMS",
+            base.format("wms") + "?service=WMS|application/xml|WMS",
+            base.format("wcs") + "|application/xml|WCS",
+            base.format("wcs") + "?service=WCS|application/xml|WCS",
+            base.format("dodsC") + ".html|application/opendap|OPENDAP",
+            base.format("dodsC") + "|application/opendap-html|OPENDAP",
+            base.format("dodsC") + "|application/opendap|OPENDAP",
+            base.format("fileServer") + ".html|text/html|HTTPServer",
+        ]
+        docs = [{"id": str(i), "url": [entry]}
+                for i, entry in enumerate(entries)]
+        docs.append({"id": "mixed", "url": entries[1:4:2] + entries[6:]})
+        solr = FakeSolr(docs)
+
+        expected = set(doc["id"] for doc in copy.deepcopy(docs)
+                       if update_urls(doc))
+        assert expected == {"0", "2", "4", "5"}
+        matched = set(doc["id"] for doc in
+                      query_all(solr, filter_query=NEEDS_UPDATE_QUERY))
+        assert matched == expected
+
+    def test_dry_run(self):
+        solr = FakeSolr(self.make_docs(25))
+        before = {i: dict(doc, url=list(doc["url"]))
+                  for i, doc in solr.docs.items()}
+        jobs = [(fix_core, ("datasets", solr, True))]
+        totals = run_jobs(jobs, {"datasets": solr}, dry_run=True)
+        assert solr.updates == []
+        assert solr.commits == 0
+        assert solr.docs == before
+        assert totals["datasets"].updated == 12
+        # Only documents that need updating are retrieved
+        assert totals["datasets"].unchanged == 0
+        samples = totals["datasets"].samples
+        assert len(samples) == SolrUpdater.MAX_SAMPLES
+        assert samples[0] == (
+            "esacci.ds001", "url",
+            "http://tds/thredds/dodsC/ds1.html|application/opendap-html|OPENDAP",
+            "http://tds/thredds/dodsC/ds1|application/opendap|OPENDAP"
+        )
+        assert "12 to update" in totals["datasets"].summary()
+
+    def test_batched_updates(self):
+        solr = FakeSolr(self.make_docs(25))
+        updater = update_all(solr, query_all(solr, "esacci"), update_urls,
+                             batch_size=5)
+        assert (updater.updated, updater.unchanged) == (12, 13)
+        assert [len(docs) for docs, _, _ in solr.updates] == [5, 5, 2]
+        assert all(kwargs["commit"] is False for _, _, kwargs in solr.updates)
+        assert solr.commits == 1
+        assert "12 updated, 13 unchanged" in updater.summary()
+
+        # Nothing to change on a second pass
+        updater = update_all(solr, query_all(solr, "esacci"), update_urls,
+                             commit_within=1000)
+        assert (updater.updated, updater.unchanged) == (0, 25)
+        assert solr.commits == 1
+
+        # Fields other than the URL are preserved
+        assert solr.docs["esacci.ds001"] == {
+            "id": "esacci.ds001",
+            "url": ["http://tds/thredds/dodsC/ds1|application/opendap|OPENDAP"],
+            "title": "Dataset 1"
+        }
+
+
+class TestImports(object):
+    """
+    Check that lightweight console scripts do not import slow scientific
+    libraries that they do not need
+    """
+    # Modules that should only be imported when aggregations are created
+    heavy_modules = {"netCDF4", "numpy", "tds_utils", "isodate"}
+
+    # Map module containing an entry point to additional modules it should
+    # not import
+    entry_points = {
+        "esacci_esgf.cache_remote_aggregations": {"psycopg2", "pysolr"},
+        "esacci_esgf.find_ncml": {"psycopg2", "requests", "pysolr"},
+        "esacci_esgf.get_catalog_path": {"psycopg2", "requests", "pysolr"},
+        "esacci_esgf.get_catalogs": {"psycopg2", "requests", "pysolr"},
+        "esacci_esgf.modify_catalogs": {"psycopg2", "requests", "pysolr"},
+        "esacci_esgf.publish": {"psycopg2", "requests", "pysolr"},
+        "esacci_esgf.shards": {"psycopg2", "requests", "pysolr"},
+        "esacci_esgf.transfer_catalogs": {"psycopg2", "requests", "pysolr"},
+        "esacci_esgf.unpublish": {"psycopg2", "requests", "pysolr"},
+        "esacci_esgf.input.make_mapfiles": {"psycopg2", "requests", "pysolr"},
+        "esacci_esgf.input.merge_csv_json": {"psycopg2", "requests", "pysolr"},
+        "esacci_esgf.input.manifest": {"psycopg2", "requests", "pysolr"},
+        "esacci_esgf.input.parse_esg_ini": {"psycopg2", "requests", "pysolr"},
+        "esacci_esgf.input.remove_key": {"psycopg2", "requests", "pysolr"},
+    }
+
+    def imported_modules(self, module):
+        """
+        Import a module in a fresh interpreter and return the names of all
+        top-level packages that end up imported
+        """
+        code = "import sys, {}; print('\\n'.join(sys.modules))".format(module)
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output([sys.executable, "-c", code],
+                                         cwd=package_root)
+        return set(name.split(".")[0] for name in output.decode().split())
+
+    def test_entry_point_imports(self):
+        for module, forbidden in self.entry_points.items():
+            imported = self.imported_modules(module)
+            unexpected = imported & (self.heavy_modules | forbidden)
+            assert not unexpected, "{} imports {}".format(module, unexpected)
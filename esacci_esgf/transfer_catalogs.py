@@ -8,14 +8,198 @@ import sys
 import os
 import subprocess
 import argparse
+import shlex
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
+from esacci_esgf.partition import split_by_size
+from esacci_esgf.sync_manifest import SyncManifest, hash_file, scan_sources
+
+
+def write_file_list(list_dir, paths):
+    """
+    Write a list of paths to a new file in `list_dir' for use with rsync's
+    --files-from option, and return the path to the file
+    """
+    fd, list_file = tempfile.mkstemp(dir=list_dir, suffix=".txt")
+    with os.fdopen(fd, "w") as f:
+        f.write("\n".join(paths) + "\n")
+    return list_file
+
+
+def parent_dirs(root_dir, paths):
+    """
+    Return the directories strictly below `root_dir' that contain any of the
+    given paths, directly or indirectly. Deeper directories come first, so
+    that each directory appears before its parent
+    """
+    root_dir = os.path.normpath(root_dir)
+    dirs = set()
+    for path in paths:
+        parent = os.path.dirname(os.path.normpath(path))
+        while parent.startswith(os.path.join(root_dir, "")) and \
+                parent not in dirs:
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+    return sorted(dirs, key=lambda d: (-d.count(os.sep), d))
+
+
+class CountingReader(object):
+    """
+    Wrapper around a binary file object that counts the bytes read from it
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class SSHTransport(object):
+    """
+    Class to build command lines that run commands on, and copy files to, a
+    remote machine over SSH.
+
+    If `multiplex' is True, a single master SSH connection is opened by
+    connect() and shared by all ssh and rsync commands until close() is
+    called, so that only one SSH handshake is required.
+    """
+    # Number of seconds the master connection stays open after the last
+    # command if close() is never called
+    CONTROL_PERSIST = 600
+
+    def __init__(self, host_spec, multiplex=True):
+        self.host_spec = host_spec
+        self.multiplex = multiplex
+        self.control_dir = None
+        self.connected = False
+        # Number of SSH connections made (or that would be made in dry-run
+        # mode)
+        self.handshakes = 0
+        self.lock = threading.Lock()
+
+    def ssh_options(self):
+        """
+        Return options to pass to ssh to use the master connection
+        """
+        if not self.multiplex:
+            return []
+        if self.control_dir is None:
+            self.control_dir = tempfile.mkdtemp(prefix="esacci-ssh-")
+        return ["-o", "ControlPath={}".format(os.path.join(self.control_dir,
+                                                           "master"))]
+
+    def connect(self, verbose=False):
+        """
+        Open the master connection if multiplexing and it is not already open
+        """
+        with self.lock:
+            if not self.multiplex or self.connected:
+                return
+            args = (["ssh", "-f", "-N", "-o", "ControlMaster=yes", "-o",
+                     "ControlPersist={}".format(self.CONTROL_PERSIST)] +
+                    self.ssh_options() + [self.host_spec])
+            if verbose:
+                print(" ".join(args), file=sys.stderr)
+            # Capture errors in a file rather than a pipe, since the master
+            # keeps its stderr open after going into the background
+            with tempfile.TemporaryFile() as err_file:
+                returncode = subprocess.call(args, stdout=subprocess.DEVNULL,
+                                             stderr=err_file)
+                if returncode != 0:
+                    err_file.seek(0)
+                    error = err_file.read().decode(errors="replace").strip()
+                    print("ERROR: could not open SSH connection to '{}': {}"
+                          .format(self.host_spec, error), file=sys.stderr)
+                    raise subprocess.CalledProcessError(returncode, args,
+                                                        output=error)
+            self.connected = True
+            self.handshakes += 1
+
+    def close(self):
+        """
+        Close the master connection if it is open
+        """
+        with self.lock:
+            if self.connected:
+                args = (["ssh"] + self.ssh_options() +
+                        ["-O", "exit", self.host_spec])
+                subprocess.call(args, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.DEVNULL)
+                self.connected = False
+            if self.control_dir is not None:
+                shutil.rmtree(self.control_dir, ignore_errors=True)
+                self.control_dir = None
+
+    def remote_path(self, path):
+        """
+        Return the rsync destination for a path on the remote machine
+        """
+        return "{}:{}".format(self.host_spec, path)
+
+    def command(self, args):
+        """
+        Return the local command line that runs `args' on the remote machine
+        """
+        if not self.multiplex:
+            self.handshakes += 1
+        # The remote shell re-parses the command, so arguments must be quoted
+        command = " ".join(shlex.quote(arg) for arg in args)
+        return ["ssh"] + self.ssh_options() + [self.host_spec, "--", command]
+
+    def rsync_options(self):
+        """
+        Return extra options to pass to rsync
+        """
+        if not self.multiplex:
+            self.handshakes += 1
+            return []
+        ssh_command = ["ssh"] + self.ssh_options()
+        return ["-e", " ".join(shlex.quote(arg) for arg in ssh_command)]
+
+
+class LocalTransport(object):
+    """
+    Stand-in for SSHTransport that treats the local machine as the remote
+    machine. Useful for testing
+    """
+    handshakes = 0
+
+    def connect(self, verbose=False):
+        pass
+
+    def close(self):
+        pass
+
+    def remote_path(self, path):
+        return path
+
+    def command(self, args):
+        return list(args)
+
+    def rsync_options(self):
+        return []
 
 
 class RemoteCatalogHandler(object):
+    """
+    Class to manage content on the remote server. This should be used as a
+    context manager (or close() should be called when finished) so that any
+    shared SSH connection is closed
+    """
     def __init__(self, user, server, remote_catalog_dir, remote_agg_dir,
                  verbose=False, dry_run=False, reinit=False,
-                 thredds_credentials=None):
+                 thredds_credentials=None, parallel=1, transport=None,
+                 multiplex=True, manifest_dir=None, delete_orphans=False,
+                 reinit_state_file=None):
         self.hostname = server
         self.host_spec = "{}@{}".format(user, self.hostname)
         self.remote_agg_dir = remote_agg_dir
@@ -24,6 +208,42 @@ class RemoteCatalogHandler(object):
         self.dry_run = dry_run
         self.reinit = reinit
         self.thredds_credentials = thredds_credentials
+        # Maximum number of rsync processes to run at once when copying
+        self.parallel = parallel
+        self.transport = transport or SSHTransport(self.host_spec,
+                                                   multiplex=multiplex)
+        # Directory in which to keep a record of the files copied to each
+        # remote root. If this is None, every file is passed to rsync on each
+        # copy
+        self.manifest_dir = manifest_dir
+        self.delete_orphans = delete_orphans
+        # Reinit is done once when the handler is closed, and only if content
+        # on the server has changed. If `reinit_state_file' is given, the need
+        # for a reinit is recorded in this file so that it can be carried out
+        # by a later handler (e.g. in a later step of the same pipeline)
+        self.reinit_state_file = reinit_state_file
+        self.reinit_pending = False
+        self.session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def connect(self):
+        """
+        Make sure the transport is ready before running remote commands
+        """
+        if not self.dry_run:
+            self.transport.connect(verbose=self.verbose)
+
+    def close(self):
+        self.transport.close()
+        self.flush_reinit()
+        if self.verbose:
+            print("SSH handshakes: {}".format(self.transport.handshakes),
+                  file=sys.stderr)
 
     def run_command(self, args):
         """
@@ -31,26 +251,77 @@ class RemoteCatalogHandler(object):
         exception if the child process returns a non-zero exit status
         """
         if self.verbose:
-            print(" ".join(args))
+            print(" ".join(args), file=sys.stderr)
         if self.dry_run:
             return None
 
         output = subprocess.check_output(args, stderr=subprocess.DEVNULL)
         return output.decode()
 
-    def rsync(self, src, dest):
+    def rsync(self, sources, dest, files_from=None):
         """
-        Use rsync to copy src to dest on the remote machine
+        Use rsync to copy one or more sources to dest on the remote machine in
+        a single transfer. If `files_from' is given, it is the path to a file
+        listing paths relative to the (single) source directory to copy.
+
+        Return True if any files were created or updated on the remote machine
         """
-        remote_dest = "{}:{}".format(self.host_spec, dest)
-        args = ["-a", src, remote_dest]
-        self.run_command(["rsync"] + args)
+        if isinstance(sources, str):
+            sources = [sources]
+        self.connect()
+        args = ["-a", "--itemize-changes"] + self.transport.rsync_options()
+        if files_from is not None:
+            args.append("--files-from={}".format(files_from))
+        args += list(sources) + [self.transport.remote_path(dest)]
+        output = self.run_command(["rsync"] + args)
+        if output is None:
+            # Assume something would have changed in dry-run mode
+            return True
+        # The first character of each line is '.' if only attributes of a file
+        # changed (e.g. a directory's mtime), and something else if the file
+        # was transferred or created
+        return any(line[0] != "." for line in output.splitlines() if line)
 
     def remote_command(self, args):
         """
         Run a command on the remote machine via SSH
         """
-        return self.run_command(["ssh", self.host_spec, "--"] + args)
+        self.connect()
+        return self.run_command(self.transport.command(args))
+
+    def request_reinit(self):
+        """
+        Note that content on the server has changed so that THREDDS is
+        re-initialised when the handler is closed
+        """
+        self.reinit_pending = True
+        if self.reinit_state_file is not None and not self.reinit:
+            with open(self.reinit_state_file, "w"):
+                pass
+
+    def flush_reinit(self):
+        """
+        Re-initialise THREDDS if reinit is enabled and changes have been made
+        since the last reinit, either by this handler or by one that shared
+        the same state file
+        """
+        pending = self.reinit_pending
+        if self.reinit_state_file is not None:
+            pending = pending or os.path.exists(self.reinit_state_file)
+
+        if not self.reinit or not pending:
+            if self.reinit and self.verbose:
+                print("No changes on server: skipping THREDDS reinit",
+                      file=sys.stderr)
+            return
+
+        self.reinit_server()
+        self.reinit_pending = False
+        if self.reinit_state_file is not None and not self.dry_run:
+            try:
+                os.remove(self.reinit_state_file)
+            except FileNotFoundError:
+                pass
 
     def reinit_server(self):
         """
@@ -58,14 +329,23 @@ class RemoteCatalogHandler(object):
         """
         url = ("http://{hostname}/thredds/admin/debug/?catalogs/reinit"
                .format(hostname=self.hostname))
-        response = requests.get(url, auth=self.thredds_credentials)
+        if self.verbose:
+            print("GET {}".format(url), file=sys.stderr)
+        if self.dry_run:
+            return
+
+        if self.session is None:
+            from esacci_esgf.http_session import make_session
+            self.session = make_session(auth=self.thredds_credentials)
+        response = self.session.get(url)
         if response.status_code != 200:
             sys.stderr.write("WARNING: THREDDS reinit failed with status code "
                              "{}\n".format(response.status_code))
 
     def copy_to_server(self, catalog_paths, ncml_paths):
         """
-        Copy catalogs and NcML files at the given paths to the remote server
+        Copy catalogs and NcML files at the given paths to the remote server.
+        Return True if anything on the server changed
         """
         # Ensure directory to place catalogs in exists on the remote machine
         self.remote_command(["mkdir", "-p", self.remote_catalog_dir])
@@ -75,45 +355,276 @@ class RemoteCatalogHandler(object):
         def normalise_path(p):
             return p + "/" if os.path.isdir(p) and not p.endswith("/") else p
 
-        # Build a list of (src, dest) to use with rsync
-        transfers = []
+        # Group sources by destination so that a single rsync can be run for
+        # each remote root
+        transfers = OrderedDict()
         for path in catalog_paths:
-            transfers.append((normalise_path(path), self.remote_catalog_dir))
+            transfers.setdefault(self.remote_catalog_dir, []).append(
+                normalise_path(path)
+            )
         for path in ncml_paths:
-            transfers.append((normalise_path(path), self.remote_agg_dir))
+            transfers.setdefault(self.remote_agg_dir, []).append(
+                normalise_path(path)
+            )
+
+        with tempfile.TemporaryDirectory() as list_dir:
+            jobs = []
+            deltas = []
+            for dest, sources in transfers.items():
+                if self.manifest_dir is not None:
+                    delta = self.delta_transfer(sources, dest, list_dir)
+                    jobs += delta[0]
+                    deltas.append(delta[1:])
+                elif self.parallel > 1:
+                    jobs += self.split_transfer(sources, dest, list_dir)
+                else:
+                    jobs.append((sources, dest, None))
+            changed = self.run_rsync_jobs(jobs)
+
+        if deltas:
+            changed = self.finish_delta_transfer(deltas) or changed
+
+        if changed:
+            self.request_reinit()
+        return changed
+
+    def copy_relative(self, local_dir, rel_paths, dest):
+        """
+        Copy files given by paths relative to `local_dir' to the same paths
+        relative to `dest' on the remote server, in a single transfer. This
+        allows some files in a tree to be copied before the rest of the tree
+        is complete. Return True if anything on the server changed
+        """
+        if not rel_paths:
+            return False
+        with tempfile.TemporaryDirectory() as list_dir:
+            list_file = write_file_list(list_dir, rel_paths)
+            changed = self.rsync([os.path.join(local_dir, "")], dest,
+                                 files_from=list_file)
+        if changed:
+            self.request_reinit()
+        return changed
+
+    def get_manifest(self, remote_dir):
+        return SyncManifest.for_remote(self.manifest_dir, self.hostname,
+                                       remote_dir)
+
+    def delta_transfer(self, sources, dest, list_dir):
+        """
+        Compare the files in `sources' to the manifest for `dest', and return
+        (jobs, dest, manifest, hashes, orphans), where `jobs' is a list of
+        rsync jobs as for split_transfer() that copy only new or changed
+        files, `hashes' maps the relative path of each copied file to its
+        checksum, and `orphans' is a list of files in the manifest that no
+        longer exist locally.
 
-        for src, dest in transfers:
-            self.rsync(src, dest)
+        Orphans are only looked for under directories in `sources', since
+        individual files do not say anything about what else should exist on
+        the remote machine
+        """
+        manifest = self.get_manifest(dest)
+        local_files = scan_sources(sources)
+        hashes = {rel_path: hash_file(path)
+                  for rel_path, (_, path) in local_files.items()}
+        changed = manifest.changed(hashes)
+
+        # Group changed files by the local directory they are relative to,
+        # so that one rsync (or self.parallel rsyncs) is run for each
+        by_base = OrderedDict()
+        for rel_path in changed:
+            base, path = local_files[rel_path]
+            by_base.setdefault(base, []).append((os.path.getsize(path),
+                                                 rel_path))
+
+        jobs = []
+        for base, files in by_base.items():
+            for chunk in split_by_size(files, max(self.parallel, 1)):
+                jobs.append(([os.path.join(base, "")], dest,
+                             write_file_list(list_dir, chunk)))
+
+        # Directory sources copy a whole tree to `dest', or to a subdirectory
+        # of `dest' if the path does not end with '/'
+        prefixes = [
+            os.path.join(os.path.relpath(src, os.path.dirname(src)), "")
+            if not src.endswith("/") else ""
+            for src in sources if os.path.isdir(src)
+        ]
+        orphans = [p for p in manifest.orphans(hashes)
+                   if any(p.startswith(prefix) for prefix in prefixes)]
+
+        return (jobs, dest, manifest,
+                {rel_path: hashes[rel_path] for rel_path in changed}, orphans)
+
+    def finish_delta_transfer(self, deltas):
+        """
+        Record copied files in the manifests after a delta transfer, and report
+        or delete orphaned files. `deltas' is a list of (dest, manifest,
+        hashes, orphans) as returned by delta_transfer().
+
+        Return True if any orphans were deleted
+        """
+        orphan_paths = []
+        for dest, manifest, hashes, orphans in deltas:
+            if self.verbose:
+                print("{}: {} changed file(s), {} orphan(s)"
+                      .format(dest, len(hashes), len(orphans)),
+                      file=sys.stderr)
+            manifest.update(hashes)
+            if not orphans:
+                continue
+            if self.delete_orphans:
+                orphan_paths += [os.path.join(dest, p) for p in orphans]
+                manifest.remove(orphans)
+            else:
+                sys.stderr.write("WARNING: Files under {} on the remote "
+                                 "server no longer exist locally:\n"
+                                 .format(dest))
+                for rel_path in orphans:
+                    sys.stderr.write("  {}\n".format(rel_path))
+
+        deleted = False
+        if orphan_paths:
+            roots = [dest for dest, _, _, _ in deltas]
+            deleted = self.remove_files(orphan_paths, roots=roots)
+
+        if not self.dry_run:
+            for _, manifest, _, _ in deltas:
+                manifest.save()
+        return deleted
+
+    def split_transfer(self, sources, dest, list_dir):
+        """
+        Split a transfer of `sources' to `dest' into at most self.parallel
+        rsync jobs per source directory, balanced by total file size. Lists of
+        files for each job are written in `list_dir'.
+
+        Return a list of (sources, dest, files_from) for use with rsync()
+        """
+        jobs = []
+        plain_sources = []
+        for src in sources:
+            if not os.path.isdir(src):
+                plain_sources.append(src)
+                continue
+
+            files = []
+            for dirpath, _, filenames in os.walk(src):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    files.append((os.path.getsize(path),
+                                  os.path.relpath(path, src)))
+            if not files:
+                jobs.append(([src], dest, None))
+                continue
 
-        if self.reinit:
-            self.reinit_server()
+            for chunk in split_by_size(files, self.parallel):
+                jobs.append(([src], dest, write_file_list(list_dir, chunk)))
+
+        if plain_sources:
+            jobs.append((plain_sources, dest, None))
+        return jobs
+
+    def run_rsync_jobs(self, jobs):
+        """
+        Run rsync for each (sources, dest, files_from) in `jobs', running up
+        to self.parallel jobs at once. Return True if any job changed files on
+        the remote machine
+        """
+        if self.parallel <= 1 or len(jobs) <= 1:
+            # Note that every job must be run, so any() cannot be used on a
+            # generator here
+            return any([self.rsync(*job) for job in jobs])
+
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            futures = [executor.submit(self.rsync, *job) for job in jobs]
+            # Wait for all jobs to finish before raising any exceptions
+            errors = [f.exception() for f in futures]
+        for error in errors:
+            if error is not None:
+                raise error
+        return any(f.result() for f in futures)
+
+    def remove_files(self, paths, roots=()):
+        """
+        Delete files on the remote machine, and return True if any existed.
+
+        Directories that are left empty are also deleted, up to (but not
+        including) whichever directory in `roots' contains them. Only the
+        parent directories of the deleted files are checked, and everything
+        is done with a single remote command
+        """
+        paths = list(paths)
+        dirs = []
+        for root in roots:
+            dirs += parent_dirs(root, paths)
+
+        script = "rm -fv -- {}".format(" ".join(map(shlex.quote, paths)))
+        if dirs:
+            # rmdir fails for directories that are not empty: ignore this
+            script += " && {{ rmdir -- {} 2>/dev/null; true; }}".format(
+                " ".join(map(shlex.quote, dirs))
+            )
+        output = self.remote_command(["sh", "-c", script])
+        # In dry-run mode assume that files would have been deleted
+        return output is None or bool(output.strip())
 
     def delete_from_server(self, catalog_paths, ncml_paths):
         """
-        Delete catalogs and NcML files from the remote server
+        Delete catalogs and NcML files from the remote server. Return True if
+        any of the files existed
         """
         def prepend_path(prefix):
             return lambda p: os.path.join(prefix, p)
 
-        command = ["rm", "-f", "--"]
-        command += list(map(prepend_path(self.remote_catalog_dir), catalog_paths))
-        command += list(map(prepend_path(self.remote_agg_dir), ncml_paths))
-        self.remote_command(command)
+        paths = list(map(prepend_path(self.remote_catalog_dir), catalog_paths))
+        paths += list(map(prepend_path(self.remote_agg_dir), ncml_paths))
+        changed = self.remove_files(paths, roots=[self.remote_catalog_dir,
+                                                  self.remote_agg_dir])
 
-        self.delete_empty_dirs(self.remote_catalog_dir)
-        self.delete_empty_dirs(self.remote_agg_dir)
+        if self.manifest_dir is not None and not self.dry_run:
+            for root, paths in ((self.remote_catalog_dir, catalog_paths),
+                                (self.remote_agg_dir, ncml_paths)):
+                if paths:
+                    manifest = self.get_manifest(root)
+                    manifest.remove(os.path.normpath(p) for p in paths)
+                    manifest.save()
 
-        if self.reinit:
-            self.reinit_server()
+        if changed:
+            self.request_reinit()
+        return changed
 
-    def delete_empty_dirs(self, root_dir):
+    def verify_server(self):
         """
-        Find and delete empty directory trees on the remote server under the
-        given root directory
+        Compute checksums of all files under the remote catalog and
+        aggregation roots in a single SSH command, and compare them to the
+        manifests of copied files.
+
+        Return a dictionary mapping each root to (modified, missing,
+        untracked) lists of relative paths, as for SyncManifest.verify()
         """
-        # Note that the root dir itself will not be deleted
-        self.remote_command(["find", root_dir, "-mindepth", "1", "-type", "d",
-                             "-empty", "-delete"])
+        roots = [os.path.normpath(d) for d in (self.remote_catalog_dir,
+                                               self.remote_agg_dir)]
+        output = self.remote_command(["find"] + roots + [
+            "-type", "f", "-exec", "sha256sum", "{}", "+"
+        ])
+        if output is None:
+            return {}
+
+        # Match the deepest root first in case one root contains the other
+        remote_hashes = {root: {} for root in roots}
+        search_order = sorted(roots, key=len, reverse=True)
+        for line in output.splitlines():
+            # sha256sum separates the checksum and filename with two
+            # characters
+            checksum = line.split(None, 1)[0]
+            path = line[len(checksum) + 2:]
+            for root in search_order:
+                if path.startswith(os.path.join(root, "")):
+                    remote_hashes[root][os.path.relpath(path, root)] = checksum
+                    break
+
+        return {root: self.get_manifest(root).verify(remote_hashes[root])
+                for root in roots}
 
     def retrieve_file(self, path):
         """
@@ -121,6 +632,71 @@ class RemoteCatalogHandler(object):
         """
         return self.remote_command(["cat", path])
 
+    def archive_command(self, catalog_paths, ncml_paths, compress=False):
+        """
+        Return a command to run on the remote server that writes a tar
+        archive of the given catalogs and NcML files to stdout. Paths are
+        relative to the catalog and aggregation roots, and are stored in the
+        archive under the base name of the corresponding root
+        """
+        command = ["tar", "-czf" if compress else "-cf", "-"]
+        for root, paths in ((self.remote_catalog_dir, catalog_paths),
+                            (self.remote_agg_dir, ncml_paths)):
+            if not paths:
+                continue
+            root = os.path.normpath(root)
+            command += ["-C", os.path.dirname(root)]
+            command += [os.path.join(os.path.basename(root),
+                                     os.path.normpath(p)) for p in paths]
+        return command
+
+    def retrieve_archive(self, catalog_paths, ncml_paths, output_dir=None,
+                         out=None, compress=False):
+        """
+        Retrieve any number of catalogs and NcML files with a single remote
+        command. The files are streamed through tar, and either extracted
+        under `output_dir' (in subdirectories named after the remote roots),
+        or written to the binary file object `out' as a tar archive.
+
+        Return (number of files, number of bytes transferred, seconds taken)
+        """
+        args = self.transport.command(
+            self.archive_command(catalog_paths, ncml_paths, compress=compress)
+        )
+        self.connect()
+        if self.verbose:
+            print(" ".join(args), file=sys.stderr)
+        if self.dry_run:
+            return 0, 0, 0
+
+        start = time.time()
+        num_files = 0
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+        stream = CountingReader(proc.stdout)
+        try:
+            if output_dir is None:
+                shutil.copyfileobj(stream, out)
+            else:
+                # Mode 'r|*' reads the archive as a stream and detects any
+                # compression
+                with tarfile.open(fileobj=stream, mode="r|*") as tar:
+                    for member in tar:
+                        name = os.path.normpath(member.name)
+                        if os.path.isabs(name) or name.startswith(".."):
+                            raise ValueError("Refusing to extract '{}' from "
+                                             "archive".format(member.name))
+                        if not (member.isfile() or member.isdir()):
+                            continue
+                        tar.extract(member, output_dir)
+                        num_files += member.isfile()
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, args)
+
+        return num_files, stream.bytes_read, time.time() - start
+
     def retrieve_catalog(self, path):
         return self.retrieve_file(os.path.join(self.remote_catalog_dir, path))
 
@@ -161,9 +737,46 @@ def main():
         "--reinit",
         action="store_true",
         default=False,
-        help="Reinitialise THREDDS catalogs after copy or delete operations "
+        help="Reinitialise THREDDS catalogs after copy or delete operations, "
+             "if anything on the server changed [default: %(default)s]"
+    )
+    parser.add_argument(
+        "--no-multiplex",
+        dest="multiplex",
+        action="store_false",
+        default=True,
+        help="Open a new SSH connection for every remote command, instead of "
+             "sharing a single connection"
+    )
+    parser.add_argument(
+        "-p", "--parallel",
+        type=int,
+        default=1,
+        help="When copying, split each directory into up to this many "
+             "chunks and run an rsync for each chunk concurrently "
              "[default: %(default)s]"
     )
+    parser.add_argument(
+        "--sync-manifest-dir",
+        help="Directory in which to keep a record of the checksums of files "
+             "copied to the server. If given, 'copy' only transfers files "
+             "that have changed since the last copy, and reports files that "
+             "have been removed locally"
+    )
+    parser.add_argument(
+        "--delete-orphans",
+        action="store_true",
+        default=False,
+        help="With --sync-manifest-dir, delete files from the server that "
+             "were previously copied but no longer exist locally"
+    )
+    parser.add_argument(
+        "--reinit-state-file",
+        help="File used to record that THREDDS needs to be reinitialised. "
+             "When content changes without --reinit the file is created, and "
+             "a later run with --reinit reinitialises THREDDS if the file "
+             "exists even if that run changes nothing"
+    )
     parser.add_argument(
         "--thredds-username",
         help="THREDDS admin username to use when calling reinit URL"
@@ -214,11 +827,30 @@ def main():
         "delete",
         help="Delete content from remote node"
     )
-    subparsers.add_parser(
+    retrieve_parser = subparsers.add_parser(
         "retrieve",
         help="Retrieve content from remote node. -c and -n are interpreted in "
-             "the same way as for 'delete', and retrieved content is written "
-             "to stdout"
+             "the same way as for 'delete'. The contents of a single file are "
+             "written to stdout; multiple files are written to stdout as a "
+             "tar archive, or extracted with -o"
+    )
+    retrieve_parser.add_argument(
+        "-o", "--output-dir",
+        help="Directory to extract retrieved files to. Catalogs and NcML "
+             "files are placed in subdirectories named after the remote "
+             "catalog and aggregation directories"
+    )
+    retrieve_parser.add_argument(
+        "-z", "--compress",
+        action="store_true",
+        default=False,
+        help="Compress files with gzip for transfer"
+    )
+    subparsers.add_parser(
+        "verify",
+        help="Compare checksums of files on the remote node to those recorded "
+             "by copies made with --sync-manifest-dir, and exit with a "
+             "non-zero status if they differ"
     )
 
     args = parser.parse_args(sys.argv[1:])
@@ -230,25 +862,72 @@ def main():
                          "when using --reinit")
         thredds_creds = (args.thredds_username, args.thredds_password)
 
+    if (args.delete_orphans or args.mode == "verify") and \
+            not args.sync_manifest_dir:
+        parser.error("--sync-manifest-dir is required for --delete-orphans "
+                     "and 'verify'")
+
     handler = RemoteCatalogHandler(user=args.user, server=args.server,
                                    remote_catalog_dir=args.remote_catalog_dir,
                                    remote_agg_dir=args.remote_agg_dir,
                                    verbose=args.verbose, dry_run=args.dry_run,
                                    reinit=args.reinit,
-                                   thredds_credentials=thredds_creds)
-
-    if args.mode == "copy":
-        handler.copy_to_server(args.catalog_path, args.ncml_path)
-
-    elif args.mode == "delete":
-        handler.delete_from_server(args.catalog_path, args.ncml_path)
-
-    elif args.mode == "retrieve":
-        if len(args.catalog_path) == 1 and not args.ncml_path:
-            contents = handler.retrieve_catalog(args.catalog_path[0])
-        elif len(args.ncml_path) == 1 and not args.catalog_path:
-            contents = handler.retrieve_ncml(args.ncml_path[0])
-        else:
-            parser.error("Must specify exactly one catalog or NcML file with "
-                         "'retrieve'")
-        print(contents)
+                                   thredds_credentials=thredds_creds,
+                                   parallel=args.parallel,
+                                   multiplex=args.multiplex,
+                                   manifest_dir=args.sync_manifest_dir,
+                                   delete_orphans=args.delete_orphans,
+                                   reinit_state_file=args.reinit_state_file)
+
+    with handler:
+        if args.mode == "copy":
+            handler.copy_to_server(args.catalog_path, args.ncml_path)
+
+        elif args.mode == "delete":
+            handler.delete_from_server(args.catalog_path, args.ncml_path)
+
+        elif args.mode == "retrieve":
+            num_paths = len(args.catalog_path) + len(args.ncml_path)
+            if num_paths == 0:
+                parser.error("Must specify at least one catalog or NcML file "
+                             "with 'retrieve'")
+            elif num_paths == 1 and not args.output_dir:
+                if args.catalog_path:
+                    contents = handler.retrieve_catalog(args.catalog_path[0])
+                else:
+                    contents = handler.retrieve_ncml(args.ncml_path[0])
+                print(contents)
+            else:
+                if args.output_dir:
+                    cat_root = os.path.normpath(args.remote_catalog_dir)
+                    agg_root = os.path.normpath(args.remote_agg_dir)
+                    if (args.catalog_path and args.ncml_path and
+                            os.path.basename(cat_root) ==
+                            os.path.basename(agg_root)):
+                        parser.error("Remote catalog and aggregation "
+                                     "directories must have different names "
+                                     "to use --output-dir")
+                num_files, num_bytes, seconds = handler.retrieve_archive(
+                    args.catalog_path, args.ncml_path,
+                    output_dir=args.output_dir, out=sys.stdout.buffer,
+                    compress=args.compress
+                )
+                rate = num_bytes / seconds / 1e6 if seconds else 0
+                summary = "Retrieved {} bytes".format(num_bytes)
+                if args.output_dir:
+                    summary += " ({} files)".format(num_files)
+                print("{} in {:.2f} s ({:.2f} MB/s)".format(summary, seconds,
+                                                            rate),
+                      file=sys.stderr)
+
+        elif args.mode == "verify":
+            drift = False
+            for root, results in handler.verify_server().items():
+                for label, rel_paths in zip(("modified", "missing",
+                                             "untracked"), results):
+                    for rel_path in rel_paths:
+                        drift = True
+                        print("{}: {}".format(label,
+                                              os.path.join(root, rel_path)))
+            if drift:
+                sys.exit(1)
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Remove the THREDDS catalogs and NcML aggregations for many datasets from the
+local catalog directories and the remote THREDDS server in a single batch.
+
+This is done in two steps, which should be run either side of unpublishing
+the datasets with the ESGF publisher:
+
+- 'find' looks up the catalog for each dataset in the publication DB (with a
+  single query) and finds the NcML files it references. The result is written
+  as JSON.
+
+- 'remove' takes this JSON, copies the regenerated top-level catalog from the
+  publisher, deletes all the catalogs and NcML files locally and on the remote
+  server (with a single remote command), copies the top-level catalog to the
+  server and reinitialises THREDDS once.
+"""
+import sys
+import os
+import argparse
+import json
+import tempfile
+from collections import OrderedDict
+
+from esacci_esgf.find_ncml import find_ncml
+from esacci_esgf.get_catalogs import CatalogGetter
+from esacci_esgf.transfer_catalogs import RemoteCatalogHandler, parent_dirs
+
+
+class BatchUnpublisher(object):
+    """
+    Class to remove catalogs and aggregations for a batch of datasets.
+    `getter' is a CatalogGetter and `handler' a RemoteCatalogHandler
+    """
+    def __init__(self, getter, handler, catalog_dir, ncml_dir):
+        self.getter = getter
+        self.handler = handler
+        self.catalog_dir = catalog_dir
+        self.ncml_dir = ncml_dir
+
+    def find_paths(self, ds_names):
+        """
+        Return an OrderedDict mapping each dataset name to a dictionary
+        containing the path of its catalog relative to the catalog root
+        ('catalog') and a list of paths of NcML files relative to the
+        aggregation root ('ncml')
+        """
+        ds_names = list(ds_names)
+        cat_locations = self.getter.get_catalog_locations(ds_names)
+
+        not_found = [name for name in ds_names if name not in cat_locations]
+        if not_found:
+            print("WARNING: Failed to find the following datasets in the DB:",
+                  file=sys.stderr)
+            for ds_name in not_found:
+                print(ds_name, file=sys.stderr)
+
+        ncml_paths = self.get_ncml_paths(
+            [cat_locations[name] for name in ds_names
+             if name in cat_locations]
+        )
+        return OrderedDict(
+            (name, {"catalog": cat_locations[name],
+                    "ncml": ncml_paths[cat_locations[name]]})
+            for name in ds_names if name in cat_locations
+        )
+
+    def get_ncml_paths(self, cat_paths):
+        """
+        Return a dictionary mapping catalog paths (relative to the catalog
+        root) to a list of the NcML files they reference (relative to the
+        aggregation root).
+
+        The local copy of each catalog is used where it exists. Any others are
+        retrieved from the remote server in a single transfer
+        """
+        local_paths = {p: os.path.join(self.catalog_dir, p) for p in cat_paths}
+        missing = [p for p, local in local_paths.items()
+                   if not os.path.isfile(local)]
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            if missing:
+                self.handler.retrieve_archive(missing, [], output_dir=tmpdir)
+                root_name = os.path.basename(
+                    os.path.normpath(self.handler.remote_catalog_dir)
+                )
+                for p in missing:
+                    local_paths[p] = os.path.join(tmpdir, root_name, p)
+
+            locations = find_ncml(local_paths[p] for p in cat_paths)
+
+        agg_root = os.path.join(
+            os.path.normpath(self.handler.remote_agg_dir), ""
+        )
+        ncml_paths = {}
+        for p in cat_paths:
+            ncml_paths[p] = []
+            for location in locations[local_paths[p]]:
+                if not location.startswith(agg_root):
+                    print("WARNING: NcML file '{}' in catalog '{}' is not "
+                          "under {}".format(location, p, agg_root),
+                          file=sys.stderr)
+                    continue
+                ncml_paths[p].append(os.path.relpath(location, agg_root))
+        return ncml_paths
+
+    def remove_local(self, root_dir, rel_paths):
+        """
+        Delete files under a local directory, and any parent directories that
+        are left empty
+        """
+        paths = [os.path.join(root_dir, p) for p in rel_paths]
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                print("WARNING: could not delete '{}': file not found"
+                      .format(path), file=sys.stderr)
+        for dirname in parent_dirs(root_dir, paths):
+            try:
+                os.rmdir(dirname)
+            except OSError:
+                pass
+
+    def remove(self, paths):
+        """
+        Remove catalogs and NcML files given in the format returned by
+        find_paths(), and update the top-level catalog on the remote server
+        """
+        cat_paths = [info["catalog"] for info in paths.values()]
+        ncml_paths = [p for info in paths.values() for p in info["ncml"]]
+
+        self.getter.copy_top_level_catalog()
+        self.remove_local(self.catalog_dir, cat_paths)
+        self.remove_local(self.ncml_dir, ncml_paths)
+
+        # Note that the handler reinitialises THREDDS (at most once) when it
+        # is closed
+        self.handler.delete_from_server(cat_paths, ncml_paths)
+        self.handler.copy_to_server(
+            [os.path.join(self.catalog_dir, "catalog.xml")], []
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "-e", "--esg-ini",
+        required=True,
+        help="Path to esg.ini containing DB connection URL and THREDDS "
+             "catalog root directory"
+    )
+    parser.add_argument(
+        "-s", "--server",
+        required=True,
+        help="Hostname of the remote THREDDS server"
+    )
+    parser.add_argument(
+        "-u", "--user",
+        default="root",
+        help="Username to connect to the server as [default: %(default)s]"
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        default=False,
+        help="Print rsync/ssh commands as they are run"
+    )
+    parser.add_argument(
+        "--catalog-dir",
+        required=True,
+        help="Local directory containing modified catalogs"
+    )
+    parser.add_argument(
+        "--ncml-dir",
+        required=True,
+        help="Local directory containing NcML aggregations"
+    )
+    parser.add_argument(
+        "--remote-catalog-dir",
+        required=True,
+        help="Directory under which catalogs are stored on the server"
+    )
+    parser.add_argument(
+        "--remote-agg-dir",
+        default="/usr/local/aggregations/",
+        help="Directory under which NcML aggregations are stored on the server"
+             " [default: %(default)s]"
+    )
+    parser.add_argument(
+        "--thredds-username",
+        help="THREDDS admin username to use when calling reinit URL"
+    )
+    parser.add_argument(
+        "--thredds-password",
+        help="THREDDS admin password to use when calling reinit URL"
+    )
+
+    subparsers = parser.add_subparsers(
+        dest="mode",
+        metavar="MODE",
+        help="Step to run"
+    )
+    subparsers.required = True
+    find_parser = subparsers.add_parser(
+        "find",
+        help="Find catalogs and NcML files for datasets and print them as "
+             "JSON"
+    )
+    find_parser.add_argument(
+        "dataset_names",
+        nargs="+",
+        metavar="dataset_name",
+        help="Versioned dataset name - e.g. my.dataset.v1234"
+    )
+    remove_parser = subparsers.add_parser(
+        "remove",
+        help="Remove catalogs and NcML files listed in the output of 'find'"
+    )
+    remove_parser.add_argument(
+        "paths_json",
+        help="File containing the output of 'find'"
+    )
+
+    args = parser.parse_args(sys.argv[1:])
+
+    thredds_creds = None
+    if args.thredds_username and args.thredds_password:
+        thredds_creds = (args.thredds_username, args.thredds_password)
+
+    getter = CatalogGetter(args.esg_ini, output_dir=args.catalog_dir)
+    handler = RemoteCatalogHandler(user=args.user, server=args.server,
+                                   remote_catalog_dir=args.remote_catalog_dir,
+                                   remote_agg_dir=args.remote_agg_dir,
+                                   verbose=args.verbose,
+                                   reinit=thredds_creds is not None,
+                                   thredds_credentials=thredds_creds)
+    unpublisher = BatchUnpublisher(getter, handler, args.catalog_dir,
+                                   args.ncml_dir)
+
+    with handler, getter:
+        if args.mode == "find":
+            paths = unpublisher.find_paths(args.dataset_names)
+            json.dump(paths, sys.stdout, indent=4)
+            print("")
+
+        elif args.mode == "remove":
+            with open(args.paths_json) as f:
+                paths = json.load(f, object_pairs_hook=OrderedDict)
+            unpublisher.remove(paths)
+
+
+if __name__ == "__main__":
+    main()
@@ -95,11 +95,14 @@ dsid_from_mapfile() {
 INI_FILE="${INI_DIR}/esg.ini"
 PROJ="esacci"
 
-REMOTE_TDS_HOST=`cci_env parse_esg_ini "$INI_FILE" thredds_host` || die "could not get THREDDS host from $INI_FILE"
-SOLR_HOST=`cci_env parse_esg_ini "$INI_FILE" solr_host` || die "could not get Solr host from $INI_FILE"
-TDS_ADMIN_USER=`cci_env parse_esg_ini "$INI_FILE" thredds_username` || \
-    die "could not get THREDDS admin username from $INI_FILE"
-TDS_ADMIN_PASSWORD=`cci_env parse_esg_ini "$INI_FILE" thredds_password` || \
-    die "could not get THREDDS admin password from $INI_FILE"
+# Get all required values from the ini file with a single call
+ini_exports=`cci_env parse_esg_ini "$INI_FILE" \
+                     --export REMOTE_TDS_HOST=thredds_host \
+                     --export SOLR_HOST=solr_host \
+                     --export TDS_ADMIN_USER=thredds_username \
+                     --export TDS_ADMIN_PASSWORD=thredds_password` || \
+    die "could not get THREDDS host, Solr host and THREDDS admin credentials from $INI_FILE"
+eval "$ini_exports"
+unset ini_exports
 
 REMOTE_TDS_URL="http://${REMOTE_TDS_HOST}/thredds/"
@@ -68,7 +68,7 @@ certificate_check 70
 
 # Get input CSV in a JSON format used throughout the rest of the process
 in_json=`mktemp`
-cci_env merge_csv_json "$in_csv" > "$in_json" || \
+cci_env merge_csv_json --compact "$in_csv" > "$in_json" || \
     die "failed to parse input CSV"
 
 # Check facet values in DRSes match those defined in the project INI.
@@ -120,15 +120,18 @@ for mapfile in $mapfiles; do
             excluded_mapfiles="${excluded_mapfiles} ${mapfile}"
             excluded_dsids="${excluded_dsids} ${dsid}"
         fi
-
-        # Remove from JSON
-        temp_json="${in_json}.bak"
-        mv "$in_json" $temp_json
-        cci_env remove_key "$dsid" "$temp_json" > "$in_json"
-        rm "$temp_json"
     fi
 done
 
+# Remove all excluded datasets from the JSON in one go
+if [[ -n $excluded_dsids ]]; then
+    temp_json="${in_json}.bak"
+    mv "$in_json" $temp_json
+    cci_env remove_key $excluded_dsids "$temp_json" > "$in_json" || \
+        die "failed to remove excluded datasets from JSON"
+    rm "$temp_json"
+fi
+
 mapfiles=`remove_exclusions "$mapfiles" "$excluded_mapfiles"`
 
 # No point in continuing if all datasets failed above
@@ -174,7 +177,8 @@ for mapfile in $mapfiles; do
 done
 
 log "modifying WMS links in Solr..."
-cci_env modify_solr_links "http://${SOLR_HOST}:8984" || die "failed to modify Solr links"
+cci_env modify_solr_links --dataset-json "$in_json" "http://${SOLR_HOST}:8984" || \
+    die "failed to modify Solr links"
 
 # Clean up
 rm "$in_json"
@@ -19,15 +19,21 @@ setup(
     },
     entry_points={
         "console_scripts": [
+            "cache_remote_aggregations=esacci_esgf.cache_remote_aggregations:main",
+            "convert_manifest=esacci_esgf.input.manifest:main",
+            "find_ncml=esacci_esgf.find_ncml:main",
             "get_catalog_path=esacci_esgf.get_catalog_path:main",
             "get_catalogs=esacci_esgf.get_catalogs:main",
             "make_mapfiles=esacci_esgf.input.make_mapfiles:main",
             "merge_csv_json=esacci_esgf.input.merge_csv_json:main",
+            "merge_shards=esacci_esgf.shards:main",
             "modify_catalogs=esacci_esgf.modify_catalogs:main",
             "modify_solr_links=esacci_esgf.modify_solr_links:main",
             "parse_esg_ini=esacci_esgf.input.parse_esg_ini:main",
+            "publish=esacci_esgf.publish:main",
             "remove_key=esacci_esgf.input.remove_key:main",
             "transfer_catalogs=esacci_esgf.transfer_catalogs:main",
+            "unpublish_catalogs=esacci_esgf.unpublish:main",
         ]
     }
 )